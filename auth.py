@@ -1,49 +1,104 @@
 #!/usr/bin/env python3
 
-import os, requests, json, jwt, urllib3
+import os, time, requests, json, jwt, urllib3
 from log import print_to_log
 
-def auth_with_dc (debug=False):
+#The Data Catalog token and the ADFS signing keys are cached on disk, readable by the owner only, so that
+#back to back runs reuse them instead of going through ADFS every time.
+dc_cache_dir = os.environ.get("DC_CACHE_DIR", os.path.expanduser("~/.cache/jgi_transfer_tasks"))
+dc_token_cache_path = os.path.join(dc_cache_dir, "dc_token.json")
+dc_jwks_cache_path = os.path.join(dc_cache_dir, "dc_jwks.json")
+dc_adfs_url = os.environ.get("DC_ADFS_URL", "https://login.glbrc.org/adfs").rstrip("/")
+dc_keys_url = dc_adfs_url+"/discovery/keys"
+dc_jwks_ttl = 24*3600
+dc_public_keys = {}
+
+def read_cache(path):
+	try:
+		with open(path) as cf:
+			return json.load(cf)
+	except (OSError, ValueError):
+		return {}
+
+def write_cache(path, data):
+	os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+	tmp_path = path+"."+str(os.getpid())
+	fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+	with os.fdopen(fd, "w") as cf:
+		json.dump(data, cf)
+	os.replace(tmp_path, path)
+
+def get_dc_public_key(kid):
+	#Signing keys are looked up by kid, first in memory, then in the on-disk JWKS cache while it is younger
+	#than dc_jwks_ttl. An unknown kid (ADFS rotated its keys) or a stale cache triggers a fresh download.
+	if kid in dc_public_keys:
+		return dc_public_keys[kid]
+	jwks_cache = read_cache(dc_jwks_cache_path)
+	if kid not in jwks_cache.get("keys", {}) or time.time() - jwks_cache.get("fetched_at", 0) > dc_jwks_ttl:
+		dc_keys_url_response = requests.get(dc_keys_url, verify=False, allow_redirects=False)
+		dc_keys_url_response_json = json.loads(dc_keys_url_response.text)
+		jwks_cache = {"fetched_at": time.time(), "keys": {}}
+		for jwk in dc_keys_url_response_json["keys"]:
+			jwks_cache["keys"][str(jwk["kid"])] = jwk
+		write_cache(dc_jwks_cache_path, jwks_cache)
+	if kid not in jwks_cache["keys"]:
+		return None
+	dc_public_keys[kid] = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(jwks_cache["keys"][kid]))
+	return dc_public_keys[kid]
+
+def verify_dc_token(dc_token, debug=False):
+	dc_token_kid = str(jwt.get_unverified_header(dc_token)['kid'])
+	dc_token_aud = str(jwt.decode(dc_token, verify=False)['aud'])
+	dc_key = get_dc_public_key(dc_token_kid)
+	if debug == True:
+		print(dc_key)
+		print(dc_token)
+		print(dc_token_kid)
+	if dc_key == None:
+		return None
+	try:
+		return jwt.decode(dc_token, verify=True, key = dc_key, algorithms=["RS256"], audience=dc_token_aud)
+	except jwt.InvalidTokenError:
+		return None
+
+def auth_with_dc (debug=False, min_validity=300):
 	urllib3.disable_warnings()
-	
+
 	dc_u = os.environ["DC_USER"]
 	dc_pw = os.environ["DC_PW"]
 	dc_client_id = os.environ["DC_CLIENT_ID"]
 	dc_client_secret = os.environ["DC_CLIENT_SECRET"]
-	
+
+	#Reuse the cached token until min_validity seconds before it expires
+	token_cache = read_cache(dc_token_cache_path)
+	if token_cache.get("username") == dc_u and token_cache.get("client_id") == dc_client_id and token_cache.get("exp", 0) - min_validity > time.time():
+		payload = verify_dc_token(token_cache["id_token"], debug)
+		if payload != None:
+			if debug == True:
+				print_to_log("Reusing cached Data Catalog token.")
+			return token_cache["id_token"]
+
 	dc_token = ""
-	dc_token_url = "https://login.glbrc.org/adfs/oauth2/token"
+	dc_token_url = dc_adfs_url+"/oauth2/token"
 	dc_grant_data = {'grant_type': 'password','username': dc_u, 'password': dc_pw, 'client_id':dc_client_id}
 	dc_access_token_response = requests.post(dc_token_url, data=dc_grant_data, verify=False, allow_redirects=False, auth=(dc_client_id, dc_client_secret))
 	dc_tokens = json.loads(dc_access_token_response.text)
 	if "id_token" in dc_tokens:
 		dc_token = dc_tokens["id_token"]
-		dc_token_kid = str(jwt.get_unverified_header(dc_token)['kid'])
-		dc_token_aud = str(jwt.decode(dc_token, verify=False)['aud'])
-		dc_keys_url = "https://login.glbrc.org/adfs/discovery/keys"
-		dc_keys_url_response = requests.get(dc_keys_url, verify=False, allow_redirects=False)
-		dc_keys_url_response_json = json.loads(dc_keys_url_response.text)
-		dc_public_keys = {}
-		for jwk in dc_keys_url_response_json["keys"]:
-			dc_kid = str(jwk["kid"])
-			dc_public_keys[dc_kid] = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(jwk))
-		dc_key = dc_public_keys[dc_token_kid]
-		if debug == True:
-			print(dc_key)
-			print(dc_token)
-			print(dc_token_kid)
-			print(dc_kid)
-		payload = None
-		try:
-			payload = jwt.decode(dc_token, verify=True, key = dc_key, algorithms=["RS256"], audience=dc_token_aud)
-		except jwt.InvalidTokenError:
+		payload = verify_dc_token(dc_token, debug)
+		if payload == None:
 			print_to_log("The obtained Data Catalog token is invalid!","fatal")
 			return ""
 		if debug == True:
 			print_to_log(json.dumps(payload))
-			
+		write_cache(dc_token_cache_path, {"username": dc_u, "client_id": dc_client_id, "id_token": dc_token, "exp": payload["exp"]})
+
 		return dc_token
-		
+
 	else:
 		print_to_log("No id_token obtained from Data Catalog!","fatal")
-		return ""
\ No newline at end of file
+		return ""
+
+def dc_token_expires_at(dc_token):
+	#Expiry of a token handed out by auth_with_dc(), so long-running callers know when to ask for a new one
+	return int(jwt.decode(dc_token, verify=False).get("exp", 0))
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+#
+# End-to-end runs of jgi_transfer_tasks.py against local fakes of every service it talks to: the JGI portal
+# (fake_jgi.py), Globus (fake_globus.py, API or CLI backend), ADFS (fake_adfs.py), the Data Catalog
+# (fake_catalog.py), the helpdesk SMTP server (fake_smtp.py) and Oracle (fakes/cx_Oracle.py, on SQLite).
+# Run from the repository root:
+#   python benchmarks/bench_end_to_end.py --deliverables 10 50 --files 20 --size_kb 64 4096 --backend api
+# Every combination of deliverables x files x size is one scenario: its deliverables are seeded as New,
+# their files put on the fake stage endpoint, and the script is run until all of them are Posted and Moved
+# (or --timeout). --mode phases runs --stage, --xfer and --post as separate processes in cycles, like cron
+# does, --mode pipeline runs one --pipeline process. Reported are the end-to-end time, the time per phase
+# and the time spent in every kind of external call, from the metrics the script writes (metrics.py).
+# --config takes extra config keys as JSON, e.g. '{"xfer_batch": true, "placement_checksum": "md5",
+# "placement_checksum_all": true}'.
+# --processes runs several copies of every phase (or pipeline) at once, sharing the queue through leases.
+# Without leasing the script keeps its lockfile in /tmp, so a single process run cannot be made next to a
+# production instance on the same host.
+
+import os, sys, json, time, shutil, sqlite3, argparse, itertools, tempfile, subprocess
+from collections import defaultdict
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(benchmarks_dir)
+sys.path.insert(0, os.path.join(benchmarks_dir, "fakes"))
+sys.path.insert(0, benchmarks_dir)
+import cx_Oracle
+from fake_jgi import FakeJGIPortal, stage_path
+from fake_globus import FakeGlobusTransfer
+from fake_adfs import FakeADFS
+from fake_catalog import FakeDataCatalog
+from fake_smtp import FakeSMTPServer
+
+lockfile = "/tmp/jgi_transfer_tasks.pid"
+in_flight = ("New", "Staging", "Downloading")
+
+def seed(db_path, stage_root, deliverables, files, size, samples):
+	#Deliverables 1000001... as New, with their samples and files on the stage endpoint
+	cx_Oracle.schema(db_path)
+	con = sqlite3.connect(db_path)
+	block = os.urandom(min(size, 1024*1024))
+	for i in range(deliverables):
+		fd_id = str(1000001 + i)
+		con.execute("INSERT INTO sync_requests (fd_id, status, num_samples) VALUES (?, 'New', ?)", (fd_id, samples))
+		con.execute("INSERT INTO final_deliverables (id, fd_id) VALUES (?, ?)", (i + 1, fd_id))
+		for j in range(samples):
+			con.execute("INSERT INTO samples (sample_id, final_deliverable_id) VALUES (?, ?)", ("BENCH_"+fd_id+"_"+str(j), i + 1))
+		directory = os.path.join(stage_root, stage_path(fd_id).strip("/"), "Raw_Data")
+		os.makedirs(directory)
+		for j in range(files):
+			with open(os.path.join(directory, "%s.%05d.filter-RNA.fastq.gz" % (fd_id, j)), "wb") as f:
+				written = 0
+				while written < size:
+					written += f.write(block[:size - written])
+	con.commit()
+	con.close()
+
+def statuses(db_path):
+	con = sqlite3.connect(db_path, timeout=30)
+	counts = dict(con.execute("SELECT status, COUNT(*) FROM sync_requests GROUP BY status").fetchall())
+	con.close()
+	return counts
+
+def count_files(path):
+	return sum(len(filenames) for dirpath, dirnames, filenames in os.walk(path))
+
+def spans(json_log_path):
+	#{(span name, phase or method and endpoint): [count, seconds, errors]} from the metrics JSON lines
+	totals = defaultdict(lambda: [0, 0.0, 0])
+	if os.path.exists(json_log_path) == False:
+		return totals
+	with open(json_log_path) as jf:
+		for line in jf:
+			record = json.loads(line)
+			if record.get("type") != "span":
+				continue
+			label = record.get("phase", record.get("method", record.get("strategy", "")))
+			if "endpoint" in record:
+				label += " "+record["endpoint"]
+			total = totals[(record["name"], label)]
+			total[0] += 1
+			total[1] += record["seconds"]
+			total[2] += 0 if record["ok"] == True else 1
+	return totals
+
+def run_script(options, config_path, env, log, processes=1):
+	#Runs processes copies side by side, returns (seconds until the last one exited, number that failed)
+	start = time.perf_counter()
+	running = [subprocess.Popen([sys.executable, os.path.join(repo_dir, "jgi_transfer_tasks.py"), "--config", config_path] + options, env=env, cwd=repo_dir, stdout=log, stderr=subprocess.STDOUT) for i in range(processes)]
+	failed = sum(1 for process in running if process.wait() != 0)
+	return (time.perf_counter() - start, failed)
+
+def scenario(args, deliverables, files, size_kb):
+	work_dir = tempfile.mkdtemp(prefix="jgi_bench_", dir=args.work_dir or None)
+	stage_root = os.path.join(work_dir, "stage")
+	tmp_path = os.path.join(work_dir, "tmp")
+	minio_path = os.path.join(args.minio_dir or work_dir, "minio_"+os.path.basename(work_dir))
+	db_path = os.path.join(work_dir, "sync_requests.sqlite")
+	json_log_path = os.path.join(work_dir, "metrics.jsonl")
+	for path in (stage_root, tmp_path, minio_path):
+		os.makedirs(path, exist_ok=True)
+	seed(db_path, stage_root, deliverables, files, size_kb*1024, args.samples)
+
+	portal = FakeJGIPortal(stage_delay=args.stage_delay, latency=args.latency).start()
+	globus = FakeGlobusTransfer(stage_root, bandwidth=args.bandwidth, task_delay=args.task_delay, concurrency=args.globus_concurrency, latency=args.latency, token_lifetime=args.globus_token_lifetime).start()
+	adfs = FakeADFS().start()
+	catalog = FakeDataCatalog(latency=args.latency).start()
+	smtp = FakeSMTPServer().start()
+
+	globus_bin = os.path.join(work_dir, "globus")
+	with open(globus_bin, "w") as gf:
+		gf.write("#!/bin/sh\nexec \""+sys.executable+"\" \""+os.path.join(benchmarks_dir, "fake_globus.py")+"\" cli --api_url "+globus.url+" \"$@\"\n")
+	os.chmod(globus_bin, 0o755)
+	config = {
+		"glbrc_destination_endpoint": "fake-glbrc-endpoint",
+		"tmp_path": tmp_path,
+		"base_minio_path": minio_path,
+		"base_dc_url": catalog.url,
+		"globus_transfer_backend": args.backend,
+		"globus_transfer_api_url": globus.url,
+		"globus_bin": globus_bin,
+		"jgi_portal_url": portal.portal_url,
+		"jgi_signon_url": portal.signon_url,
+		"state_dir": os.path.join(work_dir, "state"),
+		"metrics_json_log": json_log_path,
+		"metrics_textfile": os.path.join(work_dir, "metrics.prom"),
+		"helpdesk_smtp_host": smtp.host,
+		"helpdesk_smtp_port": smtp.port,
+		"helpdesk_from": "bench@localhost",
+		"helpdesk_to": ["helpdesk@localhost"],
+		"helpdesk_subject": "jgi_transfer_tasks benchmark",
+		"transfer_poll_min_interval": 0,
+		"pipeline_intervals": {"stage": args.cycle_pause, "xfer": args.cycle_pause, "post": args.cycle_pause},
+		"pipeline_max_runtime": args.timeout,
+		#Several processes share the queue through row leases (see SyncRequests in db.py)
+		"db_leasing": args.processes > 1,
+		"lease_batch_size": max(1, -(-deliverables // args.processes)),
+	}
+	if args.globus_token_lifetime > 0:
+		config["globus_auth_url"] = globus.url+"/v2/oauth2/token"
+	config.update(json.loads(args.config))
+	config_path = os.path.join(work_dir, "config.json")
+	with open(config_path, "w") as cf:
+		json.dump(config, cf, indent=2)
+	env = dict(os.environ)
+	env.update({
+		"PYTHONPATH": os.pathsep.join([os.path.join(benchmarks_dir, "fakes"), repo_dir] + ([env["PYTHONPATH"]] if "PYTHONPATH" in env else [])),
+		"JGI_USER": "bench", "JGI_PW": "bench",
+		"GLOBUS_USER": "bench", "GLOBUS_MYPROXY_USER": "bench", "GLOBUS_MYPROXY_PW": "bench",
+		"GLOBUS_TRANSFER_TOKEN": "fake-transfer-token",
+		"data_transfer_scripts_USERNAME": "bench", "data_transfer_scripts_PASSWORD": "bench",
+		"data_transfer_scripts_DB_HOST_PRIMARY": "localhost", "data_transfer_scripts_DB_HOST_SECONDARY": "localhost",
+		"data_transfer_scripts_DB_SERVICE_NAME": db_path,
+		"DC_USER": "bench", "DC_PW": "bench", "DC_CLIENT_ID": "fake-client", "DC_CLIENT_SECRET": "fake-secret",
+		"DC_ADFS_URL": adfs.url,
+		"DC_CACHE_DIR": os.path.join(work_dir, "cache"),
+	})
+	if args.globus_token_lifetime > 0:
+		#Short-lived tokens the script has to renew with its refresh token
+		env.update({"GLOBUS_TRANSFER_TOKEN": "", "GLOBUS_TRANSFER_REFRESH_TOKEN": "fake-refresh-token", "GLOBUS_CLIENT_ID": "fake-globus-client"})
+
+	phase_wall = defaultdict(lambda: [0, 0.0, 0])
+	cycles = 0
+	start = time.perf_counter()
+	with open(os.path.join(work_dir, "script.log"), "w") as log:
+		if args.mode == "pipeline":
+			phase_seconds, failed = run_script(["--pipeline"], config_path, env, log, args.processes)
+			phase_wall["pipeline"] = [args.processes, phase_seconds, failed]
+			cycles = 1
+		else:
+			while True:
+				for phase in ("stage", "xfer", "post"):
+					phase_seconds, failed = run_script(["--"+phase], config_path, env, log, args.processes)
+					phase_wall[phase][0] += args.processes
+					phase_wall[phase][1] += phase_seconds
+					phase_wall[phase][2] += failed
+				cycles += 1
+				counts = statuses(db_path)
+				if sum(counts.get(status, 0) for status in in_flight) == 0 or time.perf_counter() - start > args.timeout:
+					break
+				time.sleep(args.cycle_pause)
+	seconds = time.perf_counter() - start
+
+	counts = statuses(db_path)
+	total_files = deliverables * files
+	total_mb = total_files * size_kb * 1024 / 1e6
+	print("scenario: %d deliverables x %d files x %d KB (%d files, %.1f MB), %s backend, %s mode, %d process(es)" % (deliverables, files, size_kb, total_files, total_mb, args.backend, args.mode, args.processes))
+	print("  end-to-end:  %.2f s in %d cycle(s), %.1f MB/s, %.1f files/s" % (seconds, cycles, total_mb / seconds, total_files / seconds))
+	print("  deliverables: "+", ".join("%s %d" % (status, count) for status, count in sorted(counts.items())))
+	print("  files placed: %d of %d, %d registered, %d checksums" % (count_files(minio_path), total_files, sum(len(subpaths) for subpaths in catalog.files.values()), len(catalog.checksums)))
+	print("  process wall time per phase:")
+	for phase, (runs, phase_seconds, failed) in phase_wall.items():
+		print("    %-10s %4d run(s) %9.2f s %4d failed" % (phase, runs, phase_seconds, failed))
+	print("  spans (count, total s, errors):")
+	for (name, label), (count, span_seconds, errors) in sorted(spans(json_log_path).items()):
+		print("    %-48s %7d %9.3f %5d" % (name+" "+label, count, span_seconds, errors))
+	requests_seen = [("jgi", portal.requests), ("globus", globus.requests), ("adfs", adfs.requests), ("catalog", catalog.requests)]
+	print("  requests to the fakes: "+", ".join(service+" "+str(sum(seen.values())) for service, seen in requests_seen)+", helpdesk emails "+str(len(smtp.messages)))
+	print("  work directory: "+work_dir)
+
+	for fake in (portal, globus, adfs, catalog, smtp):
+		fake.stop()
+	if args.keep == False:
+		shutil.rmtree(work_dir)
+		shutil.rmtree(minio_path, ignore_errors=True)
+
+parser = argparse.ArgumentParser(description="Benchmark jgi_transfer_tasks.py end to end against local fakes")
+parser.add_argument("--deliverables", nargs="*", default=[10], type=int, help="Numbers of deliverables")
+parser.add_argument("--files", nargs="*", default=[20], type=int, help="Numbers of files per deliverable")
+parser.add_argument("--size_kb", nargs="*", default=[1024], type=int, help="File sizes in KB")
+parser.add_argument("--samples", default=1, type=int, help="Samples per deliverable, more than one posts to an experiment")
+parser.add_argument("--backend", default="api", choices=["api", "cli"], help="Globus transfer backend")
+parser.add_argument("--mode", default="phases", choices=["phases", "pipeline"], help="")
+parser.add_argument("--processes", default=1, type=int, help="Script processes run side by side, more than one turns on db_leasing")
+parser.add_argument("--stage_delay", default=0.0, type=float, help="Seconds JGI takes to stage a deliverable")
+parser.add_argument("--task_delay", default=0.0, type=float, help="Minimum seconds a Globus task takes")
+parser.add_argument("--bandwidth", default=0.0, type=float, help="Globus MB/s per file, 0 for no limit")
+parser.add_argument("--globus_token_lifetime", default=0, type=int, help="Seconds a Globus access token is valid (API backend), 0 for one static token")
+parser.add_argument("--globus_concurrency", default=4, type=int, help="Globus tasks running at the same time")
+parser.add_argument("--latency", default=0.0, type=float, help="Seconds added to every JGI, Globus and Data Catalog request")
+parser.add_argument("--cycle_pause", default=1, type=int, help="Seconds between cycles (phases mode) or the pipeline intervals")
+parser.add_argument("--timeout", default=600, type=int, help="Seconds a scenario may take")
+parser.add_argument("--config", default="{}", help="Extra config keys as JSON")
+parser.add_argument("--work_dir", default="", help="Where to create the scenario directories (default: a temporary directory)")
+parser.add_argument("--minio_dir", default="", help="Where to place the files, e.g. on another filesystem (default: the scenario directory)")
+parser.add_argument("--keep", default=False, action="store_true", help="Keep the scenario directories, with the script log and metrics")
+args = parser.parse_args()
+
+if args.processes == 1 and os.path.exists(lockfile) == True:
+	with open(lockfile) as pf:
+		pid = pf.read().strip()
+	if pid.isdigit() == True and os.path.exists("/proc/"+pid) == True:
+		print("jgi_transfer_tasks.py is running (PID "+pid+"), the benchmark would be locked out.")
+		sys.exit(1)
+for deliverables, files, size_kb in itertools.product(args.deliverables, args.files, args.size_kb):
+	scenario(args, deliverables, files, size_kb)
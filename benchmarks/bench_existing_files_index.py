@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+#
+# Compare the old linear scan over existing Data Catalog files with the subpath index used by post(),
+# on a synthetic experiment. Run from the repository root:
+#   python benchmarks/bench_existing_files_index.py --existing 50000 --transferred 5000
+
+import os, sys, time, random, argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from catalog import index_existing_files
+
+def linear_lookup(path, existing_files, existing_files_full):
+	for i,ef in enumerate(existing_files):
+		if ef == path:
+			return existing_files_full[i]
+	return None
+
+parser = argparse.ArgumentParser(description="Benchmark existing file lookups in post()")
+parser.add_argument("--existing", default=50000, type=int, help="Number of files already in the experiment")
+parser.add_argument("--transferred", default=5000, type=int, help="Number of transferred files to look up")
+parser.add_argument("--hit_ratio", default=0.5, type=float, help="Fraction of transferred files that already exist")
+parser.add_argument("--seed", default=1, type=int, help="")
+args = parser.parse_args()
+
+random.seed(args.seed)
+existing_files = ["JGI_%06d/QC_Filtered_Raw_Data/%06d.filter-RNA.fastq.gz" % (i // 100, i) for i in range(args.existing)]
+existing_files_full = ["experiments/1234/"+ef for ef in existing_files]
+transferred = []
+for i in range(args.transferred):
+	if random.random() < args.hit_ratio:
+		transferred.append(random.choice(existing_files))
+	else:
+		transferred.append("JGI_NEW/Metagenome_Bins/bin.%06d.fa" % i)
+
+start = time.perf_counter()
+linear_hits = sum(1 for path in transferred if linear_lookup(path, existing_files, existing_files_full) != None)
+linear_time = time.perf_counter() - start
+
+start = time.perf_counter()
+existing_files_index = index_existing_files(existing_files, existing_files_full)
+build_time = time.perf_counter() - start
+start = time.perf_counter()
+index_hits = sum(1 for path in transferred if path in existing_files_index)
+index_time = time.perf_counter() - start
+
+assert linear_hits == index_hits
+print("existing files:      "+str(args.existing))
+print("transferred files:   "+str(args.transferred)+" ("+str(index_hits)+" already present)")
+print("linear scan:         %.3f s" % linear_time)
+print("index build:         %.3f s" % build_time)
+print("index lookups:       %.6f s" % index_time)
+print("speedup:             %.0fx" % (linear_time / (build_time + index_time)))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+#
+# Check that IngestPipeline overlaps Data Catalog posts with moves into MinIO storage, with sleeps standing
+# in for both. Run from the repository root:
+#   python benchmarks/bench_ingest_overlap.py --files 400 --batch_size 100 --max_pending 64
+# Reports the pipeline time against running every post and then every move one after the other, the most
+# posts running at once and how long posts and moves ran at the same time. Exits with status 1 when they
+# never overlapped.
+
+import os, sys, time, argparse, threading
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ingest import IngestPipeline
+
+class Activity:
+	#Intervals during which posts and moves were running
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.running = {"post": 0, "move": 0}
+		self.max_running = {"post": 0, "move": 0}
+		self.overlap = 0.0
+		self.since = None
+
+	def change(self, stage, delta):
+		with self.lock:
+			now = time.perf_counter()
+			if self.since != None:
+				self.overlap += now - self.since
+				self.since = None
+			self.running[stage] += delta
+			self.max_running[stage] = max(self.max_running[stage], self.running[stage])
+			if self.running["post"] > 0 and self.running["move"] > 0:
+				self.since = now
+
+parser = argparse.ArgumentParser(description="Benchmark the overlap of posts and moves in the ingest pipeline")
+parser.add_argument("--files", default=400, type=int, help="Number of files")
+parser.add_argument("--batch_size", default=100, type=int, help="Files registered per Data Catalog request (dc_bulk_batch_size)")
+parser.add_argument("--max_pending", default=64, type=int, help="Files in flight at most (ingest_max_pending)")
+parser.add_argument("--post_workers", default=4, type=int, help="")
+parser.add_argument("--move_workers", default=2, type=int, help="")
+parser.add_argument("--post_seconds", default=0.5, type=float, help="Seconds one bulk registration request takes")
+parser.add_argument("--move_seconds", default=0.02, type=float, help="Seconds one move takes")
+args = parser.parse_args()
+
+activity = Activity()
+
+def post(items):
+	activity.change("post", 1)
+	time.sleep(args.post_seconds)
+	activity.change("post", -1)
+	return [(True, "/minio/"+item["local_file_path"], "", False) for item in items]
+
+def place(item, target_path):
+	activity.change("move", 1)
+	time.sleep(args.move_seconds)
+	activity.change("move", -1)
+	return (True, "")
+
+pipeline = IngestPipeline(post, place, post_workers=args.post_workers, move_workers=args.move_workers, max_pending=args.max_pending, retries=0, batch_size=args.batch_size)
+start = time.perf_counter()
+results = pipeline.run({"local_file_path": "%06d.fastq.gz" % i, "action": "post"} for i in range(args.files))
+seconds = time.perf_counter() - start
+serial = -(-args.files // args.batch_size) * args.post_seconds + args.files * args.move_seconds / args.move_workers
+
+print("files:               %d, batch_size %d, max_pending %d" % (args.files, args.batch_size, args.max_pending))
+print("pipeline:            %.2f s (posts then moves: %.2f s)" % (seconds, serial))
+print("moved:               %d of %d" % (len([r for r in results if r["moved"] == True]), args.files))
+print("max posts running:   %d" % activity.max_running["post"])
+print("post/move overlap:   %.2f s" % activity.overlap)
+if activity.overlap <= 0:
+	print("Posts and moves never ran at the same time.")
+	sys.exit(1)
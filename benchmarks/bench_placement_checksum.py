@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+#
+# Compare the integrity checks of ingest_place() on synthetic files: the size-only check after a kernel
+# copy, a naive checksum (kernel copy, then hashing the target in a second read) and the streaming
+# checksum of FilePlacer (hashing the data while copying it through the userspace path). Run from the
+# repository root:
+#   python benchmarks/bench_placement_checksum.py --files 4 --size_mb 512 --dst_dir /mnt/minio/tmp
+# Files are copied (--copy mode), so the same sources are reused for every variant. Pass a --dst_dir on
+# another filesystem to measure cross-device placement. Reads are counted from /proc/self/io (rchar).
+
+import os, sys, time, shutil, hashlib, argparse, tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from placement import FilePlacer, _hash_file
+
+def bytes_read():
+	try:
+		with open("/proc/self/io") as io:
+			for line in io:
+				if line.startswith("rchar:"):
+					return int(line.split()[1])
+	except OSError:
+		pass
+	return 0
+
+def size_only(src, dst):
+	placement = FilePlacer().place(src, dst, move=False)
+	return placement["bytes"] == os.stat(dst).st_size
+
+def naive_checksum(algorithm):
+	def check(src, dst):
+		placement = FilePlacer().place(src, dst, move=False)
+		digest = hashlib.new(algorithm)
+		_hash_file(dst, digest)
+		return placement["bytes"] == os.stat(dst).st_size and digest.hexdigest() != ""
+	return check
+
+def streaming_checksum(algorithm):
+	placer = FilePlacer("userspace", checksum=algorithm)
+	def check(src, dst):
+		placement = placer.place(src, dst, move=False)
+		return placement["bytes"] == os.stat(dst).st_size and placement["checksum"] != ""
+	return check
+
+parser = argparse.ArgumentParser(description="Benchmark checksum verification during file placement")
+parser.add_argument("--files", default=4, type=int, help="Number of files")
+parser.add_argument("--size_mb", default=256, type=int, help="Size of every file in MB")
+parser.add_argument("--src_dir", default="", help="Where to create the source files (default: a temporary directory)")
+parser.add_argument("--dst_dir", default="", help="Where to place the files (default: a temporary directory)")
+parser.add_argument("--algorithms", nargs="*", default=["md5", "blake2b"], help="")
+args = parser.parse_args()
+
+src_dir = tempfile.mkdtemp(dir=args.src_dir or None)
+dst_dir = tempfile.mkdtemp(dir=args.dst_dir or None)
+try:
+	sources = []
+	block = os.urandom(1024*1024)
+	for i in range(args.files):
+		path = os.path.join(src_dir, "%04d.filter-RNA.fastq.gz" % i)
+		with open(path, "wb") as f:
+			for mb in range(args.size_mb):
+				f.write(block)
+		sources.append(path)
+	total_mb = args.files * args.size_mb
+
+	variants = [("size only", size_only)]
+	for algorithm in args.algorithms:
+		variants.append(("naive "+algorithm, naive_checksum(algorithm)))
+		variants.append(("streaming "+algorithm, streaming_checksum(algorithm)))
+
+	print("files:               %d x %d MB" % (args.files, args.size_mb))
+	for name, check in variants:
+		read_before = bytes_read()
+		start = time.perf_counter()
+		for src in sources:
+			assert check(src, os.path.join(dst_dir, os.path.basename(src)))
+		seconds = time.perf_counter() - start
+		read_mb = (bytes_read() - read_before) / 1e6
+		print("%-20s %7.2f s  %8.1f MB/s  %8.0f MB read" % (name+":", seconds, total_mb / seconds, read_mb))
+finally:
+	shutil.rmtree(src_dir)
+	shutil.rmtree(dst_dir)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+#
+# Behavior checks of the Data Catalog registration against the fake Data Catalog. Run from the repository root:
+#   python benchmarks/check_catalog.py
+# Checks that BulkRegistrar posts whole batches, falls back to per-file posts (once) on a server without the
+# bulk endpoint and marks only requests that never reached the server for a retry, and that IngestPipeline
+# registers every file once, re-posting and re-placing only the files that failed. Exits with status 1 when
+# a check fails.
+
+import os, sys, socket
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fake_catalog import FakeDataCatalog
+from catalog import DataCatalogClient, BulkRegistrar
+from ingest import IngestPipeline
+
+failures = []
+
+def check(condition, message):
+	print(("ok      " if condition == True else "FAILED  ")+message)
+	if condition == False:
+		failures.append(message)
+
+def entries(count, prefix="file"):
+	return [("/raw/", "%s_%04d.fastq.gz" % (prefix, i)) for i in range(count)]
+
+def unused_port():
+	sock = socket.socket()
+	sock.bind(("127.0.0.1", 0))
+	port = sock.getsockname()[1]
+	sock.close()
+	return port
+
+#Bulk endpoint: one request per batch
+catalog = FakeDataCatalog(bulk=True).start()
+registrar = BulkRegistrar(DataCatalogClient(catalog.url, "fake-token", retries=0), batch_size=100)
+outcomes = registrar.register(entries(250), sample_barcode="S1")
+check(all(outcome[0] == True for outcome in outcomes), "bulk: all 250 files registered")
+check([outcome[1] for outcome in outcomes] == ["samples/S1/raw/file_%04d.fastq.gz" % i for i in range(250)], "bulk: outcomes in the order of the entries")
+check(catalog.requests["POST /api/v2/datafiles/bulk"] == 3, "bulk: 3 requests for 3 batches (%d)" % catalog.requests["POST /api/v2/datafiles/bulk"])
+check(catalog.requests["POST /api/v2/datafiles"] == 0, "bulk: no per-file posts")
+catalog.stop()
+
+#No bulk endpoint: the 404 switches to per-file posts for this and every later batch
+catalog = FakeDataCatalog(bulk=False).start()
+registrar = BulkRegistrar(DataCatalogClient(catalog.url, "fake-token", retries=0), batch_size=100, workers=4)
+outcomes = registrar.register(entries(150), experiment_id="E1")
+outcomes += registrar.register(entries(50, "more"), experiment_id="E1")
+check(all(outcome[0] == True for outcome in outcomes), "fallback: all 200 files registered")
+check(registrar.bulk_supported == False, "fallback: bulk endpoint noted as missing")
+check(catalog.requests["POST /api/v2/datafiles/bulk"] == 1, "fallback: bulk endpoint asked once (%d)" % catalog.requests["POST /api/v2/datafiles/bulk"])
+check(catalog.requests["POST /api/v2/datafiles"] == 200, "fallback: one post per file (%d)" % catalog.requests["POST /api/v2/datafiles"])
+check(len(set(catalog.files["experiments:E1"])) == 200, "fallback: no file registered twice")
+catalog.stop()
+
+#A server that cannot be reached: the files never got there and may be posted again
+registrar = BulkRegistrar(DataCatalogClient("http://127.0.0.1:%d" % unused_port(), "fake-token", retries=0, timeout=5), batch_size=10)
+outcomes = registrar.register(entries(10), sample_barcode="S1")
+check(all(outcome[0] == False and outcome[3] == True for outcome in outcomes), "unreachable: failed and marked for a retry")
+
+#IngestPipeline: every file is registered once, only failed posts marked retry and failed moves are redone
+catalog = FakeDataCatalog(bulk=True).start()
+registrar = BulkRegistrar(DataCatalogClient(catalog.url, "fake-token", retries=0), batch_size=20)
+post_calls = []
+place_calls = {}
+
+def post(items):
+	names = [item["local_file_path"] for item in items]
+	post_calls.append(names)
+	if len(post_calls) > 1:
+		return registrar.register([("/raw/", name) for name in names], sample_barcode="S2")
+	#The first batch: every fifth file never reaches the server, every seventh is registered but answered with an error
+	sent = [name for i, name in enumerate(names) if i % 5 != 0]
+	outcomes = dict(zip(sent, registrar.register([("/raw/", name) for name in sent], sample_barcode="S2")))
+	return [(False, "", "Connection refused", True) if i % 5 == 0 else (False, "", "Error posting file to Data Catalog.", False) if i % 7 == 0 else outcomes[name] for i, name in enumerate(names)]
+
+def place(item, target_path):
+	name = item["local_file_path"]
+	place_calls[name] = place_calls.get(name, 0) + 1
+	if name.endswith("3.fastq.gz") and place_calls[name] == 1:
+		return (False, "Short copy")
+	return (True, "")
+
+names = ["file_%04d.fastq.gz" % i for i in range(60)]
+first_batch = names[:20]
+pipeline = IngestPipeline(post, place, post_workers=1, move_workers=2, max_pending=64, retries=2, retry_delay=0, batch_size=20)
+results = {result["local_file_path"]: result for result in pipeline.run({"local_file_path": name, "action": "post"} for name in names)}
+not_trusted = [name for i, name in enumerate(first_batch) if i % 5 != 0 and i % 7 == 0]
+never_sent = [name for i, name in enumerate(first_batch) if i % 5 == 0]
+reposted = [name for call in post_calls[1:] for name in call if name in first_batch]
+check(sorted(reposted) == sorted(never_sent), "pipeline: only the posts that never reached the server are posted again")
+check(all(results[name]["posted"] == False and results[name]["moved"] == False and results[name]["error"] != "" for name in not_trusted), "pipeline: untrusted failed posts are left for the next cycle")
+check(all(results[name]["moved"] == True for name in names if name not in not_trusted), "pipeline: every other file moved")
+check(all(count == (2 if name.endswith("3.fastq.gz") else 1) for name, count in place_calls.items()), "pipeline: only failed moves placed again")
+check(all(name not in place_calls for name in not_trusted), "pipeline: files that failed to post are not placed")
+registered = catalog.files["samples:S2"]
+check(len(registered) == len(set(registered)) == 60, "pipeline: every file registered once (%d)" % len(registered))
+catalog.stop()
+
+if len(failures) > 0:
+	print("%d check(s) failed." % len(failures))
+	sys.exit(1)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+#
+# Behavior checks of the Globus Transfer API backend in globus_backend.py against the fake Globus service. Run
+# from the repository root:
+#   python benchmarks/check_globus.py
+# Checks that streamed listings are parsed the same wherever the chunks split them, and that GlobusTokenAuthorizer
+# renews access tokens before they expire and after a 401, and stops on an access token it cannot renew. Exits with
+# status 1 when a check fails.
+
+import os, sys, json, time, random, tempfile
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fake_globus import FakeGlobusTransfer
+from globus_backend import iter_json_array_items, get_transfer_backend, GlobusAuthError
+
+failures = []
+
+def check(condition, message):
+	print(("ok      " if condition == True else "FAILED  ")+message)
+	if condition == False:
+		failures.append(message)
+
+def split(text, sizes):
+	chunks = []
+	pos = 0
+	while pos < len(text):
+		size = next(sizes)
+		chunks.append(text[pos:pos+size])
+		pos += size
+	return chunks
+
+def parse(chunks):
+	try:
+		return list(iter_json_array_items(chunks))
+	except ValueError as e:
+		return e
+
+#Listings split at every possible chunk boundary
+items = [{"DATA_TYPE": "successful_transfer", "source_path": "/stage/a ]}, \"b\".fastq.gz", "destination_path": "/tmp/été/1.fastq.gz"}, {"nested": [[1, 2], {"x": []}], "n": -1.5e3}, "plain", 42, None, True, []]
+document = json.dumps({"DATA_TYPE": "successful_transfers_paging", "marker": "abc]", "DATA": items, "next_marker": None}, indent=1)
+check(parse([document]) == items, "listing in one chunk")
+check(all(parse(split(document, iter(lambda: size, None))) == items for size in range(1, 9)), "listing in chunks of 1 to 8 characters")
+randomizer = random.Random(1)
+check(all(parse(split(document, iter(lambda: randomizer.randint(1, 40), None))) == items for attempt in range(200)), "listing in 200 random chunkings")
+check(parse(split(json.dumps({"DATA": []}), iter(lambda: 1, None))) == [], "empty listing")
+check(isinstance(parse(split(document[:len(document)//2], iter(lambda: 7, None))), ValueError), "truncated listing raises ValueError")
+check(isinstance(parse([json.dumps({"code": "AuthenticationFailed", "message": "Token is not active"})]), ValueError), "error document raises ValueError")
+
+stage_root = tempfile.mkdtemp(prefix="jgi_check_globus_")
+
+#A refresh token is exchanged for an access token, and again after the service turns that one down
+globus = FakeGlobusTransfer(stage_root, token_lifetime=3600).start()
+backend = get_transfer_backend("api", base_url=globus.url, refresh_token="fake-refresh", client_id="fake-client", auth_url=globus.url+"/v2/oauth2/token")
+backend.task_list()
+check(globus.requests["POST /v2"] == 1, "refresh token exchanged once for an access token (%d)" % globus.requests["POST /v2"])
+backend.task_list()
+check(globus.requests["POST /v2"] == 1, "access token reused while valid")
+with globus.lock:
+	globus.access_tokens.clear()
+try:
+	backend.task_list()
+	renewed = True
+except GlobusAuthError:
+	renewed = False
+check(renewed == True and globus.requests["POST /v2"] == 2, "access token renewed after a 401")
+check(globus.requests["GET /task_list"] == 4, "only the rejected request sent again (%d)" % globus.requests["GET /task_list"])
+globus.stop()
+
+#Renewed ahead of expiry, without a 401
+globus = FakeGlobusTransfer(stage_root, token_lifetime=2).start()
+backend = get_transfer_backend("api", base_url=globus.url, client_id="fake-client", client_secret="fake-secret", auth_url=globus.url+"/v2/oauth2/token")
+backend.task_list()
+time.sleep(1.2)
+backend.task_list()
+check(globus.requests["POST /v2"] == 2 and globus.requests["GET /task_list"] == 2, "client credentials renewed before the token expires")
+
+#A bare access token cannot be renewed, a 401 stops the backend
+backend = get_transfer_backend("api", access_token="not-issued", base_url=globus.url)
+try:
+	backend.task_list()
+	stopped = False
+except GlobusAuthError:
+	stopped = True
+check(stopped == True and globus.requests["POST /v2"] == 2, "rejected access token without a refresh raises GlobusAuthError")
+globus.stop()
+os.rmdir(stage_root)
+
+if len(failures) > 0:
+	print("%d check(s) failed." % len(failures))
+	sys.exit(1)
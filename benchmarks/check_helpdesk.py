@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+#
+# Behavior checks of the helpdesk notifications in log.py against the fake SMTP server. Run from the repository root:
+#   python benchmarks/check_helpdesk.py
+# Checks that logging an alert never waits on a slow mail server, that repeated alerts go out once in a digest
+# with their count, that a fatal alert is sent right away, that one SMTP connection is reused between digests
+# and that digests beyond max_per_hour are held until exit. Exits with status 1 when a check fails.
+
+import os, sys, time
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fake_smtp import FakeSMTPServer
+from log import HelpdeskNotifier
+
+failures = []
+
+def check(condition, message):
+	print(("ok      " if condition == True else "FAILED  ")+message)
+	if condition == False:
+		failures.append(message)
+
+def wait_for_messages(sink, count, timeout=10):
+	#The notifier sends from its own thread, give it time to get count messages out
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		with sink.lock:
+			if len(sink.messages) >= count:
+				break
+		time.sleep(0.05)
+	with sink.lock:
+		return list(sink.messages)
+
+sink = FakeSMTPServer(latency=0.2).start()
+notifier = HelpdeskNotifier(smtp_host=sink.host, smtp_port=sink.port, source="jgi@example.org", target=["helpdesk@example.org"], subject="JGI transfers", digest_interval=60, max_per_hour=2, smtp_idle=60)
+
+#Repeated alerts are coalesced into one digest, sent on flush
+start = time.perf_counter()
+for i in range(5):
+	notifier.notify("1234 Error while posting files to the Data Catalog.", "error")
+notifier.notify("1235 Error while moving files.", "error")
+seconds = time.perf_counter() - start
+check(seconds < 0.1, "notify does not wait on SMTP (%.3f s for 6 alerts)" % seconds)
+time.sleep(0.5)
+check(len(wait_for_messages(sink, 1, timeout=0)) == 0, "no email before the digest is due")
+notifier.flush()
+messages = wait_for_messages(sink, 1)
+check(len(messages) == 1, "one digest for 6 alerts (%d)" % len(messages))
+if len(messages) > 0:
+	sender, recipients, data = messages[0]
+	check(recipients == ["helpdesk@example.org"] and "Subject: JGI transfers error" in data, "digest addressed to the helpdesk")
+	check("6 alert(s)" in data and data.count("Error while posting files") == 1 and "(x5)" in data, "identical alerts listed once with their count")
+	check("FD_ID 1234:" in data and "FD_ID 1235:" in data, "alerts grouped by FD_ID")
+
+#A fatal alert does not wait for the digest interval
+notifier.notify("Error while connecting to the Oracle database!", "fatal")
+messages = wait_for_messages(sink, 2, timeout=5)
+check(len(messages) == 2 and "Subject: JGI transfers fatal" in messages[-1][2], "fatal alert sent right away")
+check(sink.connections == 1, "one SMTP connection for both digests (%d)" % sink.connections)
+
+#max_per_hour is used up, the next digest is held back until exit
+notifier.notify("1236 Error while staging files.", "error")
+notifier.flush()
+time.sleep(1)
+check(len(wait_for_messages(sink, 3, timeout=0)) == 2, "digest beyond max_per_hour held back")
+notifier.close()
+messages = wait_for_messages(sink, 3, timeout=5)
+check(len(messages) == 3 and "1236 Error while staging files." in messages[-1][2], "held alerts sent at exit")
+sink.stop()
+
+if len(failures) > 0:
+	print("%d check(s) failed." % len(failures))
+	sys.exit(1)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+#
+# Local stand-in for the GLBRC ADFS token and signing key endpoints auth.py uses. Run standalone with:
+#   python benchmarks/fake_adfs.py --port 8084
+# and export DC_ADFS_URL=http://127.0.0.1:8084/adfs for the script. Any username, password and client
+# credentials are accepted. Needs the cryptography package (as PyJWT does for RS256).
+
+import time, uuid, json, threading, argparse, urllib.parse
+import jwt
+from collections import defaultdict
+from cryptography.hazmat.primitives.asymmetric import rsa
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class FakeADFS:
+	#Hands out RS256 id_tokens valid for token_lifetime seconds, with the client_id as audience, signed
+	#with a key generated at start and published as a JWKS
+	def __init__(self, host="127.0.0.1", port=0, token_lifetime=3600, latency=0.0):
+		self.token_lifetime = token_lifetime
+		self.latency = latency
+		self.kid = uuid.uuid4().hex
+		self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+		self.lock = threading.Lock()
+		self.requests = defaultdict(int)
+		self.server = ThreadingHTTPServer((host, port), self._handler())
+		self.server.daemon_threads = True
+		self.thread = None
+
+	@property
+	def url(self):
+		return "http://%s:%d/adfs" % self.server.server_address[:2]
+
+	def start(self):
+		self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	def jwks(self):
+		jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(self.private_key.public_key()))
+		jwk.update({"kid": self.kid, "use": "sig", "alg": "RS256"})
+		return {"keys": [jwk]}
+
+	def token(self, username, client_id):
+		now = int(time.time())
+		claims = {"aud": client_id, "iss": self.url, "iat": now, "nbf": now, "exp": now + self.token_lifetime, "upn": username, "unique_name": username}
+		id_token = jwt.encode(claims, self.private_key, algorithm="RS256", headers={"kid": self.kid})
+		if isinstance(id_token, bytes):
+			id_token = id_token.decode()
+		return {"access_token": id_token, "id_token": id_token, "token_type": "bearer", "expires_in": self.token_lifetime}
+
+	def _handler(self):
+		adfs = self
+
+		class Handler(BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"
+
+			def log_message(self, format, *args):
+				pass
+
+			def _reply(self, status, body):
+				data = json.dumps(body).encode()
+				self.send_response(status)
+				self.send_header("Content-Type", "application/json")
+				self.send_header("Content-Length", str(len(data)))
+				self.end_headers()
+				self.wfile.write(data)
+
+			def do_GET(self):
+				with adfs.lock:
+					adfs.requests["GET "+self.path] += 1
+				if self.path == "/adfs/discovery/keys":
+					return self._reply(200, adfs.jwks())
+				return self._reply(404, {"error": "not_found"})
+
+			def do_POST(self):
+				if adfs.latency > 0:
+					time.sleep(adfs.latency)
+				length = int(self.headers.get("Content-Length", 0))
+				form = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode() if length > 0 else ""))
+				with adfs.lock:
+					adfs.requests["POST "+self.path] += 1
+				if self.path == "/adfs/oauth2/token" and form.get("grant_type") == "password":
+					return self._reply(200, adfs.token(form.get("username", ""), form.get("client_id", "")))
+				return self._reply(400, {"error": "invalid_request"})
+
+		return Handler
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Run a fake ADFS token service")
+	parser.add_argument("--port", default=8084, type=int, help="")
+	parser.add_argument("--token_lifetime", default=3600, type=int, help="Seconds an id_token is valid")
+	args = parser.parse_args()
+	adfs = FakeADFS(port=args.port, token_lifetime=args.token_lifetime).start()
+	print("Fake ADFS listening on "+adfs.url)
+	try:
+		adfs.thread.join()
+	except KeyboardInterrupt:
+		adfs.stop()
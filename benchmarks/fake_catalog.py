@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+#
+# Local stand-in for the GLBRC Data Catalog API, for exercising the catalog clients without the real service.
+# Run standalone with: python benchmarks/fake_catalog.py --port 8081 [--no_bulk] [--latency 0.02]
+
+import json, time, threading, argparse, urllib.parse
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class FakeDataCatalog:
+	#Keeps registered datafiles in memory, per sample barcode or experiment id. bulk=False makes the
+	#bulk endpoint answer 404 like a server that does not have it. latency is added to every request.
+	def __init__(self, host="127.0.0.1", port=0, bulk=True, latency=0.0):
+		self.bulk = bulk
+		self.latency = latency
+		self.lock = threading.Lock()
+		self.files = defaultdict(list)
+		self.checksums = {}
+		self.requests = defaultdict(int)
+		self.server = ThreadingHTTPServer((host, port), self._handler())
+		self.server.daemon_threads = True
+		self.thread = None
+
+	@property
+	def url(self):
+		return "http://%s:%d" % self.server.server_address[:2]
+
+	def start(self):
+		self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	def add_existing(self, owner, subpaths):
+		with self.lock:
+			self.files[owner].extend(subpaths)
+
+	def _register(self, owner, custom_subpath, description):
+		subpath = (custom_subpath+description).lstrip("/")
+		with self.lock:
+			self.files[owner].append(subpath)
+		return {"message": "Successfully uploaded datafile", "path": owner.replace(":", "/")+"/"+subpath}
+
+	def _details(self, owner):
+		with self.lock:
+			subpaths = list(self.files[owner])
+		return {"files": {"subpaths": subpaths, "fullpaths": [owner.replace(":", "/")+"/"+sp for sp in subpaths]}}
+
+	def _handler(self):
+		catalog = self
+
+		class Handler(BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"
+
+			def log_message(self, format, *args):
+				pass
+
+			def _reply(self, status, body):
+				data = json.dumps(body).encode()
+				self.send_response(status)
+				self.send_header("Content-Type", "application/json")
+				self.send_header("Content-Length", str(len(data)))
+				self.end_headers()
+				self.wfile.write(data)
+
+			def _read(self):
+				length = int(self.headers.get("Content-Length", 0))
+				return self.rfile.read(length) if length > 0 else b""
+
+			def _route(self, method):
+				if catalog.latency > 0:
+					time.sleep(catalog.latency)
+				url = urllib.parse.urlsplit(self.path)
+				params = dict(urllib.parse.parse_qsl(url.query))
+				body = self._read()
+				with catalog.lock:
+					catalog.requests[method+" "+url.path] += 1
+				if "Authorization" not in self.headers:
+					return self._reply(401, {"errors": {"token": ["missing"]}})
+				if method == "GET" and url.path == "/api/v2/datafiles/sample_details":
+					return self._reply(200, catalog._details("samples:"+params.get("sample_barcode", "")))
+				if method == "GET" and url.path == "/api/v2/datafiles/experiment_details":
+					if "experiment_id" in params:
+						return self._reply(200, [catalog._details("experiments:"+params["experiment_id"])])
+					barcodes = json.loads(body or b"{}").get("sample_barcodes", "")
+					details = catalog._details("experiments:"+barcodes)
+					details["id"] = barcodes
+					return self._reply(200, details)
+				if method == "POST" and url.path == "/api/v2/datafiles":
+					owner = "samples:"+params["sample_barcode"] if "sample_barcode" in params else "experiments:"+params.get("experiment_id", "")
+					return self._reply(200, catalog._register(owner, params.get("custom_subpath", ""), params.get("description", "")))
+				if method == "POST" and url.path == "/api/v2/datafiles/bulk" and catalog.bulk == True:
+					request = json.loads(body)
+					owner = "samples:"+request["sample_barcode"] if "sample_barcode" in request else "experiments:"+str(request.get("experiment_id", ""))
+					return self._reply(200, {"files": [catalog._register(owner, f["custom_subpath"], f["description"]) for f in request["files"]]})
+				if method == "POST" and url.path == "/api/v2/datafiles/checksums":
+					request = json.loads(body)
+					with catalog.lock:
+						datafiles = set(owner.replace(":", "/")+"/"+sp for owner, subpaths in catalog.files.items() for sp in subpaths)
+						unknown = [f["path"] for f in request["files"] if f["path"] not in datafiles]
+						if len(unknown) > 0:
+							return self._reply(400, {"errors": {"path": ["not a datafile: "+path for path in unknown]}})
+						for f in request["files"]:
+							catalog.checksums[f["path"]] = request["algorithm"]+":"+f["checksum"]
+					return self._reply(200, {"updated": len(request["files"])})
+				return self._reply(404, {"errors": {"path": ["not found"]}})
+
+			def do_GET(self):
+				self._route("GET")
+
+			def do_POST(self):
+				self._route("POST")
+
+		return Handler
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Run a fake Data Catalog")
+	parser.add_argument("--port", default=8081, type=int, help="")
+	parser.add_argument("--no_bulk", default=False, action="store_true", help="Answer 404 on the bulk registration endpoint")
+	parser.add_argument("--latency", default=0.0, type=float, help="Seconds added to every request")
+	args = parser.parse_args()
+	catalog = FakeDataCatalog(port=args.port, bulk=(args.no_bulk == False), latency=args.latency).start()
+	print("Fake Data Catalog listening on "+catalog.url)
+	try:
+		catalog.thread.join()
+	except KeyboardInterrupt:
+		catalog.stop()
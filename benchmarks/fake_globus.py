@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+#
+# Local stand-in for Globus, for both transfer backends in globus_backend.py. Run standalone with:
+#   python benchmarks/fake_globus.py serve --port 8083 --stage_root /tmp/stage [--bandwidth 200]
+# and set globus_transfer_backend to "api" with globus_transfer_api_url http://127.0.0.1:8083 (any
+# GLOBUS_TRANSFER_TOKEN works), or keep the "cli" backend and point globus_bin at a script running
+#   python benchmarks/fake_globus.py cli --api_url http://127.0.0.1:8083 "$@"
+# which answers the globus CLI commands the script uses from the same fake service.
+#
+# Transfers really copy files: a source path on a stage endpoint is read from stage_root+path, destination
+# paths are local paths (like the GLBRC endpoint, which serves tmp_path as is).
+#
+# With --token_lifetime the service also plays Globus Auth at /v2/oauth2/token (set globus_auth_url to it,
+# with GLOBUS_CLIENT_ID and GLOBUS_TRANSFER_REFRESH_TOKEN or GLOBUS_CLIENT_SECRET set to anything) and
+# only accepts the access tokens it issued, for token_lifetime seconds each.
+
+import os, sys, json, time, uuid, shutil, getpass, datetime, threading, argparse, urllib.parse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def now_iso():
+	return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S+00:00")
+
+class FakeGlobusTransfer:
+	#The Transfer API subset the script calls. Submitted tasks are run by a pool of concurrency workers,
+	#each copy limited to bandwidth MB/s (0 for no limit) and taking at least task_delay seconds. Successful
+	#transfer listings are paged page_size records at a time, like the real API.
+	def __init__(self, stage_root, host="127.0.0.1", port=0, bandwidth=0.0, task_delay=0.0, concurrency=4, page_size=1000, latency=0.0, token_lifetime=0):
+		self.stage_root = stage_root
+		self.token_lifetime = token_lifetime
+		self.access_tokens = {}
+		self.bandwidth = bandwidth
+		self.task_delay = task_delay
+		self.page_size = page_size
+		self.latency = latency
+		self.lock = threading.Lock()
+		self.tasks = {}
+		self.transfers = defaultdict(list)
+		self.requests = defaultdict(int)
+		self.executor = ThreadPoolExecutor(max_workers=concurrency)
+		self.server = ThreadingHTTPServer((host, port), self._handler())
+		self.server.daemon_threads = True
+		self.thread = None
+
+	@property
+	def url(self):
+		return "http://%s:%d" % self.server.server_address[:2]
+
+	def start(self):
+		self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+		self.executor.shutdown(wait=False)
+
+	def issue_token(self, form):
+		if form.get("grant_type") not in ("refresh_token", "client_credentials"):
+			return None
+		access_token = "fake-transfer-"+uuid.uuid4().hex
+		with self.lock:
+			self.access_tokens[access_token] = time.time() + self.token_lifetime
+		return {"access_token": access_token, "expires_in": self.token_lifetime, "resource_server": "transfer.api.globus.org", "token_type": "Bearer", "scope": "urn:globus:auth:scope:transfer.api.globus.org:all", "other_tokens": []}
+
+	def authorized(self, header):
+		if header.startswith("Bearer ") == False:
+			return False
+		if self.token_lifetime <= 0 or header == "Bearer fake-cli-token":
+			#The CLI keeps its own login, which is not what the token lifetime is about
+			return True
+		with self.lock:
+			return self.access_tokens.get(header[len("Bearer "):], 0) > time.time()
+
+	def _local_source(self, path):
+		return os.path.join(self.stage_root, path.lstrip("/"))
+
+	def _copy(self, src, dst):
+		start = time.time()
+		shutil.copyfile(src, dst)
+		size = os.stat(dst).st_size
+		if self.bandwidth > 0:
+			time.sleep(max(0, size / (self.bandwidth * 1e6) - (time.time() - start)))
+		return size
+
+	def _run_task(self, task_id, items):
+		started = time.time()
+		status = "SUCCEEDED"
+		try:
+			for item in items:
+				src = self._local_source(item["source_path"])
+				pairs = [(src, item["source_path"], item["destination_path"])]
+				if item.get("recursive") == True:
+					pairs = []
+					for dirpath, dirnames, filenames in os.walk(src):
+						for filename in sorted(filenames):
+							relative = os.path.relpath(os.path.join(dirpath, filename), src)
+							pairs.append((os.path.join(dirpath, filename), os.path.join(item["source_path"], relative), os.path.join(item["destination_path"], relative)))
+				for local_src, source_path, destination_path in pairs:
+					os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+					size = self._copy(local_src, destination_path)
+					with self.lock:
+						self.transfers[task_id].append({"DATA_TYPE": "successful_transfer", "source_path": source_path, "destination_path": destination_path})
+						self.tasks[task_id]["files_transferred"] += 1
+						self.tasks[task_id]["bytes_transferred"] += size
+		except OSError as e:
+			status = "FAILED"
+			with self.lock:
+				self.tasks[task_id]["nice_status_details"] = str(e)
+		time.sleep(max(0, self.task_delay - (time.time() - started)))
+		with self.lock:
+			self.tasks[task_id]["status"] = status
+			self.tasks[task_id]["completion_time"] = now_iso()
+
+	def submit(self, transfer_doc):
+		task_id = str(uuid.uuid4())
+		task = {"DATA_TYPE": "task", "task_id": task_id, "type": "TRANSFER", "status": "ACTIVE", "label": transfer_doc.get("label", ""), "source_endpoint_id": transfer_doc["source_endpoint"], "destination_endpoint_id": transfer_doc["destination_endpoint"], "request_time": now_iso(), "completion_time": None, "deadline": transfer_doc.get("deadline"), "files": len(transfer_doc["DATA"]), "files_transferred": 0, "bytes_transferred": 0, "history_deleted": False, "nice_status_details": None}
+		with self.lock:
+			self.tasks[task_id] = task
+		self.executor.submit(self._run_task, task_id, transfer_doc["DATA"])
+		return {"DATA_TYPE": "transfer_result", "code": "Accepted", "message": "The transfer has been accepted and a task has been created and queued for execution", "task_id": task_id, "submission_id": transfer_doc.get("submission_id", "")}
+
+	def ls(self, path):
+		#One directory of a stage endpoint, as GET /operation/endpoint/{endpoint}/ls lists it
+		local_path = self._local_source(path)
+		if os.path.isdir(local_path) == False:
+			return None
+		entries = []
+		for entry in sorted(os.scandir(local_path), key=lambda entry: entry.name):
+			entries.append({"DATA_TYPE": "file", "name": entry.name, "type": "dir" if entry.is_dir() else "file", "size": entry.stat().st_size})
+		return {"DATA_TYPE": "file_list", "path": path, "endpoint": "", "DATA": entries, "length": len(entries), "total": len(entries)}
+
+	def task_list(self, filter_value, limit):
+		name, _, value = filter_value.partition(":")
+		with self.lock:
+			tasks = list(self.tasks.values())
+			if name == "status":
+				tasks = [dict(task) for task in tasks if task["status"] in value.split(",")]
+			elif name == "task_id":
+				tasks = [dict(self.tasks[task_id]) for task_id in value.split(",") if task_id in self.tasks]
+			else:
+				tasks = [dict(task) for task in tasks]
+		return {"DATA_TYPE": "task_list", "DATA": tasks[:limit], "length": min(len(tasks), limit), "limit": limit, "offset": 0, "total": len(tasks)}
+
+	def successful_transfers(self, task_id, marker):
+		with self.lock:
+			transfers = list(self.transfers.get(task_id, []))
+		start = int(marker or 0)
+		page = {"DATA_TYPE": "successful_transfers", "DATA": transfers[start:start+self.page_size], "marker": marker, "next_marker": None}
+		if start + self.page_size < len(transfers):
+			page["next_marker"] = str(start + self.page_size)
+		return page
+
+	def _handler(self):
+		globus = self
+
+		class Handler(BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"
+
+			def log_message(self, format, *args):
+				pass
+
+			def _reply(self, status, body):
+				data = json.dumps(body).encode()
+				self.send_response(status)
+				self.send_header("Content-Type", "application/json")
+				self.send_header("Content-Length", str(len(data)))
+				self.end_headers()
+				self.wfile.write(data)
+
+			def _read(self):
+				length = int(self.headers.get("Content-Length", 0))
+				data = self.rfile.read(length).decode() if length > 0 else ""
+				if self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+					return dict(urllib.parse.parse_qsl(data))
+				return json.loads(data) if data != "" else {}
+
+			def _route(self, method):
+				if globus.latency > 0:
+					time.sleep(globus.latency)
+				url = urllib.parse.urlsplit(self.path)
+				params = dict(urllib.parse.parse_qsl(url.query))
+				body = self._read()
+				parts = url.path.strip("/").split("/")
+				with globus.lock:
+					globus.requests[method+" /"+parts[0]] += 1
+				if method == "POST" and parts == ["v2", "oauth2", "token"] and globus.token_lifetime > 0:
+					token_json = globus.issue_token(body)
+					if token_json == None:
+						return self._reply(400, {"error": "unsupported_grant_type"})
+					return self._reply(200, token_json)
+				if globus.authorized(self.headers.get("Authorization", "")) == False:
+					return self._reply(401, {"code": "AuthenticationFailed", "message": "Token is not active"})
+				if method == "GET" and parts == ["tasksummary"]:
+					return self._reply(200, {"DATA_TYPE": "tasksummary", "active": len(globus.task_list("status:ACTIVE", 1000)["DATA"])})
+				if method == "GET" and parts == ["task_list"]:
+					if params.get("filter", "").startswith("task_id:") and len(params["filter"].split(",")) > 50:
+						return self._reply(400, {"code": "ClientError.BadRequest", "message": "task_id filter takes at most 50 ids"})
+					return self._reply(200, globus.task_list(params.get("filter", ""), int(params.get("limit", 10))))
+				if method == "GET" and parts == ["submission_id"]:
+					return self._reply(200, {"DATA_TYPE": "submission_id", "value": str(uuid.uuid4())})
+				if method == "POST" and parts == ["transfer"]:
+					return self._reply(202, globus.submit(body))
+				if method == "GET" and len(parts) == 3 and parts[0] == "endpoint" and parts[2] == "activation_requirements":
+					return self._reply(200, {"DATA_TYPE": "activation_requirements", "activated": True, "expires_in": -1, "auto_activation_supported": True, "DATA": [{"DATA_TYPE": "activation_requirement", "type": "myproxy", "name": "username", "value": None}, {"DATA_TYPE": "activation_requirement", "type": "myproxy", "name": "passphrase", "value": None}]})
+				if method == "POST" and len(parts) == 3 and parts[0] == "endpoint" and parts[2] == "activate":
+					return self._reply(200, {"DATA_TYPE": "activation_result", "code": "Activated.MyProxyCredential", "message": "Endpoint activated successfully", "expires_in": 168*3600})
+				if method == "GET" and len(parts) == 4 and parts[0] == "operation" and parts[1] == "endpoint" and parts[3] == "ls":
+					listing = globus.ls(params.get("path", "/"))
+					if listing == None:
+						return self._reply(404, {"code": "ClientError.NotFound", "message": "Directory "+params.get("path", "/")+" not found"})
+					return self._reply(200, listing)
+				if method == "GET" and len(parts) == 2 and parts[0] == "task":
+					with globus.lock:
+						task = globus.tasks.get(parts[1])
+					if task == None:
+						return self._reply(404, {"code": "TaskNotFound", "message": "Task "+parts[1]+" not found"})
+					return self._reply(200, dict(task))
+				if method == "GET" and len(parts) == 3 and parts[0] == "task" and parts[2] == "successful_transfers":
+					return self._reply(200, globus.successful_transfers(parts[1], params.get("marker")))
+				return self._reply(404, {"code": "ClientError.NotFound", "message": "Not found"})
+
+			def do_GET(self):
+				self._route("GET")
+
+			def do_POST(self):
+				self._route("POST")
+
+		return Handler
+
+def cli(api_url, argv):
+	#The globus CLI commands GlobusCLIBackend runs, answered from a FakeGlobusTransfer. Output is printed
+	#as the real CLI prints it with --format json.
+	import requests
+	session = requests.Session()
+	session.headers.update({"Authorization": "Bearer fake-cli-token"})
+	def call(method, path, **kwargs):
+		return session.request(method, api_url.rstrip("/")+path, **kwargs).json()
+	def option(name, default=None):
+		return argv[argv.index(name)+1] if name in argv else default
+	positional = []
+	skip = False
+	for i, arg in enumerate(argv):
+		if skip == True:
+			skip = False
+		elif arg in ("--format", "--limit", "--filter-status", "--filter-task-id", "--deadline", "--label", "--notify", "--batch", "--myproxy-lifetime"):
+			skip = True
+		elif arg.startswith("--") == False:
+			positional.append(arg)
+	command = positional[:2]
+	if command[:1] == ["whoami"]:
+		print("fake-user@globusid.org")
+	elif command == ["endpoint", "is-activated"]:
+		print(json.dumps(call("GET", "/endpoint/"+positional[2]+"/activation_requirements"), indent=2))
+	elif command == ["endpoint", "activate"]:
+		requirements = call("GET", "/endpoint/"+positional[2]+"/activation_requirements")
+		values = {"username": input("Myproxy username: "), "passphrase": getpass.getpass("Myproxy password: "), "lifetime_in_hours": option("--myproxy-lifetime", "168")}
+		for requirement in requirements["DATA"]:
+			requirement["value"] = values.get(requirement["name"])
+		print(json.dumps(call("POST", "/endpoint/"+positional[2]+"/activate", json=requirements), indent=2))
+	elif command[:1] == ["transfer"]:
+		items = []
+		if option("--batch") != None:
+			import shlex
+			with open(option("--batch")) as bf:
+				for line in bf:
+					words = shlex.split(line)
+					if len(words) >= 2:
+						items.append({"DATA_TYPE": "transfer_item", "source_path": words[-2], "destination_path": words[-1], "recursive": "--recursive" in words})
+			source_endpoint, destination_endpoint = positional[1], positional[2]
+		else:
+			source_endpoint, source_path = positional[1].split(":", 1)
+			destination_endpoint, destination_path = positional[2].split(":", 1)
+			items.append({"DATA_TYPE": "transfer_item", "source_path": source_path, "destination_path": destination_path, "recursive": "--recursive" in argv})
+		transfer_doc = {"DATA_TYPE": "transfer", "submission_id": call("GET", "/submission_id")["value"], "source_endpoint": source_endpoint, "destination_endpoint": destination_endpoint, "label": option("--label", ""), "deadline": option("--deadline"), "DATA": items}
+		print(json.dumps(call("POST", "/transfer", json=transfer_doc), indent=2))
+	elif command[:1] == ["ls"]:
+		#--recursive lists the whole tree with names relative to the listed path
+		endpoint, path = positional[1].split(":", 1)
+		entries = []
+		directories = [""]
+		while len(directories) > 0:
+			directory = directories.pop(0)
+			listing = call("GET", "/operation/endpoint/"+endpoint+"/ls", params={"path": os.path.join(path, directory)})
+			if "DATA" not in listing:
+				print(json.dumps(listing, indent=2), file=sys.stderr)
+				return 1
+			for entry in listing["DATA"]:
+				entry = dict(entry, name=os.path.join(directory, entry["name"]))
+				entries.append(entry)
+				if entry["type"] == "dir" and "--recursive" in argv:
+					directories.append(entry["name"])
+		print(json.dumps({"DATA_TYPE": "file_list", "DATA": entries}, indent=2))
+	elif command == ["task", "list"]:
+		task_ids = [argv[i+1] for i, arg in enumerate(argv) if arg == "--filter-task-id"]
+		filter_value = "task_id:"+",".join(task_ids) if len(task_ids) > 0 else "status:"+option("--filter-status", "ACTIVE")
+		print(json.dumps(call("GET", "/task_list", params={"filter": filter_value, "limit": option("--limit", "10")}), indent=2))
+	elif command == ["task", "show"] and "--successful-transfers" in argv:
+		#Printed page by page like the real CLI streams it, as one document
+		transfers = []
+		params = {}
+		while True:
+			page = call("GET", "/task/"+positional[2]+"/successful_transfers", params=params)
+			transfers.extend(page["DATA"])
+			if page.get("next_marker") in (None, ""):
+				break
+			params = {"marker": page["next_marker"]}
+		print(json.dumps({"DATA_TYPE": "successful_transfers", "DATA": transfers}, indent=2))
+	elif command == ["task", "show"]:
+		print(json.dumps(call("GET", "/task/"+positional[2]), indent=2))
+	else:
+		print("Unknown command: "+" ".join(argv), file=sys.stderr)
+		return 2
+	return 0
+
+if __name__ == "__main__":
+	if len(sys.argv) >= 2 and sys.argv[1] == "cli":
+		cli_parser = argparse.ArgumentParser(description="Answer globus CLI commands from a fake Globus service")
+		cli_parser.add_argument("--api_url", default=os.environ.get("FAKE_GLOBUS_API_URL", "http://127.0.0.1:8083"), help="")
+		cli_args, globus_argv = cli_parser.parse_known_args(sys.argv[2:])
+		sys.exit(cli(cli_args.api_url, globus_argv))
+	parser = argparse.ArgumentParser(description="Run a fake Globus Transfer API")
+	parser.add_argument("command", choices=["serve"], help="")
+	parser.add_argument("--port", default=8083, type=int, help="")
+	parser.add_argument("--stage_root", required=True, help="Local directory the stage endpoint paths are read from")
+	parser.add_argument("--bandwidth", default=0.0, type=float, help="MB/s per copied file, 0 for no limit")
+	parser.add_argument("--task_delay", default=0.0, type=float, help="Minimum seconds a task takes")
+	parser.add_argument("--concurrency", default=4, type=int, help="Tasks run at the same time")
+	parser.add_argument("--latency", default=0.0, type=float, help="Seconds added to every request")
+	parser.add_argument("--token_lifetime", default=0, type=int, help="Seconds an issued access token is valid, 0 to accept any bearer token")
+	args = parser.parse_args()
+	globus = FakeGlobusTransfer(args.stage_root, port=args.port, bandwidth=args.bandwidth, task_delay=args.task_delay, concurrency=args.concurrency, latency=args.latency, token_lifetime=args.token_lifetime).start()
+	print("Fake Globus Transfer API listening on "+globus.url)
+	try:
+		globus.thread.join()
+	except KeyboardInterrupt:
+		globus.stop()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+#
+# Local stand-in for the JGI sign-on and Genome Portal endpoints stage() and xfer() use. Run standalone with:
+#   python benchmarks/fake_jgi.py --port 8082 [--stage_delay 30] [--latency 0.1]
+# and set jgi_portal_url to http://127.0.0.1:8082/portal and jgi_signon_url to
+# http://127.0.0.1:8082/signon/create in the config.
+
+import time, uuid, threading, argparse, urllib.parse
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def portal_id(fd_id):
+	return "FakeJGI_"+str(fd_id)
+
+def stage_path(fd_id):
+	#Globus path of a staged deliverable on the stage endpoint, its 4th component is what xfer() names
+	#the download directory after
+	return "/jgi/stage/"+portal_id(fd_id)+"/"
+
+class FakeJGIPortal:
+	#Every staging request completes stage_delay seconds after it was made, until then its status page
+	#says it is being processed. Deliverables in no_data complete without data, the ones in failing fail.
+	#Staged data is announced on stage_endpoint under stage_path(fd_id), putting the files there (in the
+	#fake Globus, see fake_globus.py) is up to the caller. latency is added to every request.
+	def __init__(self, host="127.0.0.1", port=0, stage_endpoint="fake-jgi-stage", stage_delay=0.0, latency=0.0, no_data=(), failing=()):
+		self.stage_endpoint = stage_endpoint
+		self.stage_delay = stage_delay
+		self.latency = latency
+		self.no_data = set(str(fd_id) for fd_id in no_data)
+		self.failing = set(str(fd_id) for fd_id in failing)
+		self.lock = threading.Lock()
+		self.stage_requests = {}
+		self.requests = defaultdict(int)
+		self.server = ThreadingHTTPServer((host, port), self._handler())
+		self.server.daemon_threads = True
+		self.thread = None
+
+	@property
+	def url(self):
+		return "http://%s:%d" % self.server.server_address[:2]
+
+	@property
+	def portal_url(self):
+		return self.url+"/portal"
+
+	@property
+	def signon_url(self):
+		return self.url+"/signon/create"
+
+	def start(self):
+		self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	def _status_page(self, request_id):
+		with self.lock:
+			request = self.stage_requests.get(request_id)
+		if request == None:
+			return "Download request not found."
+		fd_id, requested_at = request
+		if time.time() - requested_at < self.stage_delay:
+			return "Download request is being processed."
+		if fd_id in self.failing:
+			return "Download request failed. Staging error on the fake portal."
+		if fd_id in self.no_data:
+			return "Download request completed. No data are available for download."
+		globus_url = "https://app.globus.org/file-manager?"+urllib.parse.urlencode({"origin_id": self.stage_endpoint, "origin_path": stage_path(fd_id)})
+		return "Download request completed. Your data is available from Globus at "+globus_url
+
+	def _handler(self):
+		portal = self
+
+		class Handler(BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"
+
+			def log_message(self, format, *args):
+				pass
+
+			def _reply(self, status, text, cookie=""):
+				data = text.encode()
+				self.send_response(status)
+				self.send_header("Content-Type", "text/plain")
+				self.send_header("Content-Length", str(len(data)))
+				if cookie != "":
+					self.send_header("Set-Cookie", cookie)
+				self.end_headers()
+				self.wfile.write(data)
+
+			def _read(self):
+				length = int(self.headers.get("Content-Length", 0))
+				return self.rfile.read(length).decode() if length > 0 else ""
+
+			def _route(self, method):
+				if portal.latency > 0:
+					time.sleep(portal.latency)
+				url = urllib.parse.urlsplit(self.path)
+				params = dict(urllib.parse.parse_qsl(url.query))
+				params.update(urllib.parse.parse_qsl(self._read()))
+				with portal.lock:
+					portal.requests[method+" "+url.path] += 1
+				if method == "POST" and url.path == "/signon/create":
+					return self._reply(200, "Signed on", cookie="jgi_session="+uuid.uuid4().hex+"; Path=/")
+				if "jgi_session" not in self.headers.get("Cookie", ""):
+					return self._reply(401, "Not signed on")
+				if method == "GET" and url.path == "/portal/ext-api/genome-admin/getPortalIdByParameter":
+					return self._reply(200, portal_id(params.get("parameterValue", "")))
+				if method == "POST" and url.path == "/portal/ext-api/downloads/globus/request":
+					fd_id = params.get("portal", "").replace(portal_id(""), "", 1)
+					request_id = uuid.uuid4().hex
+					with portal.lock:
+						portal.stage_requests[request_id] = (fd_id, time.time())
+					return self._reply(200, portal.portal_url+"/ext-api/downloads/globus/status/"+request_id)
+				if method == "GET" and url.path.startswith("/portal/ext-api/downloads/globus/status/"):
+					return self._reply(200, portal._status_page(url.path.rsplit("/", 1)[1]))
+				return self._reply(404, "Not found")
+
+			def do_GET(self):
+				self._route("GET")
+
+			def do_POST(self):
+				self._route("POST")
+
+		return Handler
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Run a fake JGI Genome Portal")
+	parser.add_argument("--port", default=8082, type=int, help="")
+	parser.add_argument("--stage_endpoint", default="fake-jgi-stage", help="Globus endpoint the staged data is announced on")
+	parser.add_argument("--stage_delay", default=0.0, type=float, help="Seconds a staging request takes")
+	parser.add_argument("--latency", default=0.0, type=float, help="Seconds added to every request")
+	args = parser.parse_args()
+	portal = FakeJGIPortal(port=args.port, stage_endpoint=args.stage_endpoint, stage_delay=args.stage_delay, latency=args.latency).start()
+	print("Fake JGI portal listening on "+portal.url)
+	try:
+		portal.thread.join()
+	except KeyboardInterrupt:
+		portal.stop()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+#
+# Local SMTP sink standing in for the helpdesk mail server, for exercising the notifications in log.py
+# without sending real email. Run standalone with: python benchmarks/fake_smtp.py --port 8025 [--latency 0.5]
+# and point helpdesk_smtp_host/helpdesk_smtp_port in the config at it.
+
+import time, threading, argparse, socketserver
+
+class FakeSMTPServer:
+	#Accepts every message and keeps it in memory as (sender, recipients, data). latency is added to
+	#every command reply, to see what a slow mail server would cost.
+	def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+		self.latency = latency
+		self.lock = threading.Lock()
+		self.messages = []
+		self.connections = 0
+		self.server = socketserver.ThreadingTCPServer((host, port), self._handler())
+		self.server.daemon_threads = True
+		self.thread = None
+
+	@property
+	def host(self):
+		return self.server.server_address[0]
+
+	@property
+	def port(self):
+		return self.server.server_address[1]
+
+	def start(self):
+		self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	def _handler(self):
+		sink = self
+
+		class Handler(socketserver.StreamRequestHandler):
+			def _reply(self, line):
+				if sink.latency > 0:
+					time.sleep(sink.latency)
+				self.wfile.write((line+"\r\n").encode())
+
+			def handle(self):
+				with sink.lock:
+					sink.connections += 1
+				self._reply("220 fake-smtp ready")
+				sender = ""
+				recipients = []
+				while True:
+					line = self.rfile.readline()
+					if not line:
+						return
+					command = line.decode("utf-8", "replace").strip()
+					verb = command.split(" ", 1)[0].upper()
+					if verb == "EHLO":
+						self._reply("250 fake-smtp")
+					elif verb == "HELO":
+						self._reply("250 fake-smtp")
+					elif verb == "MAIL":
+						sender = command.split(":", 1)[1].strip().strip("<>")
+						recipients = []
+						self._reply("250 OK")
+					elif verb == "RCPT":
+						recipients.append(command.split(":", 1)[1].strip().strip("<>"))
+						self._reply("250 OK")
+					elif verb == "DATA":
+						self._reply("354 End data with <CR><LF>.<CR><LF>")
+						data = []
+						while True:
+							data_line = self.rfile.readline()
+							if not data_line or data_line in (b".\r\n", b".\n"):
+								break
+							data.append(data_line.decode("utf-8", "replace"))
+						with sink.lock:
+							sink.messages.append((sender, recipients, "".join(data)))
+						self._reply("250 OK")
+					elif verb in ("RSET", "NOOP"):
+						self._reply("250 OK")
+					elif verb == "QUIT":
+						self._reply("221 Bye")
+						return
+					else:
+						self._reply("502 Command not implemented")
+
+		return Handler
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Run a fake SMTP server that prints what it receives")
+	parser.add_argument("--port", default=8025, type=int, help="")
+	parser.add_argument("--latency", default=0.0, type=float, help="Seconds added to every reply")
+	args = parser.parse_args()
+	sink = FakeSMTPServer(port=args.port, latency=args.latency).start()
+	print("Fake SMTP server listening on %s:%d" % (sink.host, sink.port))
+	seen = 0
+	try:
+		while True:
+			time.sleep(1)
+			with sink.lock:
+				new_messages = sink.messages[seen:]
+				seen = len(sink.messages)
+			for sender, recipients, data in new_messages:
+				print("From "+sender+" to "+", ".join(recipients)+"\n"+data)
+	except KeyboardInterrupt:
+		sink.stop()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+#
+# SQLite stand-in for the parts of cx_Oracle that db.py uses, for the offline benchmarks only. It is picked
+# up instead of the real module by putting benchmarks/fakes first on PYTHONPATH (bench_end_to_end.py does).
+# The SQLite database file is the SERVICE_NAME of the DSN, so data_transfer_scripts_DB_SERVICE_NAME is
+# the path of the file. :1, :2 ... binds are rewritten to SQLite's ?1, ?2 ... and FOR UPDATE SKIP LOCKED is
+# dropped, SQLite locks the whole database for a write anyway.
+
+import re, sqlite3, threading
+
+SPOOL_ATTRVAL_NOWAIT = 0
+SPOOL_ATTRVAL_WAIT = 1
+SPOOL_ATTRVAL_TIMEDWAIT = 3
+
+bind_regex = re.compile(r":(\d+)")
+skip_locked_regex = re.compile(r"\s+FOR UPDATE SKIP LOCKED\s*$", re.IGNORECASE)
+service_name_regex = re.compile(r"SERVICE_NAME=([^)]+)\)")
+
+class _Error:
+	def __init__(self, message, code=0):
+		self.message = message
+		self.code = code
+
+	def __str__(self):
+		return self.message
+
+class Error(Exception):
+	pass
+
+class DatabaseError(Error):
+	pass
+
+def _sql(sql):
+	return bind_regex.sub(r"?\1", skip_locked_regex.sub("", sql))
+
+def _database_error(e):
+	return DatabaseError(_Error("ORA-00000: "+str(e)))
+
+def schema(path):
+	#The tables and columns the script reads and writes, as SQLite sees them
+	con = sqlite3.connect(path)
+	con.executescript("""
+		CREATE TABLE IF NOT EXISTS sync_requests (fd_id TEXT PRIMARY KEY, status TEXT, num_samples INTEGER, portal_id TEXT, jgi_stage_url TEXT, globus_stage_url TEXT, globus_stage_endpoint TEXT, globus_stage_path TEXT, globus_transfer_task_id TEXT, globus_transfer_task_label TEXT, sync_timestamp TEXT, updated_at TEXT, lease_owner TEXT, lease_until INTEGER);
+		CREATE INDEX IF NOT EXISTS sync_requests_status ON sync_requests (status);
+		CREATE TABLE IF NOT EXISTS final_deliverables (id INTEGER PRIMARY KEY, fd_id TEXT);
+		CREATE TABLE IF NOT EXISTS samples (id INTEGER PRIMARY KEY, sample_id TEXT, final_deliverable_id INTEGER);
+	""")
+	con.execute("PRAGMA journal_mode=WAL")
+	con.commit()
+	con.close()
+
+class Cursor:
+	def __init__(self, connection):
+		self.connection = connection
+		self.arraysize = 100
+		self._cursor = connection._con.cursor()
+
+	def execute(self, sql, params=()):
+		try:
+			self._cursor.execute(_sql(sql), tuple(params))
+		except sqlite3.Error as e:
+			raise _database_error(e)
+
+	def executemany(self, sql, rows):
+		try:
+			self._cursor.executemany(_sql(sql), [tuple(row) for row in rows])
+		except sqlite3.Error as e:
+			raise _database_error(e)
+
+	def fetchall(self):
+		return self._cursor.fetchall()
+
+	def fetchmany(self, size):
+		return self._cursor.fetchmany(size)
+
+class Connection:
+	def __init__(self, path):
+		self._con = sqlite3.connect(path, timeout=30, check_same_thread=False)
+
+	def cursor(self):
+		return Cursor(self)
+
+	def commit(self):
+		try:
+			self._con.commit()
+		except sqlite3.Error as e:
+			raise _database_error(e)
+
+	def rollback(self):
+		self._con.rollback()
+
+	def close(self):
+		self._con.close()
+
+class SessionPool:
+	def __init__(self, user="", password="", dsn="", min=1, max=4, increment=1, threaded=False, getmode=SPOOL_ATTRVAL_NOWAIT, wait_timeout=0, stmtcachesize=20, ping_interval=60):
+		match = service_name_regex.search(dsn)
+		self.path = match.group(1) if match != None else dsn
+		self.max = max
+		self.lock = threading.Lock()
+		self.idle = []
+		self.busy = 0
+		try:
+			for i in range(min):
+				self.idle.append(Connection(self.path))
+		except sqlite3.Error as e:
+			raise _database_error(e)
+
+	def acquire(self):
+		with self.lock:
+			self.busy += 1
+			if len(self.idle) > 0:
+				return self.idle.pop()
+		return Connection(self.path)
+
+	def release(self, connection):
+		with self.lock:
+			self.busy -= 1
+			if len(self.idle) < self.max:
+				self.idle.append(connection)
+				return
+		connection.close()
+
+	def drop(self, connection):
+		with self.lock:
+			self.busy -= 1
+		connection.close()
+
+	def close(self):
+		with self.lock:
+			for connection in self.idle:
+				connection.close()
+			self.idle = []
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import sys, json, urllib3, requests
+from concurrent.futures import ThreadPoolExecutor
+from urllib3.util.retry import Retry
+
+def index_existing_files(subpaths, fullpaths):
+	#Map each sanitized subpath already in the Data Catalog to its fullpath. Built once per FD_ID from the
+	#sample/experiment details response, so checking a transferred file is a dict lookup instead of a
+	#scan over every existing file. The first occurrence wins, same as the linear scan it replaces.
+	existing_files_index = {}
+	for subpath, fullpath in zip(subpaths, fullpaths):
+		existing_files_index.setdefault(subpath, fullpath)
+	return existing_files_index
+
+def never_sent(error):
+	#Whether a failed request is known not to have reached the server: no connection could be opened
+	if isinstance(error, requests.exceptions.ConnectTimeout) == True:
+		return True
+	if isinstance(error, requests.exceptions.ConnectionError) == False or len(error.args) == 0:
+		return False
+	return isinstance(getattr(error.args[0], "reason", error.args[0]), (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError))
+
+class CatalogRetry(Retry):
+	#GETs are retried with backoff on connection errors, read timeouts, 429 and server errors. A POST that
+	#reached the Data Catalog may have registered its files whatever came back, so it is only sent again when
+	#it never got there (connection errors) or when the server turned it away with a Retry-After (429/503).
+	def is_retry(self, method, status_code, has_retry_after=False):
+		if method.upper() != "GET":
+			return bool(self.total) and status_code in (429, 503) and has_retry_after == True
+		return super().is_retry(method, status_code, has_retry_after)
+
+class DataCatalogClient:
+	#Every Data Catalog call goes through this one requests.Session, so connections are kept alive and
+	#reused. The session carries the token header, a default timeout and retry with exponential backoff.
+	def __init__(self, base_dc_url, token, pool_maxsize=16, timeout=120, retries=5, backoff_factor=0.5, debug=False):
+		self.base_dc_url = base_dc_url
+		self.timeout = timeout
+		self.debug = debug
+		self.session = requests.Session()
+		retry = CatalogRetry(total=retries, backoff_factor=backoff_factor, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=frozenset(["GET"]), respect_retry_after_header=True, raise_on_status=False)
+		adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry)
+		self.session.mount("https://", adapter)
+		self.session.mount("http://", adapter)
+		self.session.verify = False
+		self.set_token(token)
+
+	def set_token(self, token):
+		self.session.headers.update({"Authorization": "Token " + token})
+
+	def request(self, method, path, **kwargs):
+		kwargs.setdefault("timeout", self.timeout)
+		return self.session.request(method, self.base_dc_url+path, **kwargs)
+
+	def _debug_print(self, response):
+		if self.debug == True:
+			print("\nENCODING")
+			print(response.encoding)
+			print("\nCONTENT")
+			print(response.content)
+			print("\nREQUEST HEADERS")
+			print(response.request.headers)
+			print("\nHEADERS")
+			print(response.headers)
+			print("\nTEXT")
+			print(response.text)
+			print("\nSTATUS")
+			print(response.status_code)
+			print("\nURL")
+			print(response.url)
+			sys.stdout.flush()
+
+	def get_sample_details(self, sample_barcode):
+		response = self.request("GET", "/api/v2/datafiles/sample_details", params={"sample_barcode": sample_barcode})
+		self._debug_print(response)
+		return response
+
+	def get_experiment_details(self, sample_barcodes, experiment_id):
+		if sample_barcodes == []:
+			response = self.request("GET", "/api/v2/datafiles/experiment_details", params={"experiment_id": experiment_id})
+		else:
+			response = self.request("GET", "/api/v2/datafiles/experiment_details", data=json.dumps({"sample_barcodes": ",".join(sample_barcodes)}), headers={"Content-Type": "application/json"})
+		self._debug_print(response)
+		return response
+
+class BulkRegistrar:
+	#Registers the datafiles of a deliverable with the Data Catalog. Entries are (custom_subpath, description)
+	#pairs and go out batch_size at a time in one bulk request. If the server turns out not to have the bulk
+	#endpoint, every later batch is posted file by file instead, pipelined over a keep-alive connection pool.
+	#register() returns one (ok, path, message, retry) per entry, in order. retry is only set for failures that
+	#never reached the server, the others may have registered the file and must not be posted again.
+	def __init__(self, client, batch_size=100, workers=4, bulk_path="/api/v2/datafiles/bulk"):
+		self.client = client
+		self.batch_size = max(1, batch_size)
+		self.workers = max(1, workers)
+		self.bulk_path = bulk_path
+		self.bulk_supported = None
+
+	def _owner_params(self, sample_barcode, experiment_id):
+		if experiment_id == "":
+			return {"sample_barcode": sample_barcode}
+		return {"experiment_id": experiment_id}
+
+	def _outcome(self, file_json, description):
+		if file_json.get("message") == "Successfully uploaded datafile":
+			return (True, file_json["path"], "", False)
+		return (False, "", "Data Catalog did not register "+description+". "+json.dumps(file_json), False)
+
+	def _register_bulk(self, entries, sample_barcode, experiment_id):
+		body = self._owner_params(sample_barcode, experiment_id)
+		body["files"] = [{"custom_subpath": custom_subpath, "description": description} for custom_subpath, description in entries]
+		response = self.client.request("POST", self.bulk_path, json=body)
+		self.client._debug_print(response)
+		if response.status_code in (404, 405, 501):
+			self.bulk_supported = False
+			return None
+		if response.status_code != 200:
+			return [(False, "", "Error posting files to Data Catalog.\n"+response.text, False)] * len(entries)
+		self.bulk_supported = True
+		files_json = response.json().get("files", [])
+		if len(files_json) != len(entries):
+			return [(False, "", "Data Catalog bulk response does not match the request.\n"+response.text, False)] * len(entries)
+		return [self._outcome(file_json, description) for file_json, (custom_subpath, description) in zip(files_json, entries)]
+
+	def _register_one(self, entry, sample_barcode, experiment_id):
+		custom_subpath, description = entry
+		params = self._owner_params(sample_barcode, experiment_id)
+		params["description"] = description
+		params["custom_subpath"] = custom_subpath
+		#The Data Catalog only needs a named multipart part, the actual data is moved into MinIO storage
+		#separately, so an empty in-memory payload is enough
+		try:
+			response = self.client.request("POST", "/api/v2/datafiles", files={"file": (description, b"")}, params=params)
+		except requests.exceptions.RequestException as e:
+			return (False, "", "Error posting file to Data Catalog. "+custom_subpath+description+"\n"+str(e), never_sent(e))
+		self.client._debug_print(response)
+		if response.status_code != 200:
+			return (False, "", "Error posting file to Data Catalog. "+custom_subpath+description+"\n"+response.text, False)
+		return self._outcome(response.json(), description)
+
+	def register(self, entries, sample_barcode="", experiment_id=""):
+		outcomes = []
+		for batch_start in range(0, len(entries), self.batch_size):
+			batch = entries[batch_start:batch_start+self.batch_size]
+			batch_outcomes = None
+			if self.bulk_supported != False:
+				try:
+					batch_outcomes = self._register_bulk(batch, sample_barcode, experiment_id)
+				except requests.exceptions.RequestException as e:
+					batch_outcomes = [(False, "", "Error posting files to Data Catalog.\n"+str(e), never_sent(e))] * len(batch)
+			if batch_outcomes == None:
+				with ThreadPoolExecutor(max_workers=self.workers) as executor:
+					batch_outcomes = list(executor.map(lambda entry: self._register_one(entry, sample_barcode, experiment_id), batch))
+			outcomes.extend(batch_outcomes)
+		return outcomes
+
+class ChecksumRecorder:
+	#Stores the checksums computed while placing files with their Data Catalog datafiles, one request per
+	#deliverable. A server without the checksum endpoint (404/405/501) is noted once and not asked again.
+	#record() returns (ok, message).
+	def __init__(self, client, path="/api/v2/datafiles/checksums"):
+		self.client = client
+		self.path = path
+		self.supported = None
+
+	def record(self, checksums, algorithm):
+		#checksums are (datafile path, hex digest) pairs
+		if self.supported == False or len(checksums) == 0:
+			return (True, "")
+		body = {"algorithm": algorithm, "files": [{"path": path, "checksum": checksum} for path, checksum in checksums]}
+		try:
+			response = self.client.request("POST", self.path, json=body)
+		except requests.exceptions.RequestException as e:
+			return (False, "Error recording checksums with Data Catalog.\n"+str(e))
+		self.client._debug_print(response)
+		if response.status_code in (404, 405, 501):
+			self.supported = False
+			return (False, "Data Catalog has no checksum endpoint ("+self.path+"), checksums are only kept in the ingest ledger.")
+		if response.status_code != 200:
+			return (False, "Error recording checksums with Data Catalog.\n"+response.text)
+		self.supported = True
+		return (True, "")
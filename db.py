@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+import time, threading, contextlib, cx_Oracle
+from collections import OrderedDict, defaultdict
+from log import time_now, print_to_log
+
+#ORA- errors that mean the session is gone (connection lost, instance down, failover in progress). Sessions
+#that fail with one of these are dropped from the pool instead of being handed out again.
+lost_session_codes = (28, 1012, 1033, 1034, 1089, 3113, 3114, 3135, 12153, 12514, 12528, 12537, 12541, 12571, 25408)
+
+def create_pool(user, password, dsn, min_sessions=1, max_sessions=4, increment=1, stmtcachesize=50, ping_interval=60, wait_timeout=30000):
+	#Sessions are pinged by the pool when they were idle for ping_interval seconds before being handed out.
+	#Acquiring waits up to wait_timeout ms for a free session once max_sessions are busy.
+	return cx_Oracle.SessionPool(user=user, password=password, dsn=dsn, min=min_sessions, max=max_sessions, increment=increment, threaded=True, getmode=cx_Oracle.SPOOL_ATTRVAL_TIMEDWAIT, wait_timeout=wait_timeout, stmtcachesize=stmtcachesize, ping_interval=ping_interval)
+
+def is_lost_session(error):
+	return getattr(error.args[0], "code", 0) in lost_session_codes
+
+class SyncRequests:
+	#The sync_requests queue: updates are queued and written at checkpoints, rows are leased to worker_id with lease_seconds > 0
+	#Leasing needs the lease_owner and lease_until columns, see CONFIG.md
+	def __init__(self, pool, checkpoint_interval=30, arraysize=500, worker_id="", lease_seconds=0, lease_batch_size=0):
+		self.pool = pool
+		self.lock = threading.RLock()
+		self.pending = OrderedDict()
+		self.checkpoint_interval = checkpoint_interval
+		self.arraysize = arraysize
+		self.last_flush = time.time()
+		self.listeners = defaultdict(list)
+		self.worker_id = worker_id
+		self.lease_seconds = lease_seconds
+		self.lease_batch_size = lease_batch_size
+		self.heartbeat = None
+
+	@contextlib.contextmanager
+	def cursor(self):
+		con = self.pool.acquire()
+		try:
+			cur = con.cursor()
+			cur.arraysize = self.arraysize
+			yield cur
+		except cx_Oracle.DatabaseError as e:
+			if is_lost_session(e):
+				self.pool.drop(con)
+				con = None
+			raise
+		finally:
+			if con != None:
+				self.pool.release(con)
+
+	def _run(self, work):
+		try:
+			with self.cursor() as cur:
+				return work(cur)
+		except cx_Oracle.DatabaseError as e:
+			if is_lost_session(e) == False:
+				raise
+			print_to_log("Lost an Oracle session ("+str(e).strip()+"), retrying on a new one.", "warn")
+		with self.cursor() as cur:
+			return work(cur)
+
+	def _select(self, sql, params):
+		def work(cur):
+			cur.execute(sql, params)
+			return cur.fetchall()
+		return self._run(work)
+
+	def on_transition(self, status, callback):
+		#callback(fd_id) runs for every transition into status once it is committed
+		with self.lock:
+			self.listeners[status].append(callback)
+
+	def count(self, statuses):
+		#{status: number of requests} for the given statuses
+		counts = dict((status, 0) for status in statuses)
+		rows = self._select("SELECT status, COUNT(*) FROM sync_requests WHERE status IN ("+", ".join(":"+str(i+1) for i in range(len(statuses)))+") GROUP BY status", list(statuses))
+		for row in rows:
+			counts[row[0]] = int(row[1])
+		return counts
+
+	def fetch(self, status, columns):
+		#[{column: value}] for every request currently in the given status
+		rows = self._select("SELECT "+", ".join(columns)+" FROM sync_requests WHERE status = :1", (status,))
+		return [dict(zip(columns, row)) for row in rows]
+
+	def claim(self, status, columns):
+		#Like fetch(), but only the requests no other worker holds a live lease on, each of them now leased
+		#to this worker for lease_seconds. The candidates are locked while they are leased, so workers
+		#claiming at the same moment skip each other's rows instead of waiting for them, and the lease
+		#UPDATE is guarded by the same conditions for databases without SKIP LOCKED.
+		if self.lease_seconds <= 0:
+			return self.fetch(status, columns)
+		self._start_heartbeat()
+		now = int(time.time())
+		lease_until = now + int(self.lease_seconds)
+		def work(cur):
+			try:
+				#With SKIP LOCKED the rows are locked as they are fetched, and every round trip fetches
+				#prefetchrows (on execute) or arraysize rows. Both are cut to the batch, otherwise the rows
+				#beyond it stay locked until the commit and the other workers skip them.
+				if self.lease_batch_size > 0:
+					cur.prefetchrows = self.lease_batch_size
+					cur.arraysize = self.lease_batch_size
+				cur.execute("SELECT fd_id FROM sync_requests WHERE status = :1 AND (lease_until IS NULL OR lease_until < :2 OR lease_owner = :3) FOR UPDATE SKIP LOCKED", (status, now, self.worker_id))
+				if self.lease_batch_size > 0:
+					fd_ids = [row[0] for row in cur.fetchmany(self.lease_batch_size)]
+				else:
+					fd_ids = [row[0] for row in cur.fetchall()]
+				rows = []
+				if len(fd_ids) > 0:
+					cur.executemany("UPDATE sync_requests SET lease_owner = :1, lease_until = :2 WHERE fd_id = :3 AND status = :4 AND (lease_until IS NULL OR lease_until < :5 OR lease_owner = :6)", [(self.worker_id, lease_until, fd_id, status, now, self.worker_id) for fd_id in fd_ids])
+					#Read back in the same transaction, before the heartbeat can move lease_until on
+					cur.execute("SELECT "+", ".join(columns)+" FROM sync_requests WHERE status = :1 AND lease_owner = :2 AND lease_until = :3", (status, self.worker_id, lease_until))
+					rows = cur.fetchall()
+				cur.connection.commit()
+				return rows
+			except cx_Oracle.DatabaseError:
+				try:
+					cur.connection.rollback()
+				except cx_Oracle.DatabaseError:
+					pass
+				raise
+		return [dict(zip(columns, row)) for row in self._run(work)]
+
+	def _execute(self, sql, params):
+		def work(cur):
+			cur.execute(sql, params)
+			cur.connection.commit()
+		self._run(work)
+
+	def renew(self):
+		#Pushes lease_until of everything this worker holds lease_seconds into the future
+		self._execute("UPDATE sync_requests SET lease_until = :1 WHERE lease_owner = :2", (int(time.time()) + int(self.lease_seconds), self.worker_id))
+
+	def release(self, status=None):
+		#Hands back the leases this worker holds (on requests in status, or all of them), after the queued
+		#updates are written so no other worker picks a request up before its transition
+		if self.lease_seconds <= 0:
+			return
+		self.flush()
+		if status == None:
+			self._execute("UPDATE sync_requests SET lease_owner = NULL, lease_until = NULL WHERE lease_owner = :1", (self.worker_id,))
+		else:
+			self._execute("UPDATE sync_requests SET lease_owner = NULL, lease_until = NULL WHERE lease_owner = :1 AND status = :2", (self.worker_id, status))
+
+	def _start_heartbeat(self):
+		with self.lock:
+			if self.heartbeat == None:
+				self.heartbeat = threading.Thread(target=self._renew_leases, name="lease-heartbeat", daemon=True)
+				self.heartbeat.start()
+
+	def _renew_leases(self):
+		while True:
+			time.sleep(max(1, self.lease_seconds / 3))
+			try:
+				self.renew()
+			except cx_Oracle.DatabaseError as e:
+				print_to_log("Could not renew the sync_requests leases of "+self.worker_id+": "+str(e).strip(), "warn")
+
+	def sample_ids(self, fd_ids):
+		#{fd_id: [sample_id]} for a set of deliverables, one query per 1000 FD_IDs (the Oracle IN list limit)
+		sample_ids = dict((str(fd_id), []) for fd_id in fd_ids)
+		fd_ids = list(sample_ids.keys())
+		for start in range(0, len(fd_ids), 1000):
+			chunk = fd_ids[start:start+1000]
+			rows = self._select("SELECT fd.fd_id, s.sample_id FROM final_deliverables fd, samples s WHERE s.final_deliverable_id = fd.id AND fd.fd_id IN ("+", ".join(":"+str(i+1) for i in range(len(chunk)))+")", chunk)
+			for row in rows:
+				sample_ids[str(row[0])].append(str(row[1]))
+		return sample_ids
+
+	def update(self, fd_id, status_old, **columns):
+		#Sets columns without changing the status of the request
+		self._queue(columns, fd_id, status_old)
+
+	def transition(self, fd_id, status_old, status, **columns):
+		#A request changing status is free for whichever worker claims the new status first
+		if self.lease_seconds > 0:
+			columns = OrderedDict(list(columns.items()) + [("lease_owner", None), ("lease_until", None)])
+		self._queue(OrderedDict([("status", status), ("sync_timestamp", time_now()), ("updated_at", time_now())] + list(columns.items())), fd_id, status_old)
+
+	def _queue(self, columns, fd_id, status_old):
+		names = tuple(columns.keys())
+		sql = "UPDATE sync_requests SET "+", ".join(name+" = :"+str(i+1) for i, name in enumerate(names))+" WHERE fd_id = :"+str(len(names)+1)+" AND status = :"+str(len(names)+2)
+		with self.lock:
+			self.pending.setdefault((names, sql), []).append(tuple(columns.values())+(fd_id, status_old))
+			if time.time() - self.last_flush >= self.checkpoint_interval:
+				self.flush()
+
+	def flush(self):
+		#Column updates go before status transitions, both are guarded by the old status and a request
+		#can have one of each queued (e.g. its portal_id and then its move to Staging)
+		with self.lock:
+			self.last_flush = time.time()
+			if len(self.pending) == 0:
+				return 0
+			statements = sorted(self.pending.items(), key=lambda statement: "status" in statement[0][0])
+			self.pending = OrderedDict()
+			def work(cur):
+				try:
+					for (names, sql), rows in statements:
+						cur.executemany(sql, rows)
+					cur.connection.commit()
+				except cx_Oracle.DatabaseError:
+					try:
+						cur.connection.rollback()
+					except cx_Oracle.DatabaseError:
+						pass
+					raise
+			self._run(work)
+			for (names, sql), rows in statements:
+				if names[0] == "status":
+					for row in rows:
+						for callback in self.listeners.get(row[0], []):
+							callback(row[len(names)])
+			return sum(len(rows) for statement, rows in statements)
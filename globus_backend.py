@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+
+import os, re, json, time, shlex, tempfile, threading, pexpect, requests
+
+#Globus operations used by jgi_transfer_tasks.py. Both backends return the same JSON documents the
+#Globus CLI prints with "--format json", so the callers do not care which one is in use.
+
+def iter_json_array_items(chunks, key="DATA"):
+	#Incrementally yields the elements of the top-level array under key from a JSON document that arrives
+	#in text chunks, so a listing of any size is never held in memory as a whole
+	decoder = json.JSONDecoder()
+	array_start = re.compile(r'"'+re.escape(key)+r'"\s*:\s*\[')
+	buffer = ""
+	pos = -1
+	chunks = iter(chunks)
+	exhausted = False
+	while True:
+		if pos < 0:
+			match = array_start.search(buffer)
+			if match != None:
+				pos = match.end()
+		else:
+			while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+				pos += 1
+			if pos < len(buffer) and buffer[pos] == "]":
+				return
+			if pos < len(buffer):
+				try:
+					item, end = decoder.raw_decode(buffer, pos)
+				except ValueError:
+					end = -1
+				#A number at the end of the buffer may go on in the next chunk
+				if end >= 0 and (end < len(buffer) or exhausted == True):
+					yield item
+					buffer = buffer[end:]
+					pos = 0
+					continue
+		if exhausted == True:
+			if pos < 0:
+				raise ValueError("No \""+key+"\" array in the JSON listing: "+buffer[:200])
+			raise ValueError("Truncated JSON listing, the \""+key+"\" array is not closed.")
+		try:
+			buffer += next(chunks)
+		except StopIteration:
+			exhausted = True
+
+class GlobusCLIBackend:
+	#Spawns the Globus CLI for every operation. Kept as the fallback when no transfer API token is available.
+	def __init__(self, globus_bin, debug=False):
+		self.globus_bin = globus_bin
+		self.debug = debug
+
+	def _run(self, params):
+		child = pexpect.spawn(self.globus_bin, params, encoding='utf-8')
+		child_out = child.read()
+		if self.debug == True:
+			print(child_out)
+		return child_out
+
+	def _run_json(self, params):
+		return json.loads(self._run(params).replace("Exit: \r\n",""))
+
+	def task_list(self, filter_status="ACTIVE", limit=100):
+		task_list = self._run_json(["task","list","--format","json","--limit",str(limit),"--filter-status",filter_status])
+		if "DATA" not in task_list:
+			raise ValueError("No task listing from the Globus CLI. "+json.dumps(task_list)[:200])
+		return task_list
+
+	def whoami(self):
+		login_status = self._run(["whoami"])
+		return "Please try logging in again" not in login_status
+
+	def endpoint_is_activated(self, endpoint):
+		return self._run_json(["endpoint","is-activated","--format","json",endpoint])
+
+	def endpoint_activate_myproxy(self, endpoint, myproxy_u, myproxy_pw, lifetime=168):
+		#Use pexpect because it allows passing silent passwords
+		child = pexpect.spawn(self.globus_bin, ["endpoint","activate","--format","json","--myproxy",endpoint,"--myproxy-lifetime",str(lifetime)], encoding='utf-8')
+		child.expect("Myproxy username:")
+		child.sendline(myproxy_u+"\n")
+		child.expect("Myproxy password:")
+		child.sendline(myproxy_pw+"\n")
+		child_out = child.read()
+		return json.loads(child_out.replace("Exit: \r\n",""))
+
+	def submit_transfer(self, source_endpoint, source_path, destination_endpoint, destination_path, label, deadline, recursive=True):
+		transfer_params = ["transfer","--preserve-mtime","--deadline",deadline,"--format","json",source_endpoint+":"+source_path,destination_endpoint+":"+destination_path,"--label",label,"--notify","off"]
+		if recursive == True:
+			transfer_params.append("--recursive")
+		return self._run_json(transfer_params)
+
+	def submit_batch_transfer(self, source_endpoint, destination_endpoint, items, label, deadline):
+		#items is a list of (source_path, destination_path, recursive), handed to the CLI as a --batch file
+		with tempfile.NamedTemporaryFile(mode="w", prefix="jgi_transfer_batch_", suffix=".txt", delete=False) as bf:
+			for source_path, destination_path, recursive in items:
+				line = shlex.quote(source_path)+" "+shlex.quote(destination_path)
+				if recursive == True:
+					line = "--recursive "+line
+				bf.write(line+"\n")
+		try:
+			return self._run_json(["transfer","--preserve-mtime","--deadline",deadline,"--format","json","--batch",bf.name,source_endpoint,destination_endpoint,"--label",label,"--notify","off"])
+		finally:
+			os.remove(bf.name)
+
+	def path_size(self, endpoint, path):
+		#Total bytes of the files under path on endpoint, None if it cannot be listed
+		try:
+			listing = self._run_json(["ls","--recursive","--format","json",endpoint+":"+path])
+		except ValueError:
+			return None
+		if "DATA" not in listing:
+			return None
+		return sum(int(entry.get("size") or 0) for entry in listing["DATA"] if entry.get("type") == "file")
+
+	def task_statuses(self, task_ids, chunk_size=50):
+		#Status of many tasks from a few "task list" calls instead of one "task show" per task. The task_id
+		#filter takes at most 50 ids.
+		tasks = {}
+		for chunk_start in range(0, len(task_ids), chunk_size):
+			params = ["task","list","--format","json","--limit","1000"]
+			for task_id in task_ids[chunk_start:chunk_start+chunk_size]:
+				params += ["--filter-task-id", task_id]
+			page = self._run_json(params)
+			if "DATA" not in page:
+				raise ValueError("No task listing from the Globus CLI. "+json.dumps(page)[:200])
+			for task in page["DATA"]:
+				tasks[task["task_id"]] = task
+		return tasks
+
+	def iter_successful_transfers(self, task_id, chunk_size=65536):
+		#Parses the CLI output as it is printed, the first records are handed out before the listing is done
+		child = pexpect.spawn(self.globus_bin, ["task","show","--format","json","--successful-transfers",task_id], encoding='utf-8')
+		def chunks():
+			while True:
+				try:
+					yield child.read_nonblocking(size=chunk_size, timeout=None)
+				except pexpect.EOF:
+					return
+		try:
+			for item in iter_json_array_items(chunks()):
+				yield item
+		finally:
+			child.close()
+
+class GlobusAuthError(Exception):
+	#The Transfer API turned the credentials down and no new access token could be had. Deliberately not a
+	#ValueError, which callers take for a broken listing and retry on the next cycle.
+	pass
+
+class GlobusTokenAuthorizer:
+	#Access tokens for the Transfer API. With a refresh token (from a native app login, with its client_id)
+	#or a confidential client (client_id and client_secret) a new access token is fetched from Globus Auth
+	#refresh_margin seconds before the current one expires, and whenever the API answers 401. A bare
+	#access_token cannot be renewed, it is used until Globus turns it down (after about 48 hours).
+	def __init__(self, access_token="", refresh_token="", client_id="", client_secret="", auth_url="https://auth.globus.org/v2/oauth2/token", scope="urn:globus:auth:scope:transfer.api.globus.org:all", refresh_margin=300, timeout=30):
+		self.access_token = access_token
+		self.refresh_token = refresh_token
+		self.client_id = client_id
+		self.client_secret = client_secret
+		self.auth_url = auth_url
+		self.scope = scope
+		self.refresh_margin = refresh_margin
+		self.timeout = timeout
+		self.refresh_at = float("inf") if access_token != "" else 0
+		self.lock = threading.Lock()
+
+	def can_refresh(self):
+		return self.client_id != "" and (self.refresh_token != "" or self.client_secret != "")
+
+	def token(self):
+		with self.lock:
+			if self.can_refresh() == True and time.time() > self.refresh_at:
+				self._refresh()
+			return self.access_token
+
+	def refresh(self, rejected_token):
+		#After a 401, unless another thread has already replaced the rejected token
+		with self.lock:
+			if self.access_token == rejected_token:
+				self._refresh()
+			return self.access_token
+
+	def _refresh(self):
+		auth = None
+		if self.refresh_token != "":
+			data = {"grant_type": "refresh_token", "refresh_token": self.refresh_token}
+			if self.client_secret != "":
+				auth = (self.client_id, self.client_secret)
+			else:
+				data["client_id"] = self.client_id
+		else:
+			data = {"grant_type": "client_credentials", "scope": self.scope}
+			auth = (self.client_id, self.client_secret)
+		try:
+			response = requests.post(self.auth_url, data=data, auth=auth, timeout=self.timeout)
+		except requests.exceptions.RequestException as e:
+			raise GlobusAuthError("Could not reach Globus Auth for a new transfer access token. "+str(e))
+		if response.status_code != 200:
+			raise GlobusAuthError("Globus Auth refused a new transfer access token ("+str(response.status_code)+"). "+response.text)
+		token_json = response.json()
+		#The tokens for other resource servers come in other_tokens, the transfer one may be either
+		for candidate in [token_json] + token_json.get("other_tokens", []):
+			if candidate.get("resource_server") == "transfer.api.globus.org":
+				token_json = candidate
+				break
+		self.access_token = token_json["access_token"]
+		self.refresh_token = token_json.get("refresh_token") or self.refresh_token
+		expires_in = int(token_json.get("expires_in", 172800))
+		self.refresh_at = time.time() + max(expires_in - self.refresh_margin, expires_in / 2)
+
+class GlobusAPIBackend:
+	#Talks to the Globus Transfer REST API in-process over one pooled, keep-alive session, with the access
+	#tokens of a GlobusTokenAuthorizer. base_url can point at a local stub server.
+	def __init__(self, authorizer, base_url="https://transfer.api.globus.org/v0.10", timeout=60, debug=False):
+		self.authorizer = authorizer
+		self.base_url = base_url.rstrip("/")
+		self.timeout = timeout
+		self.debug = debug
+		self.session = requests.Session()
+		self.session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=8))
+		self.session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=8))
+		self.session.headers.update({"Accept": "application/json"})
+
+	def _request(self, method, path, **kwargs):
+		token = self.authorizer.token()
+		response = self.session.request(method, self.base_url+path, timeout=self.timeout, headers={"Authorization": "Bearer "+token}, **kwargs)
+		if response.status_code == 401 and self.authorizer.can_refresh() == True:
+			#Expired or revoked ahead of time, one more try with a new token
+			token = self.authorizer.refresh(token)
+			response = self.session.request(method, self.base_url+path, timeout=self.timeout, headers={"Authorization": "Bearer "+token}, **kwargs)
+		if self.debug == True:
+			print(response.text)
+		return response
+
+	def _json(self, method, path, **kwargs):
+		#Globus returns a JSON error document ({"code": ..., "message": ...}) on failures,
+		#which callers check the same way they check the CLI output. Rejected credentials are not
+		#left to the callers, nothing can get through until new ones are provided.
+		response = self._request(method, path, **kwargs)
+		if response.status_code == 401:
+			raise GlobusAuthError("The Globus Transfer API rejected the access token. "+response.text)
+		return response.json()
+
+	def _listing(self, method, path, **kwargs):
+		#Listings are read by the callers as they are, an error document would pass for an empty listing.
+		#Raises ValueError instead, like a listing the CLI could not print.
+		response = self._request(method, path, **kwargs)
+		if response.status_code == 401:
+			raise GlobusAuthError("The Globus Transfer API rejected the access token. "+response.text)
+		if response.status_code < 200 or response.status_code >= 300:
+			raise ValueError("Globus Transfer API "+method+" "+path+" returned "+str(response.status_code)+". "+response.text[:200])
+		listing = response.json()
+		if "code" in listing or "DATA" not in listing:
+			raise ValueError("Globus Transfer API "+method+" "+path+" returned no listing. "+response.text[:200])
+		return listing
+
+	def task_list(self, filter_status="ACTIVE", limit=100):
+		return self._listing("GET", "/task_list", params={"filter": "status:"+filter_status, "limit": limit})
+
+	def whoami(self):
+		#The transfer token is the only credential this backend holds, so a cheap authenticated call
+		#stands in for "globus whoami".
+		return self._request("GET", "/tasksummary").status_code != 401
+
+	def endpoint_is_activated(self, endpoint):
+		return self._json("GET", "/endpoint/"+endpoint+"/activation_requirements")
+
+	def endpoint_activate_myproxy(self, endpoint, myproxy_u, myproxy_pw, lifetime=168):
+		requirements = self.endpoint_is_activated(endpoint)
+		values = {"username": myproxy_u, "passphrase": myproxy_pw, "lifetime_in_hours": str(lifetime)}
+		requirements["DATA"] = [r for r in requirements.get("DATA", []) if r.get("type") == "myproxy"]
+		for r in requirements["DATA"]:
+			if r.get("name") in values:
+				r["value"] = values[r["name"]]
+		return self._json("POST", "/endpoint/"+endpoint+"/activate", json=requirements)
+
+	def submit_transfer(self, source_endpoint, source_path, destination_endpoint, destination_path, label, deadline, recursive=True):
+		return self.submit_batch_transfer(source_endpoint, destination_endpoint, [(source_path, destination_path, recursive)], label, deadline)
+
+	def submit_batch_transfer(self, source_endpoint, destination_endpoint, items, label, deadline):
+		submission_id = self._json("GET", "/submission_id")["value"]
+		transfer_doc = {
+			"DATA_TYPE": "transfer",
+			"submission_id": submission_id,
+			"source_endpoint": source_endpoint,
+			"destination_endpoint": destination_endpoint,
+			"label": label,
+			"deadline": deadline,
+			"preserve_timestamp": True,
+			"notify_on_succeeded": False,
+			"notify_on_failed": False,
+			"notify_on_inactive": False,
+			"DATA": [{"DATA_TYPE": "transfer_item", "source_path": source_path, "destination_path": destination_path, "recursive": recursive} for source_path, destination_path, recursive in items],
+		}
+		return self._json("POST", "/transfer", json=transfer_doc)
+
+	def path_size(self, endpoint, path):
+		#Total bytes of the files under path on endpoint, None if it cannot be listed. The API lists one
+		#directory per call, subdirectories are walked here.
+		total = 0
+		directories = [path]
+		while len(directories) > 0:
+			directory = directories.pop()
+			try:
+				listing = self._listing("GET", "/operation/endpoint/"+endpoint+"/ls", params={"path": directory})
+			except ValueError:
+				return None
+			for entry in listing["DATA"]:
+				if entry.get("type") == "dir":
+					directories.append(directory.rstrip("/")+"/"+entry["name"]+"/")
+				elif entry.get("type") == "file":
+					total += int(entry.get("size") or 0)
+		return total
+
+	def task_statuses(self, task_ids, chunk_size=50):
+		tasks = {}
+		for chunk_start in range(0, len(task_ids), chunk_size):
+			page = self._listing("GET", "/task_list", params={"filter": "task_id:"+",".join(task_ids[chunk_start:chunk_start+chunk_size]), "limit": 1000})
+			for task in page["DATA"]:
+				tasks[task["task_id"]] = task
+		return tasks
+
+	def iter_successful_transfers(self, task_id):
+		#One page at a time, the next page is only requested once the previous one has been consumed
+		params = {}
+		while True:
+			page = self._listing("GET", "/task/"+task_id+"/successful_transfers", params=params)
+			for item in page["DATA"]:
+				yield item
+			if page.get("next_marker") in (None, ""):
+				break
+			params = {"marker": page["next_marker"]}
+
+class GlobusSession:
+	#Per-process cache of the Globus login check and of endpoint activations, keyed by endpoint.
+	#An activation is trusted until refresh_margin seconds before it expires, and is re-checked
+	#early if a transfer submission comes back with an activation error.
+	def __init__(self, backend, myproxy_u="", myproxy_pw="", myproxy_lifetime=168, login_ttl=3600, refresh_margin=3600):
+		self.backend = backend
+		self.myproxy_u = myproxy_u
+		self.myproxy_pw = myproxy_pw
+		self.myproxy_lifetime = myproxy_lifetime
+		self.login_ttl = login_ttl
+		self.refresh_margin = refresh_margin
+		self.logged_in_until = 0
+		self.activated_until = {}
+
+	def ensure_logged_in(self):
+		if time.time() < self.logged_in_until:
+			return True
+		if self.backend.whoami() == False:
+			self.logged_in_until = 0
+			return False
+		self.logged_in_until = time.time() + self.login_ttl
+		return True
+
+	def _remember(self, endpoint, activation_json):
+		expires_in = int(activation_json.get("expires_in", self.myproxy_lifetime * 3600))
+		if expires_in < 0:
+			#-1 means the activation never expires
+			self.activated_until[endpoint] = float("inf")
+		else:
+			self.activated_until[endpoint] = time.time() + expires_in - self.refresh_margin
+
+	def ensure_activated(self, endpoint):
+		#Returns "cached", "active", "reactivated" or "failed"
+		if time.time() < self.activated_until.get(endpoint, 0):
+			return "cached"
+		activation_json = self.backend.endpoint_is_activated(endpoint)
+		expires_in = int(activation_json.get("expires_in", -1))
+		if activation_json.get("activated") == True and (expires_in < 0 or expires_in > self.refresh_margin):
+			self._remember(endpoint, activation_json)
+			return "active"
+		activation_json = self.backend.endpoint_activate_myproxy(endpoint, self.myproxy_u, self.myproxy_pw, lifetime=self.myproxy_lifetime)
+		if activation_json.get("code") != "Activated.MyProxyCredential":
+			self.invalidate(endpoint)
+			return "failed"
+		self._remember(endpoint, activation_json)
+		return "reactivated"
+
+	def invalidate(self, endpoint):
+		self.activated_until.pop(endpoint, None)
+
+	def _submit(self, destination_endpoint, submit):
+		task_json = submit()
+		if is_activation_error(task_json):
+			self.invalidate(destination_endpoint)
+			if self.ensure_activated(destination_endpoint) != "failed":
+				task_json = submit()
+		return task_json
+
+	def submit_transfer(self, source_endpoint, source_path, destination_endpoint, destination_path, label, deadline, recursive=True):
+		return self._submit(destination_endpoint, lambda: self.backend.submit_transfer(source_endpoint, source_path, destination_endpoint, destination_path, label, deadline, recursive=recursive))
+
+	def submit_batch_transfer(self, source_endpoint, destination_endpoint, items, label, deadline):
+		return self._submit(destination_endpoint, lambda: self.backend.submit_batch_transfer(source_endpoint, destination_endpoint, items, label, deadline))
+
+def is_activation_error(task_json):
+	return task_json.get("code") != "Accepted" and "activat" in (str(task_json.get("code", ""))+" "+str(task_json.get("message", ""))).lower()
+
+def get_transfer_backend(backend_name, globus_bin="", access_token="", base_url="", debug=False, refresh_token="", client_id="", client_secret="", auth_url=""):
+	if backend_name == "api":
+		auth_settings = {"access_token": access_token, "refresh_token": refresh_token, "client_id": client_id, "client_secret": client_secret}
+		if auth_url != "":
+			auth_settings["auth_url"] = auth_url
+		authorizer = GlobusTokenAuthorizer(**auth_settings)
+		if access_token == "" and authorizer.can_refresh() == False:
+			raise ValueError("The Globus API transfer backend requires an access token, a refresh token with its client ID, or a client ID and secret.")
+		if base_url != "":
+			return GlobusAPIBackend(authorizer, base_url=base_url, debug=debug)
+		return GlobusAPIBackend(authorizer, debug=debug)
+	elif backend_name == "cli":
+		return GlobusCLIBackend(globus_bin, debug=debug)
+	raise ValueError("Unknown Globus transfer backend: "+backend_name+". Needs to be 'cli' or 'api'.")
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+import threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+class IngestPipeline:
+	#Registers a deliverable's files batch_size at a time and moves each into MinIO storage as soon as its post succeeds
+	#post_fn(items) -> [(ok, target_path, message, retry), ...], place_fn(item, target_path) -> (ok, message[, details])
+	def __init__(self, post_fn, place_fn, post_workers=4, move_workers=2, max_pending=64, retries=2, retry_delay=2, move=True, batch_size=1):
+		self.post_fn = post_fn
+		self.place_fn = place_fn
+		self.post_workers = max(1, post_workers)
+		self.move_workers = max(1, move_workers)
+		self.batch_size = max(1, batch_size)
+		self.pending = threading.BoundedSemaphore(max(2 * self.batch_size, max_pending))
+		self.retries = max(0, retries)
+		self.retry_delay = retry_delay
+		self.move = move
+		self.lock = threading.Lock()
+		self.results = []
+		self.done = threading.Condition(self.lock)
+		self.in_flight = 0
+		self.posting = 0
+
+	def _finish(self, result):
+		with self.lock:
+			self.results.append(result)
+			self.in_flight -= 1
+			self.done.notify_all()
+		self.pending.release()
+
+	def _attempt(self, fn, result):
+		#Returns the successful outcome of fn, or None once the retries are used up
+		while True:
+			result["attempts"] += 1
+			try:
+				outcome = fn()
+			except Exception as e:
+				outcome = (False, str(e))
+			if outcome[0] == True:
+				result["error"] = ""
+				return outcome
+			result["error"] = outcome[1]
+			if len(outcome) > 2:
+				result.update(outcome[2])
+			if result["attempts"] > self.retries or result.get("intervention") == True:
+				return None
+			time.sleep(self.retry_delay)
+
+	def _submit_post(self, post_executor, batch):
+		with self.lock:
+			self.posting += 1
+		post_executor.submit(self._post, batch)
+
+	def _post(self, batch):
+		try:
+			self._post_batch(batch)
+		finally:
+			with self.lock:
+				self.posting -= 1
+
+	def _post_batch(self, batch):
+		while len(batch) > 0:
+			for item, result in batch:
+				result["attempts"] += 1
+			try:
+				outcomes = self.post_fn([item for item, result in batch])
+			except Exception as e:
+				outcomes = [(False, "", str(e), False)] * len(batch)
+			retry = []
+			for (item, result), outcome in zip(batch, outcomes):
+				if outcome[0] == True:
+					result["error"] = ""
+					result["posted"] = True
+					result["target_path"] = outcome[1]
+					if self.move == False:
+						self._finish(result)
+					else:
+						result["attempts"] = 0
+						self.move_executor.submit(self._place, item, result)
+				else:
+					result["error"] = outcome[2]
+					if result["attempts"] > self.retries or outcome[3] == False:
+						self._finish(result)
+					else:
+						retry.append((item, result))
+			batch = retry
+			if len(batch) > 0:
+				time.sleep(self.retry_delay)
+
+	def _place(self, item, result):
+		outcome = self._attempt(lambda: self.place_fn(item, result["target_path"]), result)
+		if outcome != None:
+			result["moved"] = True
+			if len(outcome) > 2:
+				result.update(outcome[2])
+		self._finish(result)
+
+	def run(self, items):
+		self.results = []
+		self.move_executor = ThreadPoolExecutor(max_workers=self.move_workers)
+		with self.move_executor:
+			with ThreadPoolExecutor(max_workers=self.post_workers) as post_executor:
+				batch = []
+				for item in items:
+					while self.pending.acquire(timeout=0.05) == False:
+						#While a post runs the files it hands to the move pool free up room, otherwise
+						#holding the partial batch back would leave both pools idle
+						if len(batch) > 0 and self.posting == 0:
+							self._submit_post(post_executor, batch)
+							batch = []
+					result = {"local_file_path": item["local_file_path"], "action": item["action"], "target_path": item.get("target_path", ""), "posted": item["action"] == "resume", "moved": False, "attempts": 0, "error": ""}
+					with self.lock:
+						self.in_flight += 1
+					if item["action"] != "post":
+						if self.move == False:
+							#Nothing to register and nothing to place
+							self._finish(result)
+						else:
+							self.move_executor.submit(self._place, item, result)
+					else:
+						batch.append((item, result))
+						if len(batch) >= self.batch_size:
+							self._submit_post(post_executor, batch)
+							batch = []
+				if len(batch) > 0:
+					self._submit_post(post_executor, batch)
+				#Posts hand work to the move pool, so wait for every file to settle before shutting it down
+				with self.lock:
+					while self.in_flight > 0:
+						self.done.wait()
+		return self.results
@@ -4,15 +4,39 @@
 # Author: Jacek Kominek <jkominek@wisc.edu>
 # Description: Stage JGI data and sync it to GLBRC servers
 
-import os, sys, argparse, pexpect, json, re, copy
+import os, time, signal, socket, threading, queue, atexit, argparse, pexpect, json, re
 import requests, urllib3, urllib.request, urllib.parse, urllib.error
 import cx_Oracle
 from collections import defaultdict
-from shutil import copyfile, move
-from auth import auth_with_dc
-from log import print_to_log, date_now, time_now
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from auth import auth_with_dc, dc_token_expires_at
+from log import print_to_log, date_now, time_now, helpdesk
+from throttle import HostRateLimiter
+from ingest import IngestPipeline
+from tracker import TransferTracker
+from ledger import IngestLedger
+from placement import FilePlacer, describe
+from scheduler import TransferScheduler, mb, no_slot_left
+from metrics import Metrics
+from db import SyncRequests, create_pool
+from catalog import DataCatalogClient, BulkRegistrar, ChecksumRecorder, index_existing_files
+from globus_backend import GlobusSession, GlobusAuthError, get_transfer_backend
+
+class CycleAborted(Exception):
+	pass
 
 def exit_gracefully():
+	#In daemon mode a fatal error only aborts the current cycle, the daemon itself keeps going
+	#Updates queued before the fatal error are still written
+	if sync_requests != None:
+		try:
+			sync_requests.flush()
+		except cx_Oracle.DatabaseError as e:
+			print_to_log("Could not write the queued status updates: "+str(e), "warn")
+	if daemon_running == True:
+		raise CycleAborted()
+	if lockfile_held == False:
+		exit()
 	if os.path.exists("/tmp/jgi_transfer_tasks.pid") == True:
 		child_exit = pexpect.spawn("rm",["/tmp/jgi_transfer_tasks.pid"])
 		child_exit.read()
@@ -20,86 +44,198 @@ def exit_gracefully():
 		print_to_log("Lockfile removed before a run could complete!", "warn")
 	exit()
 
-def get_sample_details(sample_barcode):
-	dc_get_sample_details_url = base_dc_url+"/api/v2/datafiles/sample_details"
-	try:
-		response = requests.get(url=dc_get_sample_details_url, params={"sample_barcode": sample_barcode}, headers=dc_api_call_headers, verify=False)
-	except TimeoutError:
-		return("Connection timed out!")
-	else:
-		return(response)
+santizing_regex = re.compile(r"[^A-Za-z0-9._\/\-]")
+sync_requests = None
+lockfile_held = False
 
-def get_experiment_details(sample_barcodes, experiment_id):
-	dc_get_experiment_details_url = base_dc_url+"/api/v2/datafiles/experiment_details"
-	barcodes = ",".join(sample_barcodes)
-	try:
-		if sample_barcodes == []:
-			response = requests.get(url=dc_get_experiment_details_url, params={"experiment_id": experiment_id}, headers=dc_api_call_headers, verify=False)
-		else:
-			dc_api_call_headers2 = copy.deepcopy(dc_api_call_headers)
-			dc_api_call_headers2["Content-Type"] = "application/json"
-			response = requests.get(url=dc_get_experiment_details_url, data="{ \"sample_barcodes\" : \""+barcodes+"\" }", headers=dc_api_call_headers2, verify=False)
-			if args.debug == True:
-				print("\nENCODING")
-				print(response.encoding)
-				print("\nCONTENT")
-				print(response.content)
-				print("\nREQUEST HEADERS")
-				print(response.request.headers)
-				print("\nHEADERS")
-				print(response.headers)
-				print("\nTEXT")
-				print(response.text)
-				print("\nSTATUS")
-				print(response.status_code)
-				print("\nURL")
-				print(response.url)
-				print("\nJSON")
-				print(response.json())
-				sys.stdout.flush()
-
-	except TimeoutError:
-		return("Connection timed out!")
-	else:
-		return(response)
+def ingest_items(fd_id, task_id, files, destination_prefix, existing_files_index, ledger_entries, listed):
+	#Turns the successful transfers of a deliverable into ingest pipeline items. Files the ingest ledger has
+	#as moved are skipped, files it has as posted only still need placing ("resume"). Files already in the
+	#Data Catalog are overwritten in place ("replace"), everything else gets posted first ("post").
+	#listed["files"] counts the transfers that belong to the deliverable, skipped ones included.
+	for f in files:
+		if f["DATA_TYPE"] != "successful_transfer":
+			continue
+		if destination_prefix != "" and os.path.normpath(f["destination_path"]).startswith(destination_prefix) == False:
+			continue
+		listed["files"] += 1
+		local_file_path = f["destination_path"]
+		ledger_state, ledger_target_path = ledger_entries.get(local_file_path, ("", ""))
+		if ledger_state == "moved":
+			continue
+		if ledger_state == "posted":
+			yield {"task_id": task_id, "local_file_path": local_file_path, "local_file_path_decoded": urllib.parse.unquote(local_file_path), "path_to_post": local_file_path.replace(tmp_path,""), "action": "resume", "target_path": ledger_target_path}
+			continue
+		if os.path.exists(local_file_path) == False:
+			print_to_log(fd_id+" File does not exist, skipping! "+local_file_path)
+			continue
+		local_file_path_decoded = urllib.parse.unquote(local_file_path)
 		
-def post_file(filename, sample_barcode, experiment_id):
-	dc_post_file_url = base_dc_url+"/api/v2/datafiles"
-	path_filename = filename.split("/")[-1]
-	path_dir = str("/".join(filename.split("/")[:-1]))+"/"
-	stub_file = "/tmp/"+path_filename
-	child_post = pexpect.spawn("touch",[stub_file])
-	child_post.read()
-	with open(stub_file, 'r') as sf:
-		try:
-			if experiment_id == "":
-				response = requests.post(url=dc_post_file_url, files={"file": sf}, params={"sample_barcode": sample_barcode, "description": path_filename, "custom_subpath": path_dir}, headers=dc_api_call_headers, verify=False)
-			else:
-				response = requests.post(url=dc_post_file_url, files={"file": sf}, params={"experiment_id" : experiment_id, "description": path_filename, "custom_subpath": path_dir}, headers=dc_api_call_headers, verify=False)
-			if args.debug == True:
-				print("\nENCODING")
-				print(response.encoding)
-				print("\nCONTENT")
-				print(response.content)
-				print("\nREQUEST HEADERS")
-				print(response.request.headers)
-				print("\nHEADERS")
-				print(response.headers)
-				print("\nTEXT")
-				print(response.text)
-				print("\nSTATUS")
-				print(response.status_code)
-				print("\nURL")
-				print(response.url)
-				print("\nJSON")
-				print(response.json())
-				sys.stdout.flush()
-			child_rm = pexpect.spawn("rm", [stub_file])
-			child_rm.read()
-		except TimeoutError:
-			return("Connection timed out!")
-		else:
-			return(response)
+		path_to_post = local_file_path.replace(tmp_path,"")
+		path_to_post_decoded = urllib.parse.unquote(path_to_post)
+		path_to_post_decoded_and_sanitized = santizing_regex.sub("_",path_to_post_decoded)
+		path_to_post_decoded_and_sanitized_noleadslash = path_to_post_decoded_and_sanitized
+		if path_to_post_decoded_and_sanitized[0] == "/":
+			path_to_post_decoded_and_sanitized_noleadslash = path_to_post_decoded_and_sanitized[1:]
+		
+		item = {"task_id": task_id, "local_file_path": local_file_path, "local_file_path_decoded": local_file_path_decoded, "path_to_post": path_to_post, "path_to_post_sanitized": path_to_post_decoded_and_sanitized, "action": "post"}
+		if path_to_post_decoded_and_sanitized_noleadslash in existing_files_index:
+			print_to_log(fd_id+" File already present in the Data Catalog. Overwriting. "+path_to_post_decoded_and_sanitized_noleadslash)
+			item["action"] = "replace"
+			item["target_path"] = base_minio_path+"/"+existing_files_index[path_to_post_decoded_and_sanitized_noleadslash]
+		yield item
+
+def ingest_post(items, fd_id, sample_id, experiment_id):
+	#Register a batch of new files with the Data Catalog, returns one (ok, minio_path, message, retry) per item
+	entries = []
+	for item in items:
+		path_filename = item["path_to_post_sanitized"].split("/")[-1]
+		path_dir = str("/".join(item["path_to_post_sanitized"].split("/")[:-1]))+"/"
+		entries.append((path_dir, path_filename))
+	outcomes = dc_registrar.register(entries, sample_barcode=sample_id, experiment_id=experiment_id)
+	results = []
+	for item, (ok, path, message, retry) in zip(items, outcomes):
+		if ok == False:
+			results.append((False, "", message, retry))
+			continue
+		if sample_id == "":
+			print_to_log(fd_id+" File Posted (experiment_id: "+experiment_id+") "+item["local_file_path"])
+		elif experiment_id == "":
+			print_to_log(fd_id+" File Posted (sample_id: "+sample_id+") "+item["local_file_path"])
+		ingest_ledger.record(item["task_id"], item["local_file_path"], fd_id, "posted", base_minio_path+"/"+path)
+		results.append((True, base_minio_path+"/"+path, "", False))
+	return results
+
+def catalog_path(minio_path):
+	#Target paths are base_minio_path followed by the datafile path the Data Catalog gave out (its "path" for
+	#new files, its "fullpath" for replaced ones), the catalog only knows the latter
+	return minio_path[len(base_minio_path+"/"):]
+
+def ingest_place(item, minio_path, fd_id, sample_id, experiment_id):
+	#Move (or copy) a file into MinIO storage and check its size, returns (ok, message)
+	local_file_path_decoded = item["local_file_path_decoded"]
+	if os.path.exists(local_file_path_decoded) == False and os.path.exists(minio_path) == True:
+		#Already placed by an earlier attempt whose result got lost, if the target has the size the source had
+		expected_size = ingest_ledger.expected_size(item["task_id"], item["local_file_path"])
+		if expected_size == None or os.stat(minio_path).st_size != expected_size:
+			return (False, "Source is gone and "+minio_path+" does not have the size recorded before it was placed ("+str(expected_size)+" bytes). "+item["path_to_post"], {"intervention": True})
+		if item["action"] == "replace":
+			#Nothing here tells the replaced file from the one it was meant to overwrite
+			print_to_log(fd_id+" Source of a replaced file is gone, keeping the file already in MinIO storage, it may still be the previous version. "+minio_path, "warn")
+		ingest_ledger.record(item["task_id"], item["local_file_path"], fd_id, "moved", minio_path, size=expected_size)
+		return (True, "")
+	#The size is kept before the source can disappear, an attempt that loses its result checks the target against it
+	size_source = os.stat(local_file_path_decoded).st_size
+	ingest_ledger.record(item["task_id"], item["local_file_path"], fd_id, "posted", minio_path, size=size_source)
+	os.makedirs(os.path.dirname(minio_path), exist_ok=True)
+	#See placement.py, a rename when tmp_path and MinIO storage share a filesystem, a kernel copy otherwise
+	placement = file_placer.place(local_file_path_decoded, minio_path, move=(args.copy == False))
+	size_target = os.stat(minio_path).st_size
+	if placement["bytes"] != size_target or size_source != size_target:
+		return (False, "Error moving file to Data Catalog. "+item["path_to_post"])
+	if sample_id == "":
+		print_to_log(fd_id+" File Moved (experiment_id: "+experiment_id+") FROM "+item["local_file_path"]+" TO "+minio_path+" ("+describe(placement)+")")
+	elif experiment_id == "":
+		print_to_log(fd_id+" File Moved (sample_id: "+sample_id+") FROM "+item["local_file_path"]+" TO "+minio_path+" ("+describe(placement)+")")
+	metrics.inc("files_placed_total", strategy=placement["strategy"])
+	metrics.inc("bytes_placed_total", placement["bytes"], strategy=placement["strategy"])
+	metrics.observe("placement", placement["seconds"], strategy=placement["strategy"], details={"fd_id": fd_id, "bytes": placement["bytes"], "path": minio_path})
+	ingest_ledger.record(item["task_id"], item["local_file_path"], fd_id, "moved", minio_path, checksum=placement["checksum"], size=size_source)
+	return (True, "", {"checksum": placement["checksum"]})
+
+def resolve_samples(fd_id, force_sample_id, force_experiment_id, prefetched_sample_ids):
+	#The sample IDs (or the experiment ID) a deliverable gets posted to, returns (sids, experiment_id, error)
+	if args.force_sample_ids != []:
+		return (args.force_sample_ids, "", "")
+	elif force_sample_id != "-1" and force_experiment_id != "-1":
+		return ([], "", "Both sample_id and experiment_id provided, both cannot be specified at the same time, aborting the current FD_ID.")
+	elif force_sample_id != "-1" and force_experiment_id == "-1":
+		return ([force_sample_id], "", "")
+	elif force_sample_id == "-1" and force_experiment_id != "-1":
+		return ([], force_experiment_id, "")
+	if sync_requests != None:
+		sids = prefetched_sample_ids.get(str(fd_id), [])
+		if sids == []:
+			return ([], "", "No samples associated with current FD_ID in the database. Aborting the current FD_ID.")
+		return (sids, "", "")
+	return ([], "", "")
+
+def metadata_key(sids, experiment_id):
+	#The Data Catalog details lookup post() makes for a deliverable, None if it makes none
+	if experiment_id != "" and sids == []:
+		return ("experiment", experiment_id)
+	elif experiment_id == "" and len(sids) == 1:
+		return ("sample", str(sids[0]))
+	elif experiment_id == "" and len(sids) > 1:
+		return ("samples", tuple(sids))
+	return None
+
+def fetch_metadata(key):
+	if key[0] == "experiment":
+		return dc_client.get_experiment_details(sample_barcodes=[], experiment_id=key[1])
+	elif key[0] == "sample":
+		return dc_client.get_sample_details(key[1])
+	return dc_client.get_experiment_details(sample_barcodes=list(key[1]), experiment_id="")
+
+def prefetch_metadata(keys):
+	#Details requests for every deliverable of the run, made concurrently. Lookups that fail here are
+	#left out and post() repeats them itself.
+	metadata = {}
+	with ThreadPoolExecutor(max_workers=dc_metadata_workers) as executor:
+		futures = dict((executor.submit(fetch_metadata, key), key) for key in set(keys))
+		for future in as_completed(futures):
+			try:
+				metadata[futures[future]] = future.result()
+			except requests.exceptions.RequestException as e:
+				print_to_log("Data Catalog "+futures[future][0]+" details prefetch failed. "+str(e), "warn")
+	return metadata
+
+def stage_request(fd_id):
+	#Get the portal_id for the fd_id and ask JGI to stage it through GLOBUS. Runs inside the stage worker pool,
+	#so nothing here touches the database or exits, errors are handed back to stage() instead.
+	result = {"fd_id": fd_id, "portal_id": "", "jgi_stage_url": "", "error": ""}
+	print_to_log(fd_id+" "+"Sync requested.")
+	
+	#Get portal_id for the fd_id
+	p1 = {"parameterName":"jgiProjectId", "parameterValue":fd_id}
+	p1 = "&".join("%s=%s" % (k,v) for k,v in list(p1.items()))
+	jgi_portal_id_url = jgi_portal_url+"/ext-api/genome-admin/getPortalIdByParameter"
+	try:
+		jgi_rate_limiter.wait(jgi_portal_id_url)
+		r1 = s.get(jgi_portal_id_url, params=p1, cookies=s.cookies, allow_redirects=True, stream=False)
+	except requests.exceptions.Timeout:
+		result["error"] = "JGI Genome Portal getting PortalID request timed out!"
+		return result
+	except requests.exceptions.SSLError:
+		result["error"] = "JGI Genome Portal SSL error!"
+		return result
+	result["portal_id"] = r1.text.strip()
+	print_to_log(fd_id+" Portal ID acquired. "+result["portal_id"])
+	
+	#Request JGI to stage the portal_id data through GLOBUS
+	p2 = {"portal":result["portal_id"],"globusName":globus_u,"sendMail": False}
+	p2 = "&".join("%s=%s" % (k,v) for k,v in list(p2.items()))
+	jgi_globus_request_url = jgi_portal_url+"/ext-api/downloads/globus/request"
+	try:
+		jgi_rate_limiter.wait(jgi_globus_request_url)
+		r2 = s.post(jgi_globus_request_url, timeout=10, data=p2, cookies=s.cookies, allow_redirects=True, stream=False)
+	except requests.exceptions.Timeout:
+		result["error"] = "JGI Genome Portal staging request timed out!"
+		return result
+	except requests.exceptions.SSLError:
+		result["error"] = "JGI Genome Portal SSL error!"
+		return result
+	jgi_stage_url = r2.text.strip()
+	
+	if "Exception while getting ID for Globus user" in jgi_stage_url:
+		result["error"] = "JGI Error: Exception while getting ID for Globus user."
+		return result
+	if "This service is temporarily unavailable. Please try again later" in jgi_stage_url:
+		result["error"] = "JGI staging service is temporarily unavailable."
+		return result
+	print_to_log(fd_id+" Data staging requested from JGI. "+jgi_stage_url)
+	result["jgi_stage_url"] = jgi_stage_url
+	return result
 
 def stage (force_fd_id):
 	fd_ids = []
@@ -111,75 +247,93 @@ def stage (force_fd_id):
 	if force_fd_id != "-1":
 		fd_ids.append(force_fd_id)
 	else:
-		cur.execute("SELECT fd_id FROM sync_requests WHERE status = :1 AND num_samples >= 1", (sync_status_old,))
-		rows = cur.fetchall()
-		for row in rows:
-			fd_id = row[0]
-			fd_ids.append(fd_id)
-		cur.execute("SELECT fd_id FROM sync_requests WHERE status = :1 AND num_samples is null", (sync_status_old,))
-		rows = cur.fetchall()
-		for row in rows:
-			fd_id = row[0]
-			print_to_log("No samples in the database for FD_ID "+fd_id+". Intervention required.", "error", no_email=args.no_mail)
-			sync_status = "Intervention"
-			cur.execute("UPDATE sync_requests SET status = :1, sync_timestamp = :2, updated_at = :3 WHERE fd_id = :4 AND status = :5", (sync_status, time_now(), time_now(), fd_id, sync_status_old))
-			con.commit()
+		for row in sync_requests.claim(sync_status_old, ["fd_id", "num_samples"]):
+			fd_id = row["fd_id"]
+			if row["num_samples"] == None:
+				print_to_log("No samples in the database for FD_ID "+fd_id+". Intervention required.", "error", no_email=args.no_mail)
+				sync_status = "Intervention"
+				sync_requests.transition(fd_id, sync_status_old, sync_status)
+			elif row["num_samples"] >= 1:
+				fd_ids.append(fd_id)
 	if len(fd_ids) >= 1:
-		for fd_id in fd_ids:
-			print_to_log(fd_id+" "+"Sync requested.")
-					
-			#Get portal_id for the fd_id
-			p1 = {"parameterName":"jgiProjectId", "parameterValue":fd_id}
-			p1 = "&".join("%s=%s" % (k,v) for k,v in list(p1.items()))
-			try:
-				r1 = s.get("https://genome.jgi.doe.gov/portal/ext-api/genome-admin/getPortalIdByParameter", params=p1, cookies=s.cookies, allow_redirects=True, stream=False)
-			except requests.exceptions.Timeout:
-				print_to_log("JGI Genome Portal getting PortalID request timed out!","fatal", no_email=args.no_mail)
-				exit_gracefully()
-			except requests.exceptions.SSLError:
-				print_to_log("JGI Genome Portal SSL error!","fatal", no_email=args.no_mail)
-				exit_gracefully()
-			portal_id = r1.text.strip()
-			
-			print_to_log(fd_id+" Portal ID acquired. "+portal_id)
-			#Report the portal_id to database
-				
-			if force_fd_id == "-1" or args.force_db == True:
-				cur.execute("UPDATE sync_requests SET portal_id = :1 WHERE fd_id = :2 AND status = :3", (portal_id, fd_id, sync_status_old))
-				con.commit()
-			
-			#Request JGI to stage the portal_id data through GLOBUS
-			p2 = {"portal":portal_id,"globusName":globus_u,"sendMail": False}
-			p2 = "&".join("%s=%s" % (k,v) for k,v in list(p2.items()))
-			try:
-				r2 = s.post("https://genome.jgi.doe.gov/portal/ext-api/downloads/globus/request", timeout=10, data=p2, cookies=s.cookies, allow_redirects=True, stream=False)
-			except requests.exceptions.Timeout:
-				print_to_log("JGI Genome Portal staging request timed out!", "fatal", no_email=args.no_mail)
-				exit_gracefully()
-			except requests.exceptions.SSLError:
-				print_to_log("JGI Genome Portal SSL error!","fatal", no_email=args.no_mail)
-				exit_gracefully()
-			jgi_stage_url = r2.text.strip()
-			
-			if "Exception while getting ID for Globus user" in jgi_stage_url:
-				print_to_log("JGI Error: Exception while getting ID for Globus user.", "fatal", no_email=args.no_mail)
-				exit_gracefully()
-			if "This service is temporarily unavailable. Please try again later" in jgi_stage_url:
-				print_to_log("JGI staging service is temporarily unavailable.", "fatal", no_email=args.no_mail)
-				exit_gracefully()
-			print_to_log(fd_id+" Data staging requested from JGI. "+jgi_stage_url)
-			sync_status = "Staging"
-			if force_fd_id == "-1" or args.force_db == True:
-				cur.execute("UPDATE sync_requests SET status = :1, sync_timestamp = :2, updated_at = :3, jgi_stage_url = :4 WHERE fd_id = :5 AND status = :6", (sync_status, time_now(), time_now(), jgi_stage_url, fd_id, sync_status_old))
-				con.commit()
-			elif force_fd_id != "-1":
-				return jgi_stage_url
+		#JGI requests run concurrently in the worker pool, database updates are applied here on the main thread
+		#as each request completes. On the first fatal error no new requests are started, the ones already
+		#finished are still recorded, and then the run exits.
+		fatal_error = ""
+		with ThreadPoolExecutor(max_workers=stage_workers) as executor:
+			futures = [executor.submit(stage_request, fd_id) for fd_id in fd_ids]
+			for future in as_completed(futures):
+				if future.cancelled():
+					continue
+				result = future.result()
+				fd_id = result["fd_id"]
+				if result["portal_id"] != "" and (force_fd_id == "-1" or args.force_db == True):
+					#Report the portal_id to database
+					sync_requests.update(fd_id, sync_status_old, portal_id=result["portal_id"])
+				if result["error"] != "":
+					if fatal_error == "":
+						fatal_error = result["error"]
+						for f in futures:
+							f.cancel()
+					continue
+				sync_status = "Staging"
+				if force_fd_id == "-1" or args.force_db == True:
+					sync_requests.transition(fd_id, sync_status_old, sync_status, jgi_stage_url=result["jgi_stage_url"])
+				elif force_fd_id != "-1":
+					return result["jgi_stage_url"]
+		if fatal_error != "":
+			print_to_log(fatal_error, "fatal", no_email=args.no_mail)
+			exit_gracefully()
 	else:
 		print_to_log("No FD_IDs currently with the \"New\" status to process.")
+	if sync_requests != None:
+		sync_requests.flush()
 		
+
+def schedule_transfers(ready, claimed_fd_ids, slots, batched):
+	#Orders the staged deliverables by xfer_policy and admits as many as the free Globus task slots and the
+	#staging disk budget allow, see scheduler.py. Deferrals are logged here, the admitted deliverables are
+	#returned with their "reason" and logged once their transfer is submitted.
+	staging_fd_ids = [row["fd_id"] for row in sync_requests.fetch("Staging", ["fd_id"])]
+	downloading_fd_ids = [row["fd_id"] for row in sync_requests.fetch("Downloading", ["fd_id"])]
+	#Every worker's deliverables are kept, not only the ones this worker claimed
+	transfer_scheduler.forget_except(list(claimed_fd_ids) + staging_fd_ids + downloading_fd_ids)
+	candidates = []
+	for deliverable in ready:
+		size = transfer_scheduler.known_size(deliverable["fd_id"])
+		if size == None and slots > 0 and transfer_scheduler.size_due(deliverable["fd_id"]) == True:
+			#Listed once on the stage endpoint, the size is remembered until the deliverable is done
+			try:
+				size = transfer_backend.path_size(deliverable["endpoint"], deliverable["path"])
+			except (ValueError, requests.exceptions.RequestException) as e:
+				print_to_log(deliverable["fd_id"]+" Could not get the size of "+deliverable["endpoint"]+":"+deliverable["path"]+" from Globus. "+str(e), "warn")
+			transfer_scheduler.remember(deliverable["fd_id"], size, deliverable["destination"])
+		candidates.append(dict(deliverable, size=size))
+	budget, outstanding = transfer_scheduler.budget(downloading_fd_ids)
+	metrics.set("staging_disk_budget_bytes", budget)
+	metrics.set("staging_disk_outstanding_bytes", outstanding)
+	print_to_log("Scheduling "+str(len(candidates))+" staged deliverable(s) by "+xfer_policy+": "+str(max(0, slots))+" Globus task slot(s), "+mb(budget)+" of staging disk budget, "+mb(outstanding)+" still to arrive for running transfers.")
+	admitted = []
+	slots_exhausted = False
+	#One Globus task takes a batch of deliverables from the same stage endpoint
+	for candidate, admit, reason in transfer_scheduler.plan(candidates, slots, budget, batch_size=xfer_batch_size if batched == True else 1):
+		if admit == True:
+			admitted.append(dict(candidate, reason=reason))
+			continue
+		metrics.inc("xfer_admissions_total", decision="deferred")
+		if candidate["size"] != None and candidate["size"] > budget + outstanding:
+			print_to_log(candidate["fd_id"]+" Transfer deferred, "+mb(candidate["size"])+" is more than the staging disk can take even once the running transfers are done ("+reason+").", "warn")
+		else:
+			print_to_log(candidate["fd_id"]+" Transfer deferred to a later cycle ("+reason+").")
+			slots_exhausted = slots_exhausted or reason == no_slot_left
+	if slots_exhausted == True:
+		print_to_log("Globus concurrent transfer task limit reached. Better luck next cycle.", "error", no_email=args.no_mail)
+	return admitted
+
 def xfer (force_fd_id, force_jgi_stage_url):
 	jgi_stage_urls = []
 	fd_ids = []
+	staged_since = {}
 	sync_status = ""
 	sync_status_old = "Staging"
 	if args.intervention == True:
@@ -189,27 +343,30 @@ def xfer (force_fd_id, force_jgi_stage_url):
 		jgi_stage_urls.append(force_jgi_stage_url)
 		fd_ids.append(force_fd_id)
 	elif force_jgi_stage_url == "":
-		cur.execute("SELECT fd_id, jgi_stage_url FROM sync_requests WHERE status = :1", (sync_status_old,))
-		rows = cur.fetchall()
-		for row in rows:
-			fd_id = row[0]
-			fd_ids.append(fd_id)
-			jgi_stage_url = row[1]
-			jgi_stage_urls.append(jgi_stage_url)
-	child0 = pexpect.spawn(globus_bin, ["task","list","--format","json","--limit","100","--filter-status","ACTIVE"], encoding='utf-8')
-	child0_out = child0.read()
-	if args.debug == True:
-		print(child0_out)
-	task0_json = json.loads(child0_out)
-	task_limit = 100 - int(len(task0_json["DATA"]))
+		for row in sync_requests.claim(sync_status_old, ["fd_id", "jgi_stage_url", "sync_timestamp"]):
+			fd_ids.append(row["fd_id"])
+			jgi_stage_urls.append(row["jgi_stage_url"])
+			staged_since[row["fd_id"]] = row["sync_timestamp"]
+	try:
+		task0_json = transfer_backend.task_list(filter_status="ACTIVE", limit=globus_task_limit)
+	except ValueError as e:
+		#Without the number of active tasks the free Globus task slots are unknown
+		print_to_log("Could not list the active Globus tasks. "+str(e)+" Will retry on the next cycle.", "error", no_email=args.no_mail)
+		return
+	task_limit = globus_task_limit - int(len(task0_json["DATA"]))
+	metrics.set("globus_active_tasks", len(task0_json["DATA"]))
+	metrics.set("globus_task_slots_free", task_limit)
 	if args.debug == True:
 		print(str(len(fd_ids)))
+	#In batched mode staged deliverables are grouped by their stage endpoint and submitted together
+	#after the loop, one Globus task per group (of up to xfer_batch_size deliverables)
+	batched = xfer_batch == True and force_jgi_stage_url == ""
+	batches = defaultdict(list)
 	if len(jgi_stage_urls) >= 1 and len(fd_ids) >= 1:
-		index = 1	
+		#Every staged deliverable is collected first, the scheduler then decides which of them are
+		#submitted this cycle and in which order (see schedule_transfers)
+		ready = []
 		for fd_id, jgi_stage_url in zip(fd_ids, jgi_stage_urls):
-			if index >= task_limit:
-				print_to_log("Globus concurrent transfer task limit reached. Better luck next cycle.", "error", no_email=args.no_mail)
-				break
 			if "http" in jgi_stage_url:
 				try:
 					r1 = s.get(jgi_stage_url, timeout=10, cookies=s.cookies, allow_redirects=True, stream=False)
@@ -227,64 +384,10 @@ def xfer (force_fd_id, force_jgi_stage_url):
 					
 					print_to_log(fd_id+" Data staging successful.")
 					if force_jgi_stage_url == "" or args.force_db == True:
-						cur.execute("UPDATE sync_requests SET globus_stage_url = :1, globus_stage_endpoint = :2, globus_stage_path = :3 WHERE fd_id = :4 AND status = :5", (globus_stage_url, globus_stage_endpoint, globus_stage_path, fd_id, sync_status_old))
-						con.commit()
+						sync_requests.update(fd_id, sync_status_old, globus_stage_url=globus_stage_url, globus_stage_endpoint=globus_stage_endpoint, globus_stage_path=globus_stage_path)
 						
 					glbrc_destination_path = globus_stage_path
-
-					#Login tokens for GLOBUS are valid for 6 months but should get refreshed every time the Globus CLI is used
-					#Login tokens must be acquired with a browser, if we do not want to go through the API (we don't)
-					#so if we're not logged in, there is no sense in proceeding, hence the forced exit.
-					child0 = pexpect.spawn(globus_bin, ["whoami"], encoding='utf-8')
-					
-					login_status = str([child0.read()][0])
-					if args.debug == True:
-						print(login_status)
-					if "Please try logging in again" in login_status:
-						print_to_log("Globus error: Not signed into Globus. Log in first and then restart.", "fatal", no_email=args.no_mail)
-						exit_gracefully()
-						
-					#Check if the GLBRC endpoint is activated, reactivate if it is not. Use pexpect because it allows passing silent passwords 
-					child1 = pexpect.spawn(globus_bin, ["endpoint","is-activated","--format","json",glbrc_destination_endpoint], encoding='utf-8')
-					child1_out = child1.read()
-					task1_json = json.loads(child1_out.replace("Exit: \r\n",""))
-					if task1_json["activated"] == False:
-						print_to_log(fd_id+" GLBRC Endpoint not active, attempting reactivation.", "warn")
-						child2 = pexpect.spawn(globus_bin, ["endpoint","activate","--format","json","--myproxy",glbrc_destination_endpoint,"--myproxy-lifetime","168"], encoding='utf-8')
-						child2.expect("Myproxy username:")
-						child2.sendline(globus_myproxy_u+"\n")
-						child2.expect("Myproxy password:")
-						child2.sendline(globus_myproxy_pw+"\n")
-						child2_out = child2.read()
-						task2_json = json.loads(child2_out.replace("Exit: \r\n",""))
-						if task2_json["code"] != "Activated.MyProxyCredential":
-							print_to_log("Globus error: Endpoint reactivation failed, cannot transfer data.", "fatal", no_email=args.no_mail)
-							exit_gracefully()
-						elif task2_json["code"] == "Activated.MyProxyCredential":
-							print_to_log(fd_id+" Endpoint succesfully reactivated, proceeding with transfer.")
-					else:
-						print_to_log(fd_id+" GLBRC endpoint active, proceeding with transfer.")
-					
-					#Launch the transfer via GLOBUS
-					transfer_label = "GLBRC JGI Data Sync "+time_now()
-					transfer_label = transfer_label.replace(":","_").replace(".","_").replace("-","_").replace(" ","_")
-					transfer_params = ["transfer","--preserve-mtime","--deadline",date_now(add_days=7),"--format","json",globus_stage_endpoint+":"+globus_stage_path,glbrc_destination_endpoint+":"+tmp_path+"/"+glbrc_destination_path.split("/")[3]+"/","--recursive", "--label",transfer_label,"--notify","off"]
-					child3 = pexpect.spawn(globus_bin, transfer_params, encoding='utf-8')
-					child3_out = child3.read()
-					task3_json = json.loads(child3_out.replace("Exit: \r\n",""))
-					if task3_json["code"] != "Accepted":
-						print_to_log(fd_id+" Transfer request failed. Transfer params:\n"+transfer_params+"\n"+child3_out, "fatal", no_email=args.no_mail)
-						exit_gracefully()
-					elif task3_json["code"] == "Accepted":
-						globus_transfer_task_id = task3_json["task_id"]
-						print_to_log(fd_id+" Transfer succesfully submitted. Transfer ID: "+globus_transfer_task_id)
-						sync_status = "Downloading"
-						index += 1
-						if force_jgi_stage_url == "" or args.force_db == True:
-							cur.execute("UPDATE sync_requests SET status = :1, sync_timestamp = :2, updated_at = :3, globus_transfer_task_id = :4, globus_transfer_task_label = :5 WHERE fd_id = :6 AND status = :7", (sync_status, time_now(), time_now(), globus_transfer_task_id, transfer_label, fd_id, sync_status_old))
-							con.commit()
-						elif force_jgi_stage_url != "" or args.force_db == True:
-							return globus_transfer_task_id			
+					ready.append({"fd_id": fd_id, "endpoint": globus_stage_endpoint, "path": globus_stage_path, "destination": tmp_path+"/"+glbrc_destination_path.split("/")[3]+"/", "since": staged_since.get(fd_id, "")})
 				elif "Download request completed." in r1.text and "No data are available for download." in r1.text:
 					print_to_log(fd_id+" No data available for download")
 				elif "Download request is being processed." in r1.text:
@@ -294,13 +397,100 @@ def xfer (force_fd_id, force_jgi_stage_url):
 				elif "Download request failed." in r1.text:
 					print_to_log(fd_id+" Staging request failed. Reverting status to \"New\" to retry next cycle. Error:\n"+r1.text, "error", no_email=args.no_mail)
 					sync_status = "New"
-					cur.execute("UPDATE sync_requests SET status = :1, sync_timestamp = :2, updated_at = :3 WHERE fd_id = :4 AND status = :5", (sync_status, time_now(), time_now(), fd_id, sync_status_old))
-					con.commit()
+					sync_requests.transition(fd_id, sync_status_old, sync_status)
+		
+		#Transfers started by hand are not scheduled
+		admitted = ready
+		if force_jgi_stage_url == "":
+			admitted = schedule_transfers(ready, fd_ids, task_limit - 1, batched)
+		index = 1
+		for candidate in admitted:
+			fd_id = candidate["fd_id"]
+			globus_stage_endpoint = candidate["endpoint"]
+			globus_stage_path = candidate["path"]
+			
+			#Login tokens for GLOBUS are valid for 6 months but should get refreshed every time the Globus CLI is used
+			#Login tokens must be acquired with a browser, if we do not want to go through the API (we don't)
+			#so if we're not logged in, there is no sense in proceeding, hence the forced exit.
+			#Both the login check and the endpoint activation are cached in globus_session, so Globus
+			#is only asked once per run (or once the cached activation gets close to expiring).
+			if globus_session.ensure_logged_in() == False:
+				print_to_log("Globus error: Not signed into Globus. Log in first and then restart.", "fatal", no_email=args.no_mail)
+				exit_gracefully()
+				
+			#Check if the GLBRC endpoint is activated, reactivate if it is not.
+			activation_status = globus_session.ensure_activated(glbrc_destination_endpoint)
+			if activation_status == "failed":
+				print_to_log("Globus error: Endpoint reactivation failed, cannot transfer data.", "fatal", no_email=args.no_mail)
+				exit_gracefully()
+			elif activation_status == "reactivated":
+				print_to_log(fd_id+" Endpoint succesfully reactivated, proceeding with transfer.")
+			elif activation_status == "active":
+				print_to_log(fd_id+" GLBRC endpoint active, proceeding with transfer.")
+			
+			if batched == True:
+				batches[globus_stage_endpoint].append((fd_id, globus_stage_path, candidate["destination"], candidate["reason"]))
+				continue
+			
+			#Launch the transfer via GLOBUS
+			transfer_label = "GLBRC JGI Data Sync "+time_now()
+			transfer_label = transfer_label.replace(":","_").replace(".","_").replace("-","_").replace(" ","_")
+			transfer_source = globus_stage_endpoint+":"+globus_stage_path
+			transfer_destination = glbrc_destination_endpoint+":"+candidate["destination"]
+			task3_json = globus_session.submit_transfer(globus_stage_endpoint, globus_stage_path, glbrc_destination_endpoint, candidate["destination"], transfer_label, date_now(add_days=7), recursive=True)
+			if task3_json["code"] != "Accepted":
+				print_to_log(fd_id+" Transfer request failed. Transfer params:\n"+transfer_source+" -> "+transfer_destination+"\n"+json.dumps(task3_json), "fatal", no_email=args.no_mail)
+				exit_gracefully()
+			elif task3_json["code"] == "Accepted":
+				globus_transfer_task_id = task3_json["task_id"]
+				if "reason" in candidate:
+					print_to_log(fd_id+" Transfer succesfully submitted ("+candidate["reason"]+"). Transfer ID: "+globus_transfer_task_id)
+					metrics.inc("xfer_admissions_total", decision="admitted")
+				else:
+					print_to_log(fd_id+" Transfer succesfully submitted. Transfer ID: "+globus_transfer_task_id)
+				sync_status = "Downloading"
+				index += 1
+				if force_jgi_stage_url == "" or args.force_db == True:
+					sync_requests.transition(fd_id, sync_status_old, sync_status, globus_transfer_task_id=globus_transfer_task_id, globus_transfer_task_label=transfer_label)
+					#Written right away, a submission lost to a later error would be submitted again next cycle
+					sync_requests.flush()
+				elif force_jgi_stage_url != "" or args.force_db == True:
+					if sync_requests != None:
+						sync_requests.flush()
+					return globus_transfer_task_id			
+		
+		for globus_stage_endpoint, batch in batches.items():
+			for batch_start in range(0, len(batch), xfer_batch_size):
+				if index >= task_limit:
+					print_to_log("Globus concurrent transfer task limit reached. Better luck next cycle.", "error", no_email=args.no_mail)
+					sync_requests.flush()
+					return
+				batch_items = batch[batch_start:batch_start+xfer_batch_size]
+				batch_fd_ids = [item[0] for item in batch_items]
+				
+				#Launch the batched transfer via GLOBUS, every deliverable gets its own source -> destination pair
+				transfer_label = "GLBRC JGI Data Sync "+time_now()+" batch "+str(index)
+				transfer_label = transfer_label.replace(":","_").replace(".","_").replace("-","_").replace(" ","_")
+				task3_json = globus_session.submit_batch_transfer(globus_stage_endpoint, glbrc_destination_endpoint, [(stage_path, destination_path, True) for fd_id, stage_path, destination_path, reason in batch_items], transfer_label, date_now(add_days=7))
+				if task3_json["code"] != "Accepted":
+					print_to_log(" ".join(batch_fd_ids)+" Batched transfer request failed. Transfer params:\n"+"\n".join([globus_stage_endpoint+":"+stage_path+" -> "+glbrc_destination_endpoint+":"+destination_path for fd_id, stage_path, destination_path, reason in batch_items])+"\n"+json.dumps(task3_json), "fatal", no_email=args.no_mail)
+					exit_gracefully()
+				globus_transfer_task_id = task3_json["task_id"]
+				index += 1
+				sync_status = "Downloading"
+				for fd_id, stage_path, destination_path, reason in batch_items:
+					print_to_log(fd_id+" Transfer succesfully submitted in a batch of "+str(len(batch_fd_ids))+" ("+reason+"). Transfer ID: "+globus_transfer_task_id)
+					metrics.inc("xfer_admissions_total", decision="admitted")
+					sync_requests.transition(fd_id, sync_status_old, sync_status, globus_transfer_task_id=globus_transfer_task_id, globus_transfer_task_label=transfer_label)
+				sync_requests.flush()
+		if sync_requests != None:
+			sync_requests.flush()
 	else:
 		print_to_log("No FD_IDs currently with the \"Staging\" status to process.")
 		
 def post (force_fd_id, force_sample_id, force_experiment_id, force_globus_transfer_task_id):
 	globus_transfer_task_ids = []
+	globus_stage_paths = []
 	fd_ids = []
 	sync_status = ""
 	sync_status_old = "Downloading"
@@ -311,68 +501,93 @@ def post (force_fd_id, force_sample_id, force_experiment_id, force_globus_transf
 		fd_ids.append(force_fd_id)
 	if force_globus_transfer_task_id != "":
 		globus_transfer_task_ids.append(force_globus_transfer_task_id)
+		globus_stage_paths.append("")
 	if force_fd_id == "-1" and force_globus_transfer_task_id == "":
-		cur.execute("SELECT fd_id, globus_transfer_task_id FROM sync_requests WHERE status = :1", (sync_status_old,))
-		rows = cur.fetchall()
-		for row in rows:
-			fd_id = row[0]
-			fd_ids.append(fd_id)
-			globus_transfer_task_id = row[1]
-			globus_transfer_task_ids.append(globus_transfer_task_id)
+		for row in sync_requests.claim(sync_status_old, ["fd_id", "globus_transfer_task_id", "globus_stage_path"]):
+			fd_ids.append(row["fd_id"])
+			globus_transfer_task_ids.append(row["globus_transfer_task_id"])
+			globus_stage_paths.append(row["globus_stage_path"] or "")
 	
+	#Batched transfers share one Globus task between several FD_IDs, so task lookups are done once per task.
+	#The status of every outstanding task comes from one bulk lookup in the transfer tracker, which caches
+	#finished tasks and only re-checks running ones once their poll interval is up.
+	#The successful transfer listing of a task is streamed into the ingest pipeline as it is parsed, only the
+	#listings of batched tasks that several FD_IDs filter are kept in memory.
+	shared_task_ids = set(task_id for task_id in globus_transfer_task_ids if globus_transfer_task_ids.count(task_id) > 1)
+	successful_transfers_cache = {}
+	task_statuses = {}
+	if len(globus_transfer_task_ids) >= 1:
+		try:
+			task_statuses = transfer_tracker.poll(globus_transfer_task_ids, force=(force_globus_transfer_task_id != "" or force_fd_id != "-1"))
+		except ValueError as e:
+			print_to_log("Could not look up the status of the Globus download tasks. "+str(e)+" Will retry on the next cycle.", "error", no_email=args.no_mail)
+			return
+	#Sample IDs and Data Catalog details of every deliverable ready to post are resolved before any file is
+	#ingested: the sample IDs with one query, then the details requests concurrently into a per-run cache
+	ready_fd_ids = []
+	for fd_id, globus_transfer_task_id in zip(fd_ids, globus_transfer_task_ids):
+		if globus_transfer_task_id in task_statuses and task_statuses[globus_transfer_task_id]["task"]["status"] == "SUCCEEDED" and task_statuses[globus_transfer_task_id]["task"]["history_deleted"] == False:
+			ready_fd_ids.append(fd_id)
+	prefetched_sample_ids = {}
+	metadata = {}
+	if len(ready_fd_ids) >= 1:
+		if sync_requests != None and args.force_sample_ids == [] and force_sample_id == "-1" and force_experiment_id == "-1":
+			prefetched_sample_ids = sync_requests.sample_ids(ready_fd_ids)
+		metadata_keys = []
+		for fd_id in ready_fd_ids:
+			sids, experiment_id, error = resolve_samples(fd_id, force_sample_id, force_experiment_id, prefetched_sample_ids)
+			if error == "" and metadata_key(sids, experiment_id) != None:
+				metadata_keys.append(metadata_key(sids, experiment_id))
+		metadata = prefetch_metadata(metadata_keys)
 	if len(fd_ids) >= 1 and len(globus_transfer_task_ids) >= 1:
-		for fd_id, globus_transfer_task_id in zip(fd_ids, globus_transfer_task_ids):
+		for fd_id, globus_transfer_task_id, globus_stage_path in zip(fd_ids, globus_transfer_task_ids, globus_stage_paths):
 			#Check status of the GLOBUS transfers. If downloading successful, go through the list
 			#of transferred files and post them into Data Catalog and move to the target location
-			child1 = pexpect.spawn(globus_bin, ["task","show","--format","json",globus_transfer_task_id], encoding='utf-8')
-			child1_out = child1.read()
-			child1_json = json.loads(child1_out)
+			if globus_transfer_task_id not in task_statuses:
+				print_to_log(fd_id+" Globus download task "+str(globus_transfer_task_id)+" returned unknown status.", "error", no_email=args.no_mail)
+				continue
+			child1_json = task_statuses[globus_transfer_task_id]["task"]
+			task_newly_finished = task_statuses[globus_transfer_task_id]["new"]
 			if child1_json["status"] == "SUCCEEDED":
 				print_to_log(fd_id+" All files successfully downloaded. Posting to Data Catalog.")
 				
-				globus_task_check = pexpect.spawn(globus_bin, ["task","show","--format","json", globus_transfer_task_id], encoding='utf-8')
-				globus_task_check_out = globus_task_check.read()
-				globus_task_check_out_json = json.loads(globus_task_check_out)
+				globus_task_check_out_json = child1_json
 				if globus_task_check_out_json["history_deleted"] == True:
 					print_to_log(fd_id+" Detailed history of the Globus transfer task was deleted, cannot proceed with post, aborting the current FD_ID and changing its status to 'New', for re-staging.", "error", no_email=args.no_mail)
 					sync_status = "New"
-					if cur != None and con != None:
-						cur.execute("UPDATE sync_requests SET status = :1, sync_timestamp = :2, updated_at = :3 WHERE fd_id = :4 AND status = :5", (sync_status, time_now(), time_now(), fd_id, sync_status_old))
-						con.commit()
+					if sync_requests != None:
+						sync_requests.transition(fd_id, sync_status_old, sync_status)
 					continue
 				
-				child2 = pexpect.spawn(globus_bin, ["task","show","--format","json","--successful-transfers", globus_transfer_task_id], encoding='utf-8')
-				child2_out = child2.read()
-				child2_json_files = json.loads(child2_out)
+				if globus_transfer_task_id in shared_task_ids:
+					if globus_transfer_task_id not in successful_transfers_cache:
+						try:
+							successful_transfers_cache[globus_transfer_task_id] = list(transfer_backend.iter_successful_transfers(globus_transfer_task_id))
+						except ValueError as e:
+							print_to_log(fd_id+" Could not read the successful transfers of Globus task "+str(globus_transfer_task_id)+". "+str(e)+" Will retry on the next cycle.", "error", no_email=args.no_mail)
+							continue
+					transferred_files = successful_transfers_cache[globus_transfer_task_id]
+				else:
+					transferred_files = transfer_backend.iter_successful_transfers(globus_transfer_task_id)
+				#Only the files under this deliverable's destination directory belong to it (matters for batched tasks)
+				destination_prefix = ""
+				if globus_stage_path != "":
+					destination_prefix = os.path.normpath(tmp_path+"/"+globus_stage_path.split("/")[3])+"/"
 				child2_json_files_posted = defaultdict(bool)
 				child2_json_files_moved = defaultdict(bool)
 				child2_json_files_replaced = defaultdict(bool)
 				
 				sample_id = ""
-				experiment_id = ""
 				existing_files = []
 				existing_files_full = defaultdict(str)
-				sids = []
 				
-				if args.force_sample_ids != []:
-					sids = args.force_sample_ids
-				elif force_sample_id != "-1" and force_experiment_id != "-1":
-					print_to_log(fd_id+" Both sample_id and experiment_id provided, both cannot be specified at the same time, aborting the current FD_ID.", "error", no_email=args.no_mail)
+				sids, experiment_id, error = resolve_samples(fd_id, force_sample_id, force_experiment_id, prefetched_sample_ids)
+				if error != "":
+					print_to_log(fd_id+" "+error, "error", no_email=args.no_mail)
 					continue
-				elif force_sample_id != "-1" and force_experiment_id == "-1":
-					sids.append(force_sample_id)
-				elif force_sample_id == "-1" and force_experiment_id != "-1":
-					experiment_id = force_experiment_id
-				elif force_sample_id == "-1" and force_experiment_id == "-1":
-					if cur != None and con != None:
-						cur.execute("SELECT fd.fd_id, s.sample_id FROM final_deliverables fd, samples s WHERE s.final_deliverable_id = fd.id AND fd.fd_id = :1", (fd_id,))
-						rows = cur.fetchall()
-						for row in rows:
-							sid = row[1]
-							sids.append(str(sid))
-						if sids == []:
-							print_to_log(fd_id+" No samples associated with current FD_ID in the database. Aborting the current FD_ID.", "error", no_email=args.no_mail)
-							continue
+				details_key = metadata_key(sids, experiment_id)
+				if details_key != None and details_key not in metadata:
+					metadata[details_key] = fetch_metadata(details_key)
 	
 				if args.debug == True:
 					print(str(" ".join(["\nsids"]+sids+["\n"])))
@@ -382,13 +597,12 @@ def post (force_fd_id, force_sample_id, force_experiment_id, force_globus_transf
 					print_to_log(fd_id+" No sample IDs or experiment_id to process. Aborting the current FD_ID.", "error", no_email=args.no_mail)
 					continue	
 				elif experiment_id != "" and sids == []:
-					experiment_details = get_experiment_details(sample_barcodes=sids, experiment_id=experiment_id)
+					experiment_details = metadata[details_key]
 					if experiment_details.status_code != 200:
 						print_to_log(fd_id+" Experiment details request for ID "+experiment_id+" failed or data absent from Data Catalog, aborting the current FD_ID. Intervention required. \n"+experiment_details.text, "error", no_email=args.no_mail)
 						sync_status = "Intervention"
-						if cur != None and con != None:
-							cur.execute("UPDATE sync_requests SET status = :1, sync_timestamp = :2, updated_at = :3 WHERE fd_id = :4 AND status = :5", (sync_status, time_now(), time_now(), fd_id, sync_status_old))
-							con.commit()
+						if sync_requests != None:
+							sync_requests.transition(fd_id, sync_status_old, sync_status)
 						continue
 					else:	
 						experiment_details_json = experiment_details.json()
@@ -401,19 +615,17 @@ def post (force_fd_id, force_sample_id, force_experiment_id, force_globus_transf
 						else:
 							print_to_log(fd_id+" Experiment details request for ID "+experiment_id+" failed or data absent from Data Catalog, aborting the current FD_ID. Intervention required. \n"+experiment_details.text, "error", no_email=args.no_mail)
 							sync_status = "Intervention"
-							if cur != None and con != None:
-								cur.execute("UPDATE sync_requests SET status = :1, sync_timestamp = :2, updated_at = :3 WHERE fd_id = :4 AND status = :5", (sync_status, time_now(), time_now(), fd_id, sync_status_old))
-								con.commit()
+							if sync_requests != None:
+								sync_requests.transition(fd_id, sync_status_old, sync_status)
 							continue
 				elif experiment_id == "" and len(sids) == 1:
 					sample_id = str(sids[0])
-					sample_details = get_sample_details(sample_id)
+					sample_details = metadata[details_key]
 					if sample_details.status_code != 200:
 						print_to_log(fd_id+" Sample details request for ID "+sample_id+" failed or data absent from Data Catalog, aborting the current FD_ID. Intervention required.\n"+sample_details.text, "error", no_email=args.no_mail)
 						sync_status = "Intervention"
-						if cur != None and con != None:
-							cur.execute("UPDATE sync_requests SET status = :1, sync_timestamp = :2, updated_at = :3 WHERE fd_id = :4 AND status = :5", (sync_status, time_now(), time_now(), fd_id, sync_status_old))
-							con.commit()
+						if sync_requests != None:
+							sync_requests.transition(fd_id, sync_status_old, sync_status)
 						continue
 					else:
 						sample_details_json = sample_details.json()
@@ -425,21 +637,19 @@ def post (force_fd_id, force_sample_id, force_experiment_id, force_globus_transf
 							else:
 								print_to_log(fd_id+" Sample "+sample_id+" request error, aborting the current FD_ID. "+sample_details.text, "error", no_email=args.no_mail)
 							sync_status = "Intervention"
-							if cur != None and con != None:
-								cur.execute("UPDATE sync_requests SET status = :1, sync_timestamp = :2, updated_at = :3 WHERE fd_id = :4 AND status = :5", (sync_status, time_now(), time_now(), fd_id, sync_status_old))
-								con.commit()
+							if sync_requests != None:
+								sync_requests.transition(fd_id, sync_status_old, sync_status)
 							continue
 						elif len(sample_details_json["files"]) >= 1 and len(sample_details_json["files"]["subpaths"]) >= 1 and len(sample_details_json["files"]["fullpaths"]) >= 1:
 							existing_files = sample_details_json["files"]["subpaths"]					
 							existing_files_full = sample_details_json["files"]["fullpaths"]
 				elif experiment_id == "" and len(sids) > 1:
-					experiment_details = get_experiment_details(sample_barcodes=sids, experiment_id=experiment_id)
+					experiment_details = metadata[details_key]
 					if experiment_details.status_code != 200:
 						print_to_log(fd_id+" Experiment details request for sample IDs "+",".join(sids)+" failed or data absent from Data Catalog, aborting the current FD_ID. Intervention required.\n"+experiment_details.text, "error", no_email=args.no_mail)
 						sync_status = "Intervention"
-						if cur != None and con != None:
-							cur.execute("UPDATE sync_requests SET status = :1, sync_timestamp = :2, updated_at = :3 WHERE fd_id = :4 AND status = :5", (sync_status, time_now(), time_now(), fd_id, sync_status_old))
-							con.commit()
+						if sync_requests != None:
+							sync_requests.transition(fd_id, sync_status_old, sync_status)
 						continue
 					else:
 						experiment_details_json = experiment_details.json()
@@ -451,9 +661,8 @@ def post (force_fd_id, force_sample_id, force_experiment_id, force_globus_transf
 							else:
 								print_to_log(fd_id+" Experiment details request error for sample IDs "+",".join(sids)+" aborting the current FD_ID.\n"+experiment_details.text, "error", no_email=args.no_mail)
 							sync_status = "Intervention"
-							if cur != None and con != None:
-								cur.execute("UPDATE sync_requests SET status = :1, sync_timestamp = :2, updated_at = :3 WHERE fd_id = :4 AND status = :5", (sync_status, time_now(), time_now(), fd_id, sync_status_old))
-								con.commit()
+							if sync_requests != None:
+								sync_requests.transition(fd_id, sync_status_old, sync_status)
 							continue
 						if "id" in experiment_details_json:
 							experiment_id = str(experiment_details_json["id"])
@@ -463,9 +672,8 @@ def post (force_fd_id, force_sample_id, force_experiment_id, force_globus_transf
 						else:
 							print_to_log(fd_id+" Sample IDs "+",".join(sids)+" associated with more than one experiment in Data Catalog. Aborting the current FD_ID. \n"+experiment_details.text, "error", no_email=args.no_mail)
 							sync_status = "Intervention"
-							if cur != None and con != None:
-								cur.execute("UPDATE sync_requests SET status = :1, sync_timestamp = :2, updated_at = :3 WHERE fd_id = :4 AND status = :5", (sync_status, time_now(), time_now(), fd_id, sync_status_old))
-								con.commit()
+							if sync_requests != None:
+								sync_requests.transition(fd_id, sync_status_old, sync_status)
 							continue
 				if args.debug == True:
 					print(str(" ".join(["\nExisting files"]+existing_files+["\n"])))
@@ -478,94 +686,69 @@ def post (force_fd_id, force_sample_id, force_experiment_id, force_globus_transf
 						print_to_log(fd_id+" Posting files to sample "+sample_id+".")
 					elif experiment_id != "":
 						print_to_log(fd_id+" Posting files to experiment "+experiment_id+".")
-					for f in child2_json_files["DATA"]:
-						if f["DATA_TYPE"] == "successful_transfer":
-							already_exists = False
-							santizing_regex = re.compile(r"[^A-Za-z0-9._\/\-]")
-							local_file_path = f["destination_path"]
-							if os.path.exists(local_file_path) == False:
-								print_to_log(fd_id+" File does not exist, skipping! "+local_file_path)
-								continue
-							local_file_path_decoded = urllib.parse.unquote(local_file_path)
-							#local_file_path_decoded_and_sanitized = santizing_regex.sub("_",local_file_path_decoded)
-							
-							path_to_post = local_file_path.replace(tmp_path,"")
-							path_to_post_decoded = urllib.parse.unquote(path_to_post)
-							path_to_post_decoded_and_sanitized = santizing_regex.sub("_",path_to_post_decoded)
-							path_to_post_decoded_and_sanitized_noleadslash = path_to_post_decoded_and_sanitized
-							if path_to_post_decoded_and_sanitized[0] == "/":
-								path_to_post_decoded_and_sanitized_noleadslash = path_to_post_decoded_and_sanitized[1:]
-							
-							for i,ef in enumerate(existing_files):
-								if ef == path_to_post_decoded_and_sanitized_noleadslash:
-									child2_json_files_replaced[local_file_path] = False
-									ef_full = existing_files_full[i]
-									minio_path = base_minio_path+"/"+ef_full
-									print_to_log(fd_id+" File already present in the Data Catalog. Overwriting. "+ef)
-									if os.path.exists(minio_path) == False:
-										os.makedirs(os.path.dirname(minio_path))
-									if args.copy == True:
-										copyfile(local_file_path_decoded, minio_path)
-									else:
-										move(local_file_path_decoded, minio_path)
-									if sample_id == "":
-										print_to_log(fd_id+" File Moved (experiment_id: "+experiment_id+") FROM "+local_file_path+" TO "+minio_path)
-									elif experiment_id == "":
-										print_to_log(fd_id+" File Moved (sample_id: "+sample_id+") FROM "+local_file_path+" TO "+minio_path)
-									child2_json_files_replaced[local_file_path] = True
-									already_exists = True
-									break
-							if already_exists == False:
-								child2_json_files_posted[local_file_path] = False
-								child2_json_files_moved[local_file_path] = False
-								
-								r = None
-								r = post_file(path_to_post_decoded_and_sanitized, sample_barcode=sample_id, experiment_id=experiment_id)
-								if int(r.status_code) != 200:
-									print_to_log(fd_id+" Error posting file to Data Catalog. "+path_to_post_decoded_and_sanitized+"\n"+r.text, "error", no_email=args.no_mail)
-									break
-								
-								if args.no_move == True:
-									continue
-								r = r.json()
-								if r["message"] == "Successfully uploaded datafile":
-									minio_path = base_minio_path+"/"+r["path"]
-									if sample_id == "":
-										print_to_log(fd_id+" File Posted (experiment_id: "+experiment_id+") "+local_file_path)
-									elif experiment_id == "":
-										print_to_log(fd_id+" File Posted (sample_id: "+sample_id+") "+local_file_path)
-									child2_json_files_posted[local_file_path] = True
-									size_orig = os.stat(local_file_path_decoded).st_size
-									if args.copy == True:
-										copyfile(local_file_path_decoded, minio_path)
-									else:
-										move(local_file_path_decoded, minio_path)
-									size_target = os.stat(minio_path).st_size
-									if size_orig == size_target:
-										if sample_id == "":
-											print_to_log(fd_id+" File Moved (experiment_id: "+experiment_id+") FROM "+local_file_path+" TO "+minio_path)
-										elif experiment_id == "":
-											print_to_log(fd_id+" File Moved (sample_id: "+sample_id+") FROM "+local_file_path+" TO "+minio_path)
-										child2_json_files_moved[local_file_path] = True
-									else:
-										print_to_log(fd_id+" Error moving file to Data Catalog. "+path_to_post, "error", no_email=args.no_mail)
+					#Files go through the ingest pipeline: catalog posts and moves into MinIO storage run on
+					#separate pools, every file gets its own result record
+					pipeline = IngestPipeline(
+						lambda items: ingest_post(items, fd_id, sample_id, experiment_id),
+						lambda item, target_path: ingest_place(item, target_path, fd_id, sample_id, experiment_id),
+						post_workers=ingest_post_workers, move_workers=ingest_move_workers, max_pending=ingest_max_pending, retries=ingest_retries, move=(args.no_move == False), batch_size=dc_bulk_batch_size)
+					existing_files_index = index_existing_files(existing_files, existing_files_full)
+					ledger_entries = ingest_ledger.load(globus_transfer_task_id)
+					listed = {"files": 0}
+					try:
+						results = pipeline.run(ingest_items(fd_id, globus_transfer_task_id, transferred_files, destination_prefix, existing_files_index, ledger_entries, listed))
+					except ValueError as e:
+						#The files ingested before the listing broke off are in the ledger, the next cycle resumes from there
+						print_to_log(fd_id+" Could not read the successful transfers of Globus task "+str(globus_transfer_task_id)+". "+str(e)+" Will retry on the next cycle.", "error", no_email=args.no_mail)
+						continue
+					#Checksums computed while placing the files are stored with their datafiles in one request
+					checksums = [(catalog_path(result["target_path"]), result["checksum"]) for result in results if result.get("checksum", "") != ""]
+					if len(checksums) >= 1:
+						checksums_ok, checksums_message = dc_checksum_recorder.record(checksums, placement_checksum)
+						if checksums_ok == False:
+							print_to_log(fd_id+" "+checksums_message, "warn")
+					for result in results:
+						metrics.inc("ingest_files_total", action=result["action"], outcome="failed" if result["error"] != "" else "ok")
+						if result["action"] == "replace":
+							child2_json_files_replaced[result["local_file_path"]] = result["moved"]
+						else:
+							child2_json_files_posted[result["local_file_path"]] = result["posted"]
+							child2_json_files_moved[result["local_file_path"]] = result["moved"]
+						if result["error"] != "":
+							print_to_log(fd_id+" Failed to ingest "+result["local_file_path"]+" after "+str(result["attempts"])+" attempt(s). "+result["error"], "warn")
 								
-					if sum(child2_json_files_posted.values()) == len(child2_json_files_posted) and sum(child2_json_files_moved.values()) == len(child2_json_files_moved):
+					if len([result for result in results if result.get("intervention") == True]) >= 1:
+						print_to_log(fd_id+" "+str(len([result for result in results if result.get("intervention") == True]))+" file(s) cannot be placed safely, their source is gone and the target in MinIO storage is not the expected file. Intervention required.", "error", no_email=args.no_mail)
+						sync_status = "Intervention"
+						if force_globus_transfer_task_id == "" or args.force_db == True:
+							sync_requests.transition(fd_id, sync_status_old, sync_status)
+					elif listed["files"] == 0:
+						#A finished task that moved nothing for this deliverable, there is nothing to post
+						print_to_log(fd_id+" Globus task "+str(globus_transfer_task_id)+" succeeded but lists no transferred files for this FD_ID. Intervention required.", "error", no_email=args.no_mail)
+						sync_status = "Intervention"
+						if force_globus_transfer_task_id == "" or args.force_db == True:
+							sync_requests.transition(fd_id, sync_status_old, sync_status)
+					elif sum(child2_json_files_posted.values()) == len(child2_json_files_posted) and sum(child2_json_files_moved.values()) == len(child2_json_files_moved) and sum(child2_json_files_replaced.values()) == len(child2_json_files_replaced):
 						print_to_log(fd_id+" "+str(len(child2_json_files_posted))+" new file(s) and "+str(len(child2_json_files_replaced))+" replaced file(s) successfully posted and moved to the Data Catalog.")
 						sync_status = "Posted and Moved"
 						if force_globus_transfer_task_id == "" or args.force_db == True:
-							cur.execute("UPDATE sync_requests SET status = :1, sync_timestamp = :2, updated_at = :3 WHERE fd_id = :4 AND status = :5", (sync_status, time_now(), time_now(), fd_id, sync_status_old))
-							con.commit()
+							sync_requests.transition(fd_id, sync_status_old, sync_status)
 					else:
-						print_to_log(fd_id+" Error posting or moving some of the files to Data Catalog. Will retry on the next cycle.", "error", no_email=args.no_mail)
+						print_to_log(fd_id+" Error posting or moving "+str(len([r for r in results if r["error"] != ""]))+" of "+str(len(results))+" file(s) to Data Catalog. Will retry on the next cycle.", "error", no_email=args.no_mail)
 			elif child1_json["status"] == "ACTIVE":
 				print_to_log(fd_id+" Download still in progress")
 			elif child1_json["status"] == "FAILED":
-				print_to_log(fd_id+" Globus download task "+globus_transfer_task_id+" failed.", "error", no_email=args.no_mail)
+				#Only notify when the failure is first seen, not on every cycle after that
+				if task_newly_finished == True:
+					print_to_log(fd_id+" Globus download task "+globus_transfer_task_id+" failed.", "error", no_email=args.no_mail)
+				else:
+					print_to_log(fd_id+" Globus download task "+globus_transfer_task_id+" failed.", "warn")
 			elif child1_json["status"] == "INACTIVE":
 				print_to_log(fd_id+" Globus download task "+globus_transfer_task_id+" inactive.", "warn")
 			else:
 				print_to_log(fd_id+" Globus download task "+globus_transfer_task_id+" returned unknown status.", "error", no_email=args.no_mail)
+		if sync_requests != None:
+			sync_requests.flush()
 	else:
 		print_to_log("No FD_IDs currently with the \"Downloading\" status to process.")
 		
@@ -589,30 +772,36 @@ parser.add_argument("--no_oracle", default=False, action="store_true", help="")
 parser.add_argument("--dry_post", default=False, action="store_true", help="")
 parser.add_argument("--copy", default=False, action="store_true", help="")
 parser.add_argument("--print_url", default=False, action="store_true", help="")
+parser.add_argument("--batch_xfer", default=False, action="store_true", help="Submit staged deliverables sharing a stage endpoint as one Globus transfer task")
+parser.add_argument("--daemon", default=False, action="store_true", help="Keep running and do stage, xfer and post on their own intervals (daemon_intervals in the config)")
+parser.add_argument("--pipeline", default=False, action="store_true", help="Run stage, xfer and post side by side, handing each deliverable on as soon as its status changes (pipeline_intervals in the config). Stops once nothing is in flight unless --daemon is given too")
+parser.add_argument("--workers", default=None, type=int, help="Number of concurrent JGI staging requests (overrides stage_workers in the config)")
 args = parser.parse_args()
 urllib3.disable_warnings()
 
-#Check for a pidfile, to prevent simultaneous runs. 
-#If it's there and the PID is currently running - exit
-#If it's there and the PID is not running - store a new one and proceed
-	
-if os.path.exists("/tmp/jgi_transfer_tasks.pid") == True:
-	local_pid = 0
-	with open("/tmp/jgi_transfer_tasks.pid") as pf:
-		for l in pf:
-			local_pid = str(l.strip())
-	pids = [pid for pid in os.listdir('/proc') if pid.isdigit()]
-	if local_pid in pids:
-		print_to_log("Another jgi_transfer_tasks.py task already running (PID "+str(local_pid)+").", "warn")
-		exit()
+def take_lockfile():
+	#Check for a pidfile, to prevent simultaneous runs. 
+	#If it's there and the PID is currently running - exit
+	#If it's there and the PID is not running - store a new one and proceed
+	global lockfile_held
+	if os.path.exists("/tmp/jgi_transfer_tasks.pid") == True:
+		local_pid = 0
+		with open("/tmp/jgi_transfer_tasks.pid") as pf:
+			for l in pf:
+				local_pid = str(l.strip())
+		pids = [pid for pid in os.listdir('/proc') if pid.isdigit()]
+		if local_pid in pids:
+			print_to_log("Another jgi_transfer_tasks.py task already running (PID "+str(local_pid)+").", "warn")
+			exit()
+		else:
+			print_to_log("Another jgi_transfer_tasks.py task likely crashed (PID "+local_pid+"). Replacing lockfile with current PID "+str(os.getpid())+" and proceeding with the current run.", "error", no_email=args.no_mail)
+			with open("/tmp/jgi_transfer_tasks.pid", "w") as pf:
+				pf.write(str(os.getpid()))
 	else:
-		print_to_log("Another jgi_transfer_tasks.py task likely crashed (PID "+local_pid+"). Replacing lockfile with current PID "+str(os.getpid())+" and proceeding with the current run.", "error", no_email=args.no_mail)
 		with open("/tmp/jgi_transfer_tasks.pid", "w") as pf:
 			pf.write(str(os.getpid()))
-else:
-	with open("/tmp/jgi_transfer_tasks.pid", "w") as pf:
-		pf.write(str(os.getpid()))
-	print_to_log("Creating a new lockfile with current PID "+str(os.getpid())+" and proceeding with the current run.")
+		print_to_log("Creating a new lockfile with current PID "+str(os.getpid())+" and proceeding with the current run.")
+	lockfile_held = True
 
 jgi_u = ""
 jgi_pw = ""
@@ -623,6 +812,64 @@ globus_bin = ""
 tmp_path = ""
 base_minio_path = ""
 base_dc_url = ""
+globus_transfer_backend = "cli"
+globus_transfer_api_url = ""
+globus_auth_url = ""
+globus_login_ttl = 3600
+globus_activation_refresh_margin = 3600
+xfer_batch = False
+ingest_post_workers = 4
+ingest_move_workers = 2
+ingest_max_pending = 64
+ingest_retries = 2
+dc_bulk_batch_size = 100
+dc_register_workers = 4
+dc_pool_maxsize = 16
+dc_timeout = 120
+dc_retries = 5
+dc_backoff_factor = 0.5
+xfer_batch_size = 100
+stage_workers = 1
+jgi_rate_limit = 0
+jgi_rate_burst = 1
+daemon_intervals = {"stage": 300, "xfer": 300, "post": 300}
+pipeline_intervals = {"stage": 300, "xfer": 60, "post": 60}
+pipeline_max_runtime = 6*3600
+metrics_json_log = ""
+metrics_textfile = ""
+jgi_signon_ttl = 3600
+jgi_portal_url = "https://genome.jgi.doe.gov/portal"
+jgi_signon_url = "https://signon.jgi.doe.gov/signon/create"
+daemon_running = False
+state_dir = os.path.expanduser("~/.cache/jgi_transfer_tasks")
+transfer_poll_min_interval = 60
+transfer_poll_max_interval = 1800
+ingest_ledger_retention_days = 30
+dc_metadata_workers = 4
+placement_strategy = "auto"
+placement_reflink = False
+placement_chunk_size = 64
+placement_checksum = ""
+placement_checksum_all = False
+placement_verify = False
+dc_checksum_path = "/api/v2/datafiles/checksums"
+db_checkpoint_interval = 30
+oracle_pool_min = 1
+oracle_pool_max = 4
+oracle_pool_increment = 1
+oracle_stmtcachesize = 50
+oracle_arraysize = 500
+oracle_ping_interval = 60
+db_leasing = False
+lease_seconds = 1800
+lease_batch_size = 100
+worker_id = socket.gethostname()+":"+str(os.getpid())
+globus_task_limit = 100
+xfer_policy = "oldest"
+xfer_tmp_reserve_gb = 10
+xfer_max_inflight_gb = 0
+xfer_fair_rate = 100
+xfer_size_retry_interval = 3600
 
 if os.path.exists(args.config) == False:
 	print_to_log('The config file doesn\'t exist or no config file was specified using "--config".', "fatal", no_email=args.no_mail)
@@ -630,11 +877,85 @@ if os.path.exists(args.config) == False:
 #Set up global variables from config
 with open(args.config) as json_config_file:
 	json_config_data = json.load(json_config_file)	
-	globus_bin = json_config_data["globus_bin"]
+	globus_bin = json_config_data.get("globus_bin", globus_bin)
 	glbrc_destination_endpoint = json_config_data["glbrc_destination_endpoint"] 
 	tmp_path = json_config_data["tmp_path"]
 	base_minio_path = json_config_data["base_minio_path"]
 	base_dc_url = json_config_data["base_dc_url"]
+	globus_transfer_backend = json_config_data.get("globus_transfer_backend", globus_transfer_backend)
+	globus_transfer_api_url = json_config_data.get("globus_transfer_api_url", globus_transfer_api_url)
+	globus_auth_url = json_config_data.get("globus_auth_url", globus_auth_url)
+	globus_login_ttl = int(json_config_data.get("globus_login_ttl", globus_login_ttl))
+	globus_activation_refresh_margin = int(json_config_data.get("globus_activation_refresh_margin", globus_activation_refresh_margin))
+	xfer_batch = bool(json_config_data.get("xfer_batch", xfer_batch))
+	xfer_batch_size = max(1, int(json_config_data.get("xfer_batch_size", xfer_batch_size)))
+	ingest_post_workers = int(json_config_data.get("ingest_post_workers", ingest_post_workers))
+	ingest_move_workers = int(json_config_data.get("ingest_move_workers", ingest_move_workers))
+	ingest_max_pending = int(json_config_data.get("ingest_max_pending", ingest_max_pending))
+	ingest_retries = int(json_config_data.get("ingest_retries", ingest_retries))
+	dc_bulk_batch_size = int(json_config_data.get("dc_bulk_batch_size", dc_bulk_batch_size))
+	dc_register_workers = int(json_config_data.get("dc_register_workers", dc_register_workers))
+	dc_pool_maxsize = int(json_config_data.get("dc_pool_maxsize", dc_pool_maxsize))
+	dc_timeout = float(json_config_data.get("dc_timeout", dc_timeout))
+	dc_retries = int(json_config_data.get("dc_retries", dc_retries))
+	dc_backoff_factor = float(json_config_data.get("dc_backoff_factor", dc_backoff_factor))
+	stage_workers = int(json_config_data.get("stage_workers", stage_workers))
+	jgi_rate_limit = float(json_config_data.get("jgi_rate_limit", jgi_rate_limit))
+	jgi_rate_burst = int(json_config_data.get("jgi_rate_burst", jgi_rate_burst))
+	daemon_intervals.update(json_config_data.get("daemon_intervals", {}))
+	pipeline_intervals.update(json_config_data.get("pipeline_intervals", {}))
+	pipeline_max_runtime = int(json_config_data.get("pipeline_max_runtime", pipeline_max_runtime))
+	metrics_json_log = os.path.expanduser(json_config_data.get("metrics_json_log", metrics_json_log))
+	metrics_textfile = os.path.expanduser(json_config_data.get("metrics_textfile", metrics_textfile))
+	#Helpdesk notifications, see HelpdeskNotifier in log.py
+	helpdesk_settings = {"helpdesk_smtp_host": "smtp_host", "helpdesk_smtp_port": "smtp_port", "helpdesk_from": "source", "helpdesk_to": "target", "helpdesk_subject": "subject", "notify_digest_interval": "digest_interval", "notify_max_per_hour": "max_per_hour"}
+	helpdesk.configure(**dict((setting, json_config_data[key]) for key, setting in helpdesk_settings.items() if key in json_config_data))
+	jgi_signon_ttl = int(json_config_data.get("jgi_signon_ttl", jgi_signon_ttl))
+	#Only pointed elsewhere for the offline benchmarks, see benchmarks/bench_end_to_end.py
+	jgi_portal_url = json_config_data.get("jgi_portal_url", jgi_portal_url).rstrip("/")
+	jgi_signon_url = json_config_data.get("jgi_signon_url", jgi_signon_url)
+	state_dir = os.path.expanduser(json_config_data.get("state_dir", state_dir))
+	transfer_poll_min_interval = int(json_config_data.get("transfer_poll_min_interval", transfer_poll_min_interval))
+	transfer_poll_max_interval = int(json_config_data.get("transfer_poll_max_interval", transfer_poll_max_interval))
+	ingest_ledger_retention_days = int(json_config_data.get("ingest_ledger_retention_days", ingest_ledger_retention_days))
+	dc_metadata_workers = int(json_config_data.get("dc_metadata_workers", dc_metadata_workers))
+	placement_strategy = json_config_data.get("placement_strategy", placement_strategy)
+	placement_reflink = json_config_data.get("placement_reflink", placement_reflink)
+	placement_chunk_size = int(json_config_data.get("placement_chunk_size", placement_chunk_size))
+	placement_checksum = json_config_data.get("placement_checksum", placement_checksum)
+	placement_checksum_all = json_config_data.get("placement_checksum_all", placement_checksum_all)
+	placement_verify = json_config_data.get("placement_verify", placement_verify)
+	dc_checksum_path = json_config_data.get("dc_checksum_path", dc_checksum_path)
+	db_checkpoint_interval = int(json_config_data.get("db_checkpoint_interval", db_checkpoint_interval))
+	oracle_pool_min = int(json_config_data.get("oracle_pool_min", oracle_pool_min))
+	oracle_pool_max = int(json_config_data.get("oracle_pool_max", oracle_pool_max))
+	oracle_pool_increment = int(json_config_data.get("oracle_pool_increment", oracle_pool_increment))
+	oracle_stmtcachesize = int(json_config_data.get("oracle_stmtcachesize", oracle_stmtcachesize))
+	oracle_arraysize = int(json_config_data.get("oracle_arraysize", oracle_arraysize))
+	oracle_ping_interval = int(json_config_data.get("oracle_ping_interval", oracle_ping_interval))
+	db_leasing = bool(json_config_data.get("db_leasing", db_leasing))
+	lease_seconds = int(json_config_data.get("lease_seconds", lease_seconds))
+	lease_batch_size = int(json_config_data.get("lease_batch_size", lease_batch_size))
+	worker_id = json_config_data.get("worker_id", worker_id)
+	globus_task_limit = int(json_config_data.get("globus_task_limit", globus_task_limit))
+	xfer_policy = json_config_data.get("xfer_policy", xfer_policy)
+	xfer_tmp_reserve_gb = float(json_config_data.get("xfer_tmp_reserve_gb", xfer_tmp_reserve_gb))
+	xfer_max_inflight_gb = float(json_config_data.get("xfer_max_inflight_gb", xfer_max_inflight_gb))
+	xfer_fair_rate = float(json_config_data.get("xfer_fair_rate", xfer_fair_rate))
+	xfer_size_retry_interval = int(json_config_data.get("xfer_size_retry_interval", xfer_size_retry_interval))
+#--intervention reprocesses the Intervention rows in one run of a phase, the pipeline and the daemon would cycle through them
+if args.intervention == True and (args.pipeline == True or args.daemon == True):
+	print_to_log("--intervention cannot be combined with --pipeline or --daemon, run the phases on their own instead.", "fatal", no_email=args.no_mail)
+	exit_gracefully()
+#With leasing any number of workers can share the queue, otherwise only one run per host is allowed (see CONFIG.md)
+if db_leasing == False or args.no_oracle == True:
+	take_lockfile()
+if args.batch_xfer == True:
+	xfer_batch = True
+if args.workers != None:
+	stage_workers = args.workers
+stage_workers = max(1, stage_workers)
+jgi_rate_limiter = HostRateLimiter(jgi_rate_limit, jgi_rate_burst)
 
 jgi_u = os.environ["JGI_USER"]
 jgi_pw = os.environ["JGI_PW"]
@@ -646,51 +967,269 @@ oracle_pw = os.environ["data_transfer_scripts_PASSWORD"]
 oracle_db_host_primary = os.environ["data_transfer_scripts_DB_HOST_PRIMARY"]
 oracle_db_host_secondary = os.environ["data_transfer_scripts_DB_HOST_SECONDARY"]
 oracle_db_service_name = os.environ["data_transfer_scripts_DB_SERVICE_NAME"]
+#The API backend takes a static access token, or renews its tokens with a refresh token (native app) or
+#a client secret (confidential client), see GlobusTokenAuthorizer in globus_backend.py
+globus_transfer_token = os.environ.get("GLOBUS_TRANSFER_TOKEN", "")
+globus_transfer_refresh_token = os.environ.get("GLOBUS_TRANSFER_REFRESH_TOKEN", "")
+globus_client_id = os.environ.get("GLOBUS_CLIENT_ID", "")
+globus_client_secret = os.environ.get("GLOBUS_CLIENT_SECRET", "")
 
-con = None
-cur = None
-if args.no_oracle == False:
+#Set by SIGTERM/SIGINT or a fatal error, stops the daemon and the pipeline after the phases that are running
+stop = threading.Event()
+
+#The status each phase takes requests from
+phase_statuses = {"stage": "New", "xfer": "Staging", "post": "Downloading"}
+
+#Spans and counters for every external call, phase and placed file, see metrics.py
+metrics = Metrics(json_log_path=metrics_json_log, textfile_path=metrics_textfile)
+atexit.register(metrics.close)
+#The calls of every client that go out to a service, the rest (queued status updates, settings) is not timed
+timed_methods = {
+	"globus": ["task_list", "whoami", "endpoint_is_activated", "endpoint_activate_myproxy", "submit_transfer", "submit_batch_transfer", "path_size", "task_statuses", "iter_successful_transfers"],
+	"oracle": ["count", "fetch", "claim", "renew", "release", "sample_ids", "flush"],
+	"catalog": ["request", "get_sample_details", "get_experiment_details"],
+	"jgi": ["get", "post"],
+}
+
+def catalog_endpoint(method, args, kwargs):
+	#Bulk registrations, single posts and checksum uploads all go through request(), told apart by their path
+	if method != "request":
+		return {}
+	return {"endpoint": str(args[0])+" "+str(args[1])}
+
+def run_phase(name, phase):
+	#One timed run of a phase, the queue depths and the Prometheus textfile are updated after it. The
+	#requests the phase claimed and left in their status go back to the queue for the next worker.
+	try:
+		with metrics.span("phase", phase=name):
+			phase()
+	except GlobusAuthError as e:
+		#No cycle gets through Globus without new credentials, so the daemon and the pipeline stop too
+		print_to_log("Globus rejected the transfer credentials. "+str(e)+" Provide new ones and restart.", "fatal", no_email=args.no_mail)
+		stop.set()
+		exit_gracefully()
+	finally:
+		if sync_requests != None:
+			#The transitions queued before an unexpected error are written too, leasing or not
+			try:
+				sync_requests.flush()
+			except cx_Oracle.DatabaseError as e:
+				print_to_log("Could not write the queued status updates of "+name+": "+str(e), "warn")
+			try:
+				sync_requests.release("Intervention" if args.intervention == True else phase_statuses[name])
+			except cx_Oracle.DatabaseError as e:
+				print_to_log("Could not release the "+name+" leases: "+str(e), "warn")
+			try:
+				for status, count in sync_requests.count(["New", "Staging", "Downloading", "Intervention"]).items():
+					metrics.set("sync_requests", count, status=status)
+			except cx_Oracle.DatabaseError as e:
+				print_to_log("Could not count the sync_requests queue: "+str(e), "warn")
+		metrics.write_textfile()
+
+#Globus operations go through the in-process Transfer API client when configured, the Globus CLI otherwise
+try:
+	transfer_backend = metrics.instrument(get_transfer_backend(globus_transfer_backend, globus_bin=globus_bin, access_token=globus_transfer_token, base_url=globus_transfer_api_url, debug=args.debug, refresh_token=globus_transfer_refresh_token, client_id=globus_client_id, client_secret=globus_client_secret, auth_url=globus_auth_url), "globus", timed_methods["globus"])
+except ValueError as e:
+	print_to_log(str(e), "fatal", no_email=args.no_mail)
+	exit_gracefully()
+try:
+	file_placer = FilePlacer(placement_strategy, reflink=placement_reflink, chunk_size=placement_chunk_size*1024*1024, checksum=placement_checksum, checksum_all=placement_checksum_all, verify=placement_verify)
+except ValueError as e:
+	print_to_log(str(e), "fatal", no_email=args.no_mail)
+	exit_gracefully()
+#Which staged deliverables xfer() submits and in which order, see scheduler.py. xfer_fair_rate is in MB/s.
+try:
+	transfer_scheduler = TransferScheduler(tmp_path, policy=xfer_policy, state_path=os.path.join(state_dir, "transfer_scheduler.json"), reserve_bytes=xfer_tmp_reserve_gb*1e9, max_inflight_bytes=xfer_max_inflight_gb*1e9, fair_rate=xfer_fair_rate*1e6, size_retry_interval=xfer_size_retry_interval)
+except ValueError as e:
+	print_to_log(str(e), "fatal", no_email=args.no_mail)
+	exit_gracefully()
+#Per-file ingest progress survives crashes and failed cycles, see ledger.py
+ingest_ledger = IngestLedger(os.path.join(state_dir, "ingest_ledger.sqlite"))
+ingest_ledger.purge(older_than_days=ingest_ledger_retention_days)
+transfer_tracker = TransferTracker(transfer_backend, state_path=os.path.join(state_dir, "transfer_tasks.json"), min_interval=transfer_poll_min_interval, max_interval=transfer_poll_max_interval)
+globus_session = GlobusSession(transfer_backend, myproxy_u=globus_myproxy_u, myproxy_pw=globus_myproxy_pw, myproxy_lifetime=168, login_ttl=globus_login_ttl, refresh_margin=globus_activation_refresh_margin)
+
+def connect_oracle():
+	#Sessions come from a pool, see db.py. The pool pings sessions that sat idle before handing them out and
+	#drops the ones lost to a failover, the DSN fails over to the secondary host on its own.
+	global oracle_pool, sync_requests
 	dsnStr = "(DESCRIPTION=(FAILOVER=on)(CONNECT_TIMEOUT=5)(ADDRESS_LIST=(ADDRESS=(PROTOCOL=TCP)(HOST="+oracle_db_host_primary+")(PORT=1521))(ADDRESS=(PROTOCOL=TCP)(HOST="+oracle_db_host_secondary+")(PORT=1521))(LOAD_BALANCE=no))(CONNECT_DATA=(SERVICE_NAME="+oracle_db_service_name+")))"
 	try:
-		con = cx_Oracle.connect(oracle_u,oracle_pw,dsnStr)
+		oracle_pool = create_pool(oracle_u, oracle_pw, dsnStr, min_sessions=oracle_pool_min, max_sessions=oracle_pool_max, increment=oracle_pool_increment, stmtcachesize=oracle_stmtcachesize, ping_interval=oracle_ping_interval)
 	except cx_Oracle.DatabaseError:
 		print_to_log("Error while connecting to the Oracle database!", "fatal", no_email=args.no_mail)
 		exit_gracefully()
-	cur = con.cursor()
-
-#Get Data Catalog authentication token
-dc_api_call_headers = ""
-auth_token = auth_with_dc(args.debug)
-if auth_token == "":
-	print_to_log("Authentication with Data Catalog failed!","fatal", no_email=args.no_mail)
-	exit_gracefully()
-else:
-	dc_api_call_headers = {"Authorization": "Token " + auth_token}
+	sync_requests = metrics.instrument(SyncRequests(oracle_pool, checkpoint_interval=db_checkpoint_interval, arraysize=oracle_arraysize, worker_id=worker_id, lease_seconds=lease_seconds if db_leasing == True else 0, lease_batch_size=lease_batch_size), "oracle", timed_methods["oracle"])
 
+def refresh_dc_token():
+	#Get Data Catalog authentication token, a cached one is reused until shortly before it expires
+	global dc_token_expires
+	auth_token = auth_with_dc(args.debug)
+	if auth_token == "":
+		print_to_log("Authentication with Data Catalog failed!","fatal", no_email=args.no_mail)
+		exit_gracefully()
+	dc_token_expires = dc_token_expires_at(auth_token)
+	dc_client.set_token(auth_token)
 
-if args.stage == True or args.xfer == True:
-	s = requests.session()
+def jgi_signon():
+	global s, jgi_signon_time
+	s = metrics.instrument(requests.session(), "jgi", timed_methods["jgi"])
+	s.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=stage_workers))
 	p0= {"login":jgi_u, "password":jgi_pw}
 	try:
-		resp = s.post("https://signon.jgi.doe.gov/signon/create", timeout=10, params=p0, allow_redirects=True, stream=False)
+		resp = s.post(jgi_signon_url, timeout=10, params=p0, allow_redirects=True, stream=False)
 	except requests.exceptions.Timeout as e:
 		print_to_log("JGI Genome Portal sign-on connection timed out!", "fatal", no_email=args.no_mail)
 		print_to_log(str(e))
 	except requests.exceptions.SSLError:
 		print_to_log("JGI Genome Portal SSL error!","fatal", no_email=args.no_mail)
 		exit_gracefully()
-	if args.stage == True:
-		stage(args.force_fd_id)
-	elif args.xfer == True:
-		xfer(args.force_fd_id, args.force_jgi_stage_url)
+	jgi_signon_time = time.time()
 
-if args.post == True:
-	post(args.force_fd_id, args.force_sample_id, args.force_experiment_id, args.force_globus_transfer_task_id)
+def refresh_credentials(name):
+	#Called before every phase by the daemon and the pipeline, the phase threads of the pipeline share it
+	with credentials_lock:
+		if time.time() > dc_token_expires - 300:
+			refresh_dc_token()
+		if name in ("stage", "xfer") and time.time() - jgi_signon_time > jgi_signon_ttl:
+			jgi_signon()
 
-if cur != None and con != None:
-	con.close()
-if args.stage == False and args.xfer == False and args.post == False:
-	print_to_log('No task specified. Use "--stage", "--xfer" or "--post".', "fatal", no_email=args.no_mail)
+def run_pipeline():
+	#Stage, xfer and post run side by side, each in its own thread. Once a status transition is committed
+	#the deliverable is put on the queue of the phase that takes it from there, which then runs right away
+	#instead of waiting for its interval. Every phase still runs on its own interval (pipeline_intervals) to
+	#pick up what nobody hands over: new requests, JGI staging finishing, Globus transfers completing.
+	#Without --daemon the pipeline stops once no deliverable is New, Staging or Downloading any more, or
+	#after pipeline_max_runtime seconds. SIGTERM/SIGINT stop it after the phases that are running.
+	global daemon_running
+	signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+	signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+	phases = [
+		("stage", lambda: stage("-1")),
+		("xfer", lambda: xfer("-1", "")),
+		("post", lambda: post("-1", "-1", "-1", "")),
+	]
+	handoff = dict((name, queue.Queue()) for name, phase in phases)
+	sync_requests.on_transition("Staging", handoff["xfer"].put)
+	sync_requests.on_transition("Downloading", handoff["post"].put)
+	#A deliverable that failed staging goes back to New
+	sync_requests.on_transition("New", handoff["stage"].put)
 
-exit_gracefully()
+	def phase_loop(name, phase):
+		while stop.is_set() == False:
+			try:
+				refresh_credentials(name)
+				run_phase(name, phase)
+			except CycleAborted:
+				print_to_log("Pipeline "+name+" cycle aborted, retrying in "+str(pipeline_intervals[name])+" s.", "warn")
+			except Exception as e:
+				print_to_log("Pipeline "+name+" cycle failed with "+repr(e)+", retrying in "+str(pipeline_intervals[name])+" s.", "error", no_email=args.no_mail)
+			#The alerts of the cycle go out as one digest
+			helpdesk.flush()
+			#Sleep until a deliverable is handed over or the interval is up, then take everything queued at once
+			deadline = time.time() + int(pipeline_intervals[name])
+			while stop.is_set() == False and time.time() < deadline:
+				try:
+					fd_id = handoff[name].get(timeout=min(1, max(0.01, deadline - time.time())))
+				except queue.Empty:
+					continue
+				handed_over = [fd_id]
+				while handoff[name].empty() == False:
+					handed_over.append(handoff[name].get_nowait())
+				print_to_log("Pipeline "+name+" picking up "+" ".join(str(f) for f in handed_over)+".")
+				break
+
+	daemon_running = True
+	started = time.time()
+	print_to_log("Pipeline started, intervals (s): "+", ".join(name+" "+str(pipeline_intervals[name]) for name, phase in phases)+".")
+	threads = [threading.Thread(target=phase_loop, args=(name, phase), name="pipeline-"+name, daemon=True) for name, phase in phases]
+	for thread in threads:
+		thread.start()
+	while stop.is_set() == False:
+		stop.wait(max(1, min(pipeline_intervals.values())))
+		if args.daemon == True or stop.is_set() == True:
+			continue
+		if time.time() - started > pipeline_max_runtime:
+			print_to_log("Pipeline reached its maximum run time of "+str(pipeline_max_runtime)+" s.", "warn")
+			stop.set()
+		elif sum(sync_requests.count(["New", "Staging", "Downloading"]).values()) == 0:
+			print_to_log("Pipeline has no deliverables left in flight.")
+			stop.set()
+	for thread in threads:
+		thread.join()
+	daemon_running = False
+	print_to_log("Pipeline stopping.")
+
+def run_daemon():
+	#Keep the database session pool, HTTP sessions and tokens warm and run every phase on its own interval.
+	#Credentials are only refreshed once they are about to expire. SIGTERM/SIGINT stop the loop after the current phase.
+	global daemon_running
+	signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+	signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+	phases = [
+		("stage", lambda: stage("-1")),
+		("xfer", lambda: xfer("-1", "")),
+		("post", lambda: post("-1", "-1", "-1", "")),
+	]
+	next_run = dict((name, 0) for name, phase in phases)
+	daemon_running = True
+	print_to_log("Daemon started, intervals (s): "+", ".join(name+" "+str(daemon_intervals[name]) for name, phase in phases)+".")
+	while stop.is_set() == False:
+		for name, phase in phases:
+			if stop.is_set() == True or time.time() < next_run[name]:
+				continue
+			next_run[name] = time.time() + int(daemon_intervals[name])
+			try:
+				refresh_credentials(name)
+				run_phase(name, phase)
+			except CycleAborted:
+				print_to_log("Daemon "+name+" cycle aborted, retrying in "+str(daemon_intervals[name])+" s.", "warn")
+			except Exception as e:
+				print_to_log("Daemon "+name+" cycle failed with "+repr(e)+", retrying in "+str(daemon_intervals[name])+" s.", "error", no_email=args.no_mail)
+			#The alerts of the cycle go out as one digest
+			helpdesk.flush()
+		stop.wait(max(1, min(next_run.values()) - time.time()))
+	daemon_running = False
+	print_to_log("Daemon stopping.")
+
+oracle_pool = None
+if args.no_oracle == False:
+	connect_oracle()
 
+dc_client = metrics.instrument(DataCatalogClient(base_dc_url, "", pool_maxsize=max(dc_pool_maxsize, ingest_post_workers*dc_register_workers), timeout=dc_timeout, retries=dc_retries, backoff_factor=dc_backoff_factor, debug=args.debug), "catalog", timed_methods["catalog"], labels=catalog_endpoint)
+dc_token_expires = 0
+refresh_dc_token()
+dc_registrar = BulkRegistrar(dc_client, batch_size=dc_bulk_batch_size, workers=dc_register_workers)
+dc_checksum_recorder = ChecksumRecorder(dc_client, path=dc_checksum_path)
+
+s = None
+jgi_signon_time = 0
+credentials_lock = threading.Lock()
+if args.pipeline == True:
+	if sync_requests == None:
+		print_to_log("The pipeline needs the Oracle database, it cannot be combined with --no_oracle.", "fatal", no_email=args.no_mail)
+		exit_gracefully()
+	jgi_signon()
+	run_pipeline()
+elif args.daemon == True:
+	jgi_signon()
+	run_daemon()
+else:
+	if args.stage == True or args.xfer == True:
+		jgi_signon()
+		if args.stage == True:
+			run_phase("stage", lambda: stage(args.force_fd_id))
+		elif args.xfer == True:
+			run_phase("xfer", lambda: xfer(args.force_fd_id, args.force_jgi_stage_url))
+
+	if args.post == True:
+		run_phase("post", lambda: post(args.force_fd_id, args.force_sample_id, args.force_experiment_id, args.force_globus_transfer_task_id))
+
+if oracle_pool != None:
+	sync_requests.flush()
+	oracle_pool.close()
+ingest_ledger.close()
+if args.stage == False and args.xfer == False and args.post == False and args.daemon == False and args.pipeline == False:
+	print_to_log('No task specified. Use "--stage", "--xfer", "--post", "--daemon" or "--pipeline".', "fatal", no_email=args.no_mail)
+
+exit_gracefully()
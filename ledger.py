@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+import os, time, sqlite3, threading
+
+class IngestLedger:
+	#Local SQLite journal of per-file ingest progress, keyed by Globus transfer task and destination path.
+	#A file is "posted" once the Data Catalog has registered it (with the MinIO path it got back) and
+	#"moved" once it has been placed and verified, so a retried deliverable skips everything already done.
+	#Moved files also keep the checksum computed while placing them, if checksums are enabled, and every file
+	#the size it had before it was placed.
+	def __init__(self, path):
+		os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+		self.lock = threading.Lock()
+		self.con = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+		self.con.execute("PRAGMA journal_mode=WAL")
+		self.con.execute("PRAGMA synchronous=NORMAL")
+		self.con.execute("CREATE TABLE IF NOT EXISTS ingest_files (task_id TEXT NOT NULL, destination_path TEXT NOT NULL, fd_id TEXT, state TEXT NOT NULL, target_path TEXT, updated_at REAL NOT NULL, checksum TEXT, PRIMARY KEY (task_id, destination_path))")
+		#Ledgers created before checksums and sizes were recorded
+		columns = [row[1] for row in self.con.execute("PRAGMA table_info(ingest_files)")]
+		if "checksum" not in columns:
+			self.con.execute("ALTER TABLE ingest_files ADD COLUMN checksum TEXT")
+		if "size" not in columns:
+			self.con.execute("ALTER TABLE ingest_files ADD COLUMN size INTEGER")
+
+	def load(self, task_id):
+		#{destination_path: (state, target_path)} for one transfer task, read once per deliverable
+		with self.lock:
+			rows = self.con.execute("SELECT destination_path, state, target_path FROM ingest_files WHERE task_id = ?", (task_id,)).fetchall()
+		return dict((row[0], (row[1], row[2])) for row in rows)
+
+	def record(self, task_id, destination_path, fd_id, state, target_path="", checksum="", size=None):
+		with self.lock:
+			self.con.execute("INSERT OR REPLACE INTO ingest_files (task_id, destination_path, fd_id, state, target_path, updated_at, checksum, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (task_id, destination_path, fd_id, state, target_path, time.time(), checksum, size))
+
+	def expected_size(self, task_id, destination_path):
+		#Size of the file before it was placed, None if it was never recorded
+		with self.lock:
+			row = self.con.execute("SELECT size FROM ingest_files WHERE task_id = ? AND destination_path = ?", (task_id, destination_path)).fetchone()
+		if row == None:
+			return None
+		return row[0]
+
+	def purge(self, older_than_days=30):
+		with self.lock:
+			self.con.execute("DELETE FROM ingest_files WHERE updated_at < ?", (time.time() - older_than_days*86400,))
+
+	def close(self):
+		with self.lock:
+			self.con.close()
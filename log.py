@@ -1,14 +1,15 @@
 #!/usr/bin/env python3
 
-import datetime, smtplib
+import datetime, smtplib, threading, queue, atexit, time
 from datetime import timedelta
+from collections import OrderedDict, deque
 
 def time_now():
 	return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-	
+
 def date_now(add_days=0):
 	return (datetime.datetime.now()+timedelta(days=add_days)).strftime("%Y-%m-%d")
-	
+
 def print_to_log(message="", log_level="info", no_email=False):
 	log_level_label = ""
 	if log_level == "info":
@@ -30,13 +31,152 @@ def print_to_log(message="", log_level="info", no_email=False):
 		print(message)
 		exit()
 	print(str(" ".join([time_now(),log_level_label,message])))
-	
+
+class HelpdeskNotifier:
+	#Helpdesk emails are sent from a background thread, so logging an error never waits on SMTP.
+	#Alerts are collected into one digest per cycle: the digest goes out when flush() is called (at the end
+	#of a daemon or pipeline cycle), digest_interval seconds after its first alert, right away for a fatal
+	#alert, and at exit. Identical alerts are listed once with a count, grouped by FD_ID. At most
+	#max_per_hour digests are sent, alerts beyond that are held and go out with the next allowed digest.
+	#One SMTP connection is kept open between digests and closed once it has been idle for smtp_idle seconds.
+	def __init__(self, smtp_host="XXX", smtp_port=25, source="XXX", target=["XXX"], subject="XXX", digest_interval=60, max_per_hour=12, smtp_idle=60, timeout=30):
+		self.smtp_host = smtp_host
+		self.smtp_port = smtp_port
+		self.source = source
+		self.target = target
+		self.subject = subject
+		self.digest_interval = digest_interval
+		self.max_per_hour = max_per_hour
+		self.smtp_idle = smtp_idle
+		self.timeout = timeout
+		self.queue = queue.Queue()
+		self.lock = threading.Lock()
+		self.thread = None
+		self.pending = OrderedDict()
+		self.digest_due = None
+		self.sent_times = deque()
+		self.server = None
+		self.server_used = 0
+
+	def configure(self, **settings):
+		for name, value in settings.items():
+			setattr(self, name, value)
+
+	def _start(self):
+		with self.lock:
+			if self.thread == None or self.thread.is_alive() == False:
+				self.thread = threading.Thread(target=self._run, name="helpdesk-notifier", daemon=True)
+				self.thread.start()
+
+	def notify(self, text, error_level="error"):
+		self._start()
+		self.queue.put(("alert", error_level, text))
+
+	def flush(self):
+		if self.thread != None:
+			self.queue.put(("flush",))
+
+	def close(self, timeout=60):
+		#Sends what is still pending and waits for it (up to timeout seconds)
+		if self.thread != None and self.thread.is_alive() == True:
+			self.queue.put(("close",))
+			self.thread.join(timeout)
+
+	def _run(self):
+		while True:
+			wait = None
+			if self.digest_due != None:
+				wait = max(0, self.digest_due - time.time())
+			elif self.server != None:
+				wait = self.smtp_idle
+			try:
+				event = self.queue.get(timeout=wait)
+			except queue.Empty:
+				event = ("timeout",)
+			if event[0] == "alert":
+				level, text = event[1], event[2]
+				key = (level, text.strip())
+				self.pending[key] = self.pending.get(key, 0) + 1
+				if self.digest_due == None:
+					self.digest_due = time.time() + self.digest_interval
+				if level == "fatal":
+					self.digest_due = time.time()
+			elif event[0] == "flush" and len(self.pending) > 0:
+				self.digest_due = time.time()
+			if event[0] == "close":
+				if len(self.pending) > 0:
+					self._send_digest(force=True)
+				self._disconnect()
+				return
+			if self.digest_due != None and time.time() >= self.digest_due:
+				self._send_digest()
+			if self.server != None and self.digest_due == None and time.time() - self.server_used >= self.smtp_idle:
+				self._disconnect()
+
+	def _send_digest(self, force=False):
+		now = time.time()
+		while len(self.sent_times) > 0 and now - self.sent_times[0] > 3600:
+			self.sent_times.popleft()
+		if force == False and len(self.sent_times) >= self.max_per_hour:
+			#Held back, try again once the oldest digest of the hour has aged out
+			self.digest_due = self.sent_times[0] + 3600
+			return
+		alerts = self.pending
+		self.pending = OrderedDict()
+		self.digest_due = None
+		levels = [level for level, text in alerts.keys()]
+		error_level = "fatal" if "fatal" in levels else "error"
+		by_fd_id = OrderedDict()
+		for (level, text), count in alerts.items():
+			fd_id = text.split(" ", 1)[0] if text.split(" ", 1)[0].isdigit() == True else ""
+			by_fd_id.setdefault(fd_id, []).append("["+level.upper()+"]"+(" (x"+str(count)+")" if count > 1 else "")+" "+text)
+		lines = []
+		for fd_id, entries in by_fd_id.items():
+			lines.append("FD_ID "+fd_id+":" if fd_id != "" else "General:")
+			lines.extend(entries)
+			lines.append("")
+		total = sum(alerts.values())
+		text = str(total)+" alert(s) as of "+time_now()+"\n\n"+"\n".join(lines)
+		if total == 1:
+			text = list(alerts.keys())[0][1]
+		try:
+			self._sendmail(error_level, text)
+			self.sent_times.append(time.time())
+		except (smtplib.SMTPException, OSError) as e:
+			print(str(" ".join([time_now(), "[WARN]", "Could not email the helpdesk: "+str(e)])))
+
+	def _connect(self):
+		server = smtplib.SMTP(self.smtp_host, self.smtp_port, timeout=self.timeout)
+		self.server = server
+		return server
+
+	def _disconnect(self):
+		if self.server != None:
+			try:
+				self.server.quit()
+			except (smtplib.SMTPException, OSError):
+				pass
+			self.server = None
+
+	def _sendmail(self, error_level, text):
+		subject = self.subject + " " + error_level
+		message = """From: %s\nTo: %s\nSubject: %s\n%s""" % (self.source, ", ".join(self.target), subject, text)
+		#The kept connection may have been closed by the server in the meantime, reconnect once
+		for attempt in range(2):
+			server = self.server
+			if server == None:
+				server = self._connect()
+			try:
+				server.sendmail(self.source, self.target, message)
+				self.server_used = time.time()
+				return
+			except (smtplib.SMTPServerDisconnected, ConnectionError):
+				self.server = None
+				if attempt == 1:
+					raise
+
+helpdesk = HelpdeskNotifier()
+atexit.register(helpdesk.close)
+
 def send_email_to_helpdesk (text, error_level="error"):
-	source = "XXX"
-	target = ["XXX"] # must be a list
-	subject = "XXX " + error_level
-	message = text
-	message = """From: %s\nTo: %s\nSubject: %s\n%s""" % (source, ", ".join(target), subject, message)
-	server = smtplib.SMTP("XXX")
-	server.sendmail(source, target, message)
-	server.quit()
+	helpdesk.notify(text, error_level)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import os, json, time, datetime, threading, inspect, contextlib
+
+def _label_key(labels):
+	return tuple(sorted((str(k), str(v)) for k, v in labels.items()))
+
+def _format_labels(key):
+	if len(key) == 0:
+		return ""
+	return "{"+",".join(k+"=\""+v.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")+"\"" for k, v in key)+"}"
+
+class Metrics:
+	#In-process counters, gauges and timing spans. Every finished span (and every event) is also written
+	#as one JSON line to json_log_path, and write_textfile() dumps the current values in the Prometheus text
+	#format to textfile_path (for the node_exporter textfile collector). Both outputs are off when their path
+	#is "", the values are kept in memory either way. Spans are exported as summaries (<name>_seconds_sum and
+	#_count) plus an <name>_errors_total counter for the spans that ended with an exception.
+	def __init__(self, json_log_path="", textfile_path="", prefix="jgi_transfer"):
+		self.json_log_path = json_log_path
+		self.textfile_path = textfile_path
+		self.prefix = prefix
+		self.lock = threading.Lock()
+		self.counters = {}
+		self.gauges = {}
+		self.summaries = {}
+		self.json_log = None
+		if json_log_path != "":
+			os.makedirs(os.path.dirname(os.path.abspath(json_log_path)), exist_ok=True)
+			self.json_log = open(json_log_path, "a", buffering=1)
+
+	def inc(self, name, value=1, **labels):
+		with self.lock:
+			key = (name, _label_key(labels))
+			self.counters[key] = self.counters.get(key, 0) + value
+
+	def set(self, name, value, **labels):
+		with self.lock:
+			self.gauges[(name, _label_key(labels))] = value
+
+	def observe(self, name, seconds, ok=True, details=None, **labels):
+		#details only go into the JSON line, e.g. values too varied to be labels
+		with self.lock:
+			key = (name, _label_key(labels))
+			total, count = self.summaries.get(key, (0.0, 0))
+			self.summaries[key] = (total + seconds, count + 1)
+		if ok == False:
+			self.inc(name+"_errors_total", **labels)
+		self.event("span", name, seconds=round(seconds, 6), ok=ok, **dict(labels, **(details or {})))
+
+	@contextlib.contextmanager
+	def span(self, name, **labels):
+		start = time.perf_counter()
+		ok = True
+		try:
+			yield
+		except BaseException:
+			ok = False
+			raise
+		finally:
+			self.observe(name, time.perf_counter() - start, ok=ok, **labels)
+
+	def event(self, event_type, name, **fields):
+		if self.json_log == None:
+			return
+		record = {"time": datetime.datetime.now().isoformat(timespec="milliseconds"), "type": event_type, "name": name}
+		record.update(fields)
+		line = json.dumps(record, default=str)
+		with self.lock:
+			self.json_log.write(line+"\n")
+
+	def instrument(self, target, name, methods, labels=None):
+		#Proxy that times the calls of the given methods of target (the ones doing I/O) as <name>_call spans
+		#labelled with the method, everything else is handed out as it is. labels(method, args, kwargs) can
+		#add labels of its own. Generators returned by a method are timed until they are used up.
+		return InstrumentedProxy(self, target, name, methods, labels)
+
+	def write_textfile(self):
+		if self.textfile_path == "":
+			return
+		lines = []
+		with self.lock:
+			types = {}
+			samples = []
+			for (name, key), value in self.counters.items():
+				types[name] = "counter"
+				samples.append((name, key, value))
+			for (name, key), value in self.gauges.items():
+				types[name] = "gauge"
+				samples.append((name, key, value))
+			for (name, key), (total, count) in self.summaries.items():
+				types[name+"_seconds"] = "summary"
+				samples.append((name+"_seconds_sum", key, total))
+				samples.append((name+"_seconds_count", key, count))
+		for family in sorted(types.keys()):
+			lines.append("# TYPE "+self.prefix+"_"+family+" "+types[family])
+			for name, key, value in sorted(samples):
+				if name == family or (types[family] == "summary" and name in (family+"_sum", family+"_count")):
+					lines.append(self.prefix+"_"+name+_format_labels(key)+" "+repr(float(value)))
+		#Written next to the target and renamed, so the collector never reads a partial file
+		tmp_path = self.textfile_path+"."+str(os.getpid())
+		os.makedirs(os.path.dirname(os.path.abspath(self.textfile_path)), exist_ok=True)
+		with open(tmp_path, "w") as tf:
+			tf.write("\n".join(lines)+"\n")
+		os.replace(tmp_path, self.textfile_path)
+
+	def close(self):
+		self.write_textfile()
+		if self.json_log != None:
+			with self.lock:
+				self.json_log.close()
+				self.json_log = None
+
+class InstrumentedProxy:
+	def __init__(self, metrics, target, name, methods, labels):
+		self._metrics = metrics
+		self._target = target
+		self._name = name
+		self._methods = frozenset(methods)
+		self._labels = labels
+
+	def __getattr__(self, attribute):
+		value = getattr(self._target, attribute)
+		if attribute not in self._methods or callable(value) == False:
+			return value
+		metrics = self._metrics
+		span_name = self._name+"_call"
+		label_fn = self._labels
+		def timed(*args, **kwargs):
+			labels = {"method": attribute}
+			if label_fn != None:
+				labels.update(label_fn(attribute, args, kwargs))
+			start = time.perf_counter()
+			try:
+				result = value(*args, **kwargs)
+			except BaseException:
+				metrics.observe(span_name, time.perf_counter() - start, ok=False, **labels)
+				raise
+			if inspect.isgenerator(result):
+				return _timed_generator(metrics, span_name, labels, result, start)
+			metrics.observe(span_name, time.perf_counter() - start, **labels)
+			return result
+		return timed
+
+def _timed_generator(metrics, span_name, labels, generator, start):
+	ok = True
+	try:
+		yield from generator
+	except GeneratorExit:
+		raise
+	except BaseException:
+		ok = False
+		raise
+	finally:
+		metrics.observe(span_name, time.perf_counter() - start, ok=ok, **labels)
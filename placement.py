@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+import os, time, errno, fcntl, shutil, hashlib
+
+FICLONE = 0x40049409
+strategies = ("auto", "rename", "hardlink", "reflink", "copy_file_range", "sendfile", "userspace")
+#errno values that mean a mechanism is not available for this pair of files, the next one is tried instead
+unsupported_errnos = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EPERM, errno.EBADF)
+
+def _reflink(src_fd, dst_fd, size, chunk_size, digest):
+	fcntl.ioctl(dst_fd, FICLONE, src_fd)
+	return size
+
+def _copy_file_range(src_fd, dst_fd, size, chunk_size, digest):
+	copied = 0
+	while copied < size:
+		count = os.copy_file_range(src_fd, dst_fd, min(chunk_size, size - copied))
+		if count == 0:
+			break
+		copied += count
+	return copied
+
+def _sendfile(src_fd, dst_fd, size, chunk_size, digest):
+	copied = 0
+	while copied < size:
+		count = os.sendfile(dst_fd, src_fd, copied, min(chunk_size, size - copied))
+		if count == 0:
+			break
+		copied += count
+	return copied
+
+def _userspace(src_fd, dst_fd, size, chunk_size, digest):
+	#Every chunk read is fed to the digest (if any) before it is written, so hashing costs no extra read
+	buffer = bytearray(min(chunk_size, 8*1024*1024))
+	view = memoryview(buffer)
+	copied = 0
+	with open(src_fd, "rb", buffering=0, closefd=False) as src, open(dst_fd, "wb", closefd=False) as dst:
+		while True:
+			count = src.readinto(buffer)
+			if not count:
+				break
+			if digest != None:
+				digest.update(view[:count])
+			dst.write(view[:count])
+			copied += count
+	return copied
+
+def _hash_file(path, digest):
+	buffer = bytearray(8*1024*1024)
+	view = memoryview(buffer)
+	with open(path, "rb", buffering=0) as f:
+		while True:
+			count = f.readinto(buffer)
+			if not count:
+				break
+			digest.update(view[:count])
+
+copiers = {"reflink": _reflink, "copy_file_range": _copy_file_range, "sendfile": _sendfile, "userspace": _userspace}
+
+class FilePlacer:
+	#Puts files into MinIO storage by rename, hardlink, reflink or copy, copies are renamed over the target once complete
+	#See CONFIG.md for which files get a checksum and which copies are verified
+	def __init__(self, strategy="auto", reflink=False, chunk_size=64*1024*1024, checksum="", checksum_all=False, verify=False):
+		if strategy not in strategies:
+			raise ValueError("Unknown file placement strategy \""+str(strategy)+"\", use one of: "+", ".join(strategies)+".")
+		if checksum != "" and checksum not in hashlib.algorithms_available:
+			raise ValueError("Unknown checksum algorithm \""+str(checksum)+"\", use one of: "+", ".join(sorted(hashlib.algorithms_guaranteed))+".")
+		if verify == True and checksum == "":
+			raise ValueError("Verifying placed files needs a checksum algorithm.")
+		if checksum != "" and checksum_all == False and (strategy != "userspace" or reflink == True):
+			#Renames, reflinks and kernel copies never see the data, most files would get no checksum at all
+			raise ValueError("A checksum for every placed file needs checksum_all (placement_checksum_all), or the userspace strategy without reflinks.")
+		self.strategy = strategy
+		self.reflink = reflink
+		self.chunk_size = chunk_size
+		self.checksum = checksum
+		self.checksum_all = checksum_all
+		self.verify = verify
+
+	def place(self, src, dst, move=True):
+		#Returns {"strategy": <mechanism used>, "bytes": <file size>, "seconds": <time taken>,
+		#"checksum": <hex digest, "" when none was computed>, "checksum_algorithm": <hashlib name>}
+		start = time.time()
+		size = os.stat(src).st_size
+		checksum = ""
+		strategy = self._link(src, dst, move)
+		if strategy == None:
+			strategy, checksum = self._copy(src, dst, size, move)
+			if move == True:
+				#The source is only removed once the target is known to be complete
+				if os.stat(dst).st_size != size:
+					raise OSError(errno.EIO, "Placed "+dst+" with "+str(os.stat(dst).st_size)+" of "+str(size)+" bytes, keeping "+src)
+				os.unlink(src)
+		elif self.checksum != "" and self.checksum_all == True:
+			digest = hashlib.new(self.checksum)
+			_hash_file(dst, digest)
+			checksum = digest.hexdigest()
+		return {"strategy": strategy, "bytes": size, "seconds": time.time() - start, "checksum": checksum, "checksum_algorithm": self.checksum}
+
+	def _link(self, src, dst, move):
+		if self.strategy not in ("auto", "rename", "hardlink"):
+			return None
+		if move == False and self.strategy != "hardlink":
+			return None
+		try:
+			if os.stat(src).st_dev != os.stat(os.path.dirname(dst) or ".").st_dev:
+				return None
+			if move == True:
+				os.rename(src, dst)
+				return "rename"
+			tmp_path = dst+".part"
+			if os.path.lexists(tmp_path) == True:
+				os.unlink(tmp_path)
+			os.link(src, tmp_path)
+			os.replace(tmp_path, dst)
+			return "hardlink"
+		except OSError as e:
+			if e.errno in unsupported_errnos or e.errno == errno.EMLINK:
+				return None
+			raise
+
+	def _copy(self, src, dst, size, move):
+		#Returns (strategy, checksum)
+		order = ["copy_file_range", "sendfile", "userspace"]
+		if self.strategy in order:
+			order = order[order.index(self.strategy):]
+		if self.reflink == True or self.strategy == "reflink":
+			order = ["reflink"] + order
+		digest = None
+		if self.checksum != "":
+			digest = hashlib.new(self.checksum)
+		checksum = ""
+		tmp_path = dst+".part"
+		try:
+			with open(src, "rb") as src_file, open(tmp_path, "wb") as dst_file:
+				for strategy in order:
+					try:
+						copied = copiers[strategy](src_file.fileno(), dst_file.fileno(), size, self.chunk_size, digest)
+						if strategy == "reflink":
+							copied = os.fstat(dst_file.fileno()).st_size
+						if copied == size:
+							break
+						#A kernel copy can stop short without an error (e.g. copy_file_range on some filesystems)
+						if strategy == "userspace":
+							raise OSError(errno.EIO, "Copied "+str(copied)+" of "+str(size)+" bytes from "+src+" to "+tmp_path)
+					except OSError as e:
+						if e.errno not in unsupported_errnos or strategy == "userspace":
+							raise
+					#Start over with the next mechanism
+					os.lseek(src_file.fileno(), 0, os.SEEK_SET)
+					os.lseek(dst_file.fileno(), 0, os.SEEK_SET)
+					os.ftruncate(dst_file.fileno(), 0)
+					if digest != None:
+						digest = hashlib.new(self.checksum)
+			if digest != None:
+				if strategy == "userspace":
+					checksum = digest.hexdigest()
+				elif strategy == "reflink":
+					if self.checksum_all == True:
+						_hash_file(tmp_path, digest)
+						checksum = digest.hexdigest()
+				elif self.checksum_all == True or self.verify == True:
+					#The kernel copied the data without handing it out, so the digest to verify against comes from the source
+					_hash_file(src, digest)
+					checksum = digest.hexdigest()
+			if self.verify == True and strategy != "reflink":
+				written = hashlib.new(self.checksum)
+				_hash_file(tmp_path, written)
+				if written.hexdigest() != checksum:
+					raise OSError(errno.EIO, "Checksum mismatch after copying "+src+" to "+tmp_path+" ("+self.checksum+" "+checksum+" read back as "+written.hexdigest()+")")
+			if move == True:
+				shutil.copystat(src, tmp_path)
+			os.replace(tmp_path, dst)
+		except BaseException:
+			if os.path.lexists(tmp_path) == True:
+				os.unlink(tmp_path)
+			raise
+		return (strategy, checksum)
+
+def describe(placement):
+	#"copy_file_range, 1520.3 MB in 2.41 s (630.8 MB/s)" for the logs, followed by the digest if there is one
+	mb = placement["bytes"] / 1e6
+	description = placement["strategy"]+", "+"%.1f MB in %.2f s (%.1f MB/s)" % (mb, placement["seconds"], mb / max(placement["seconds"], 1e-6))
+	if placement.get("checksum", "") != "":
+		description += ", "+placement["checksum_algorithm"]+" "+placement["checksum"]
+	return description
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import os, json, time, datetime
+
+policies = ("oldest", "smallest", "fair")
+no_slot_left = "no Globus task slot left"
+
+def _epoch(value):
+	#sync_timestamp as SyncRequests writes it (time_now()), or a datetime handed back by the database
+	if isinstance(value, datetime.datetime):
+		return value.timestamp()
+	try:
+		return datetime.datetime.strptime(str(value), "%Y-%m-%d %H:%M:%S").timestamp()
+	except ValueError:
+		return time.time()
+
+def directory_size(path):
+	size = 0
+	for dirpath, dirnames, filenames in os.walk(path):
+		for filename in filenames:
+			try:
+				size += os.lstat(os.path.join(dirpath, filename)).st_size
+			except OSError:
+				pass
+	return size
+
+def mb(size):
+	return "%.1f MB" % (size / 1e6)
+
+class TransferScheduler:
+	#Admits staged deliverables in policy order while there are free Globus task slots and staging disk budget
+	#Deliverable sizes are kept in state_path, only the entries this process changed are written over it
+	def __init__(self, tmp_path, policy="oldest", state_path="", reserve_bytes=0, max_inflight_bytes=0, fair_rate=100e6, size_retry_interval=3600):
+		if policy not in policies:
+			raise ValueError("Unknown transfer scheduling policy \""+str(policy)+"\", use one of: "+", ".join(policies)+".")
+		self.tmp_path = tmp_path
+		self.policy = policy
+		self.state_path = state_path
+		self.reserve_bytes = reserve_bytes
+		self.max_inflight_bytes = max_inflight_bytes
+		self.fair_rate = fair_rate
+		self.size_retry_interval = size_retry_interval
+		self.changes = {}
+		self.deliverables = self._load()
+
+	def _load(self):
+		if self.state_path == "" or os.path.exists(self.state_path) == False:
+			return {}
+		try:
+			with open(self.state_path) as sf:
+				return json.load(sf)
+		except ValueError:
+			return {}
+
+	def _merge(self):
+		#The state file as other processes left it, with the changes of this one since its last save on top
+		if self.state_path == "":
+			return
+		deliverables = self._load()
+		for fd_id, deliverable in self.changes.items():
+			if deliverable == None:
+				deliverables.pop(fd_id, None)
+			else:
+				deliverables[fd_id] = deliverable
+		self.deliverables = deliverables
+
+	def _save(self):
+		if self.state_path == "":
+			self.changes = {}
+			return
+		self._merge()
+		self.changes = {}
+		os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+		tmp_path = self.state_path+"."+str(os.getpid())
+		with open(tmp_path, "w") as sf:
+			json.dump(self.deliverables, sf)
+		os.replace(tmp_path, self.state_path)
+
+	def known_size(self, fd_id):
+		return self.deliverables.get(str(fd_id), {}).get("size")
+
+	def size_due(self, fd_id):
+		#Whether the size of a deliverable is to be looked up: never tried, or failed long enough ago
+		deliverable = self.deliverables.get(str(fd_id))
+		if deliverable == None:
+			return True
+		return deliverable["size"] == None and deliverable.get("checked", 0) + self.size_retry_interval <= time.time()
+
+	def remember(self, fd_id, size, destination):
+		self.deliverables[str(fd_id)] = {"size": size, "destination": destination, "checked": time.time()}
+		self.changes[str(fd_id)] = self.deliverables[str(fd_id)]
+		self._save()
+
+	def forget_except(self, fd_ids):
+		#Drops the deliverables that are neither staged nor downloading any more
+		keep = set(str(fd_id) for fd_id in fd_ids)
+		self._merge()
+		for fd_id in list(self.deliverables.keys()):
+			if fd_id not in keep:
+				del self.deliverables[fd_id]
+				self.changes[fd_id] = None
+		self._save()
+
+	def outstanding(self, downloading_fd_ids):
+		#Bytes still to arrive on tmp_path for the deliverables being downloaded
+		total = 0
+		for fd_id in downloading_fd_ids:
+			deliverable = self.deliverables.get(str(fd_id))
+			if deliverable == None or deliverable["size"] == None:
+				continue
+			total += max(0, deliverable["size"] - directory_size(deliverable["destination"]))
+		return total
+
+	def budget(self, downloading_fd_ids):
+		#Bytes the transfers admitted in this cycle may bring in, returns (budget, outstanding)
+		stat = os.statvfs(self.tmp_path)
+		outstanding = self.outstanding(downloading_fd_ids)
+		budget = stat.f_bavail * stat.f_frsize - self.reserve_bytes - outstanding
+		if self.max_inflight_bytes > 0:
+			budget = min(budget, self.max_inflight_bytes - outstanding)
+		return (max(0, budget), outstanding)
+
+	def order(self, candidates):
+		#candidates are {"fd_id", "size" (None if unknown), "since" (sync_timestamp)} dicts
+		if self.policy == "smallest":
+			return sorted(candidates, key=lambda c: (c["size"] == None, c["size"] or 0, _epoch(c["since"])))
+		elif self.policy == "fair":
+			return sorted(candidates, key=lambda c: _epoch(c["since"]) + (c["size"] or 0) / self.fair_rate)
+		return sorted(candidates, key=lambda c: _epoch(c["since"]))
+
+	def plan(self, candidates, slots, budget, batch_size=1):
+		#Returns [(candidate, admitted, reason)] in policy order. slots is how many Globus tasks are free, a
+		#task takes up to batch_size deliverables of one stage endpoint ("endpoint"). Deliverables of unknown
+		#size are admitted without counting against the budget.
+		decisions = []
+		tasks = 0
+		per_endpoint = {}
+		for candidate in self.order(candidates):
+			size = candidate["size"]
+			endpoint = candidate.get("endpoint", "")
+			new_task = per_endpoint.get(endpoint, 0) % max(1, batch_size) == 0
+			if new_task == True and tasks >= slots:
+				decisions.append((candidate, False, no_slot_left))
+			elif size != None and size > budget:
+				decisions.append((candidate, False, "needs "+mb(size)+", "+mb(budget)+" of staging disk budget left"))
+			else:
+				if new_task == True:
+					tasks += 1
+				per_endpoint[endpoint] = per_endpoint.get(endpoint, 0) + 1
+				if size != None:
+					budget -= size
+				decisions.append((candidate, True, (mb(size) if size != None else "size unknown")+", "+mb(budget)+" of staging disk budget left"))
+		return decisions
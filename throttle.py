@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+
+import threading, time
+from urllib.parse import urlsplit
+
+class HostRateLimiter:
+	#Token bucket per host, shared by all worker threads. rate is in requests per second,
+	#burst is how many requests can go out back to back before the rate kicks in. rate <= 0 disables limiting.
+	def __init__(self, rate=0, burst=1):
+		self.rate = float(rate)
+		self.burst = max(1, int(burst))
+		self.lock = threading.Lock()
+		self.buckets = {}
+
+	def wait(self, url):
+		if self.rate <= 0:
+			return
+		host = urlsplit(url).netloc
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				tokens, last = self.buckets.get(host, (self.burst, now))
+				tokens = min(self.burst, tokens + (now - last) * self.rate)
+				if tokens >= 1:
+					self.buckets[host] = (tokens - 1, now)
+					return
+				self.buckets[host] = (tokens, now)
+				delay = (1 - tokens) / self.rate
+			time.sleep(delay)
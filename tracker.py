@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import os, json, time, datetime
+
+terminal_statuses = ("SUCCEEDED", "FAILED")
+
+class TransferTracker:
+	#Tracks the Globus transfer tasks behind the Downloading rows. Outstanding tasks are looked up in bulk,
+	#terminal states are cached (on disk as well, so cron runs share them) and never asked for again, and
+	#tasks still running are only re-checked once their poll interval is up. The interval grows with the
+	#age of the task and the amount of data it has moved so far, between min_interval and max_interval.
+	def __init__(self, backend, state_path="", min_interval=60, max_interval=1800, age_factor=0.05, bytes_factor=10):
+		self.backend = backend
+		self.state_path = state_path
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		self.age_factor = age_factor
+		self.bytes_factor = bytes_factor
+		self.tasks = {}
+		if state_path != "" and os.path.exists(state_path) == True:
+			try:
+				with open(state_path) as sf:
+					self.tasks = json.load(sf)
+			except ValueError:
+				self.tasks = {}
+
+	def _save(self):
+		if self.state_path == "":
+			return
+		os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+		tmp_path = self.state_path+"."+str(os.getpid())
+		with open(tmp_path, "w") as sf:
+			json.dump(self.tasks, sf)
+		os.replace(tmp_path, self.state_path)
+
+	def _age(self, task):
+		try:
+			request_time = datetime.datetime.fromisoformat(str(task.get("request_time", "")).replace("Z", "+00:00"))
+		except ValueError:
+			return 0
+		if request_time.tzinfo == None:
+			request_time = request_time.replace(tzinfo=datetime.timezone.utc)
+		return max(0, (datetime.datetime.now(datetime.timezone.utc) - request_time).total_seconds())
+
+	def _interval(self, task):
+		#Young, small transfers are checked often. Old or big ones are unlikely to finish in the next
+		#minute, so they are checked less often (bytes_factor seconds per GB moved so far).
+		interval = self.min_interval + self.age_factor * self._age(task) + self.bytes_factor * int(task.get("bytes_transferred") or 0) / 1e9
+		return min(self.max_interval, interval)
+
+	def poll(self, task_ids, force=False):
+		#Returns {task_id: {"task": <task document>, "new": bool}} for every task whose status is known.
+		#"new" is set when the task reached SUCCEEDED/FAILED in this poll. Tasks that are not due for a
+		#check are returned with their last known document, or left out if they were never seen.
+		now = time.time()
+		task_ids = list(dict.fromkeys(task_ids))
+		due = [task_id for task_id in task_ids if force == True or (task_id not in self.tasks) or (self.tasks[task_id]["task"].get("status") not in terminal_statuses and self.tasks[task_id]["next_check"] <= now)]
+		fetched = {}
+		if len(due) > 0:
+			fetched = self.backend.task_statuses(due)
+		statuses = {}
+		for task_id in task_ids:
+			if task_id in fetched:
+				task = fetched[task_id]
+				was_terminal = task_id in self.tasks and self.tasks[task_id]["task"].get("status") in terminal_statuses
+				self.tasks[task_id] = {"task": task, "next_check": now + self._interval(task)}
+				statuses[task_id] = {"task": task, "new": task.get("status") in terminal_statuses and was_terminal == False}
+			elif task_id in self.tasks:
+				statuses[task_id] = {"task": self.tasks[task_id]["task"], "new": False}
+		#Forget tasks that are no longer outstanding (a forced poll only covers a few tasks, so it keeps the rest)
+		if force == False:
+			for task_id in list(self.tasks.keys()):
+				if task_id not in task_ids:
+					del self.tasks[task_id]
+		self._save()
+		return statuses